@@ -0,0 +1,156 @@
+import sys
+import gzip
+
+import numpy as np
+import pandas as pd
+
+
+# Strand codes; sites not on the '+' strand (e.g. strand '.') are treated as '-' strand
+STRAND_CODES = {'+':1, '-':-1}
+
+
+def count_header_lines(bed_file):
+    """Count the 'track', 'browser' and comment lines at the top of a BED file"""
+    opener = gzip.open if str(bed_file).endswith('.gz') else open
+
+    n = 0
+    with opener(bed_file, 'rt') as fin:
+        for line in fin:
+            if not line.startswith(('track', 'browser', '#')):
+                break
+            n += 1
+
+    return n
+
+
+def get_labels(scores, bed_file):
+    """Convert the float scores of a BED file into integer labels (see read_bed)"""
+    scores = np.nan_to_num(scores, nan=0.0)
+
+    bad = (scores != np.rint(scores)) | (np.abs(scores) > np.iinfo(np.int32).max)
+    if bad.any():
+        print('Error: the score (5th) column of the BED file', bed_file, 'must have integer labels; found', scores[bad][0], file=sys.stderr)
+        sys.exit()
+
+    if len(scores) == 0 or (scores.min() >= np.iinfo(np.int8).min and scores.max() <= np.iinfo(np.int8).max):
+        return scores.astype(np.int8)
+
+    return scores.astype(np.int32)
+
+
+def read_bed(bed_file):
+    """Read a plain or gzipped BED file into a BedRegions object
+
+    Only the first six columns are used; the 'score' column (5th) stores
+    the labels, which must be integers (e.g. '1' or '1.0'); they are int8,
+    or int32 if they don't fit. Scores of '.' and files with fewer columns
+    get label 0. As before, sites not
+    on the '+' strand, including those without a strand, are treated as '-'
+    strand. Header ('track'/'browser') and comment lines are skipped.
+    """
+    n_header = count_header_lines(bed_file)
+    try:
+        n_cols = min(pd.read_csv(bed_file, sep='\t', header=None, comment='#', skiprows=n_header, nrows=1).shape[1], 6)
+    except pd.errors.EmptyDataError:
+        return BedRegions(np.zeros(0, dtype=np.int8), np.zeros(0, dtype=str), np.zeros(0, dtype=np.int64),
+                          np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int8), bed_file)
+
+    # Scores are parsed as floats, with '.' (no score) as missing values
+    dtypes = {0:'category', 1:np.int64, 2:np.int64, 3:str, 4:np.float64, 5:'category'}
+    try:
+        bed_pd = pd.read_csv(bed_file, sep='\t', header=None, comment='#', skiprows=n_header, usecols=range(n_cols),
+                             dtype={i:dtypes[i] for i in range(n_cols)}, keep_default_na=False, na_values={4:['.', '']})
+    except ValueError as e:
+        print('Error: cannot read the BED file', bed_file, '(', e, '); the start/end (2nd/3rd) columns must be integers and the score (5th) column numbers', file=sys.stderr)
+        sys.exit()
+
+    # Chromosomes are stored as categorical codes
+    chrom_codes = bed_pd[0].cat.codes.to_numpy()
+    chrom_names = bed_pd[0].cat.categories.to_numpy(dtype=str)
+
+    n = bed_pd.shape[0]
+    labels = get_labels(bed_pd[4].to_numpy(), bed_file) if n_cols > 4 else np.zeros(n, dtype=np.int8)
+
+    strands = np.full(n, STRAND_CODES['-'], dtype=np.int8)
+    if n_cols > 5:
+        strand_cats = np.array([STRAND_CODES.get(s, STRAND_CODES['-']) for s in bed_pd[5].cat.categories], dtype=np.int8)
+        strands = strand_cats[bed_pd[5].cat.codes.to_numpy()]
+
+    return BedRegions(chrom_codes, chrom_names, bed_pd[1].to_numpy(), bed_pd[2].to_numpy(), strands, labels, bed_file)
+
+
+class BedRegions:
+    """Columns of BED regions as NumPy arrays"""
+    def __init__(self, chrom_codes, chrom_names, starts, ends, strands, labels, fn=None):
+        """
+        Args:
+            chrom_codes: chromosome of each region, as an index of chrom_names
+            chrom_names: names of chromosomes
+            starts: 0-based start positions (int64)
+            ends: end positions (int64)
+            strands: strand codes (int8; 1: '+', -1: '-')
+            labels: labels in the 'score' column (int8, or int32 if they don't fit)
+            fn: the BED file of the regions; None for subsets of a file
+        """
+        self.chrom_codes = chrom_codes
+        self.chrom_names = chrom_names
+        self.starts = starts
+        self.ends = ends
+        self.strands = strands
+        self.labels = labels
+        self.fn = fn
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        """Get a subset of the regions; slicing returns views without copying"""
+        if isinstance(idx, range):
+            idx = slice(idx.start, idx.stop, idx.step)
+        fn = self.fn if isinstance(idx, slice) and idx == slice(None) else None
+
+        return BedRegions(self.chrom_codes[idx], self.chrom_names, self.starts[idx], self.ends[idx],
+                          self.strands[idx], self.labels[idx], fn)
+
+    @property
+    def chroms(self):
+        """Chromosome names of the regions"""
+        return self.chrom_names[self.chrom_codes]
+
+    @property
+    def strand_chars(self):
+        """Strands of the regions as '+', '-' or '.'"""
+        return np.array(['.', '+', '-'])[self.strands]
+
+    def to_dataframe(self):
+        """Convert the regions into a DataFrame with 'chrom', 'start', 'end', 'score' and 'strand' columns"""
+        return pd.DataFrame({'chrom':self.chroms, 'start':self.starts, 'end':self.ends,
+                             'score':self.labels, 'strand':self.strand_chars})
+
+    def overlaps(self, chroms, starts, ends):
+        """Check which intervals [starts, ends) overlap any of the regions"""
+        chroms = np.asarray(chroms).astype(str)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+
+        mask = np.zeros(len(starts), dtype=bool)
+        region_chroms = self.chroms
+        for chrom in np.unique(chroms):
+            idx = np.flatnonzero(chroms == chrom)
+
+            # Merge the regions of the chromosome into sorted disjoint intervals
+            in_chrom = np.flatnonzero(region_chroms == chrom)
+            if len(in_chrom) == 0:
+                continue
+            order = np.argsort(self.starts[in_chrom], kind='stable')
+            r_starts = self.starts[in_chrom][order]
+            r_ends = np.maximum.accumulate(self.ends[in_chrom][order])
+            first = np.concatenate(([True], r_starts[1:] > r_ends[:-1]))
+            r_ends = r_ends[np.append(np.flatnonzero(first)[1:]-1, len(r_starts)-1)]
+            r_starts = r_starts[first]
+
+            # The last interval starting before each end must cover the start
+            k = np.searchsorted(r_starts, ends[idx], side='left') - 1
+            mask[idx] = (k >= 0) & (r_ends[np.maximum(k, 0)] > starts[idx])
+
+        return mask
@@ -0,0 +1,471 @@
+import os
+import sys
+
+import pyBigWig
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from MuRaL.genome_utils import merge_windows, is_minus_strand
+from MuRaL.cache_utils import file_lock, atomic_output
+
+
+# Suffixes of bigWig stores for each data type
+BW_STORE_SUFFIXES = {'float16':'.mural.f16', 'uint8':'.mural.u8'}
+
+# Number of positions read from a bigWig file at a time when packing
+PACK_BLOCK_SIZE = 10000000
+
+
+def get_bw_quant_params(bw_file):
+    """Get (vmin, scale) for linearly quantizing the values of a bigWig track into uint8
+    
+    Values (missing values as 0) are coded as rint((value-vmin)/scale), so
+    that the minimum and the maximum of the track map to 0 and 255.
+    """
+    bw = pyBigWig.open(bw_file)
+    
+    vmin, vmax = 0.0, 0.0
+    for chrom, chrom_len in bw.chroms().items():
+        vmin = min(vmin, np.nan_to_num(bw.stats(chrom, 0, chrom_len, type='min', exact=True)[0]))
+        vmax = max(vmax, np.nan_to_num(bw.stats(chrom, 0, chrom_len, type='max', exact=True)[0]))
+    bw.close()
+    
+    return float(vmin), float((vmax - vmin)/255 if vmax > vmin else 1.0)
+
+def get_bw_store_path(bw_file, dtype='float16'):
+    """Get the file path of the dense store of a bigWig file"""
+    return bw_file + BW_STORE_SUFFIXES[dtype]
+
+def pack_bigwig(bw_file, store_path, dtype='float16'):
+    """Convert a bigWig file into a dense store of base-wise values
+    
+    The store has two files: 'store_path' with the values of all 
+    chromosomes as one contiguous array, and 'store_path.idx' with the 
+    dequantization parameters in the header line and the name, offset 
+    and length of each chromosome. Missing values are stored as 0.
+    
+    Args:
+        bw_file: file path of the bigWig track
+        store_path: file path of the store
+        dtype: 'float16', or 'uint8' for values linearly quantized 
+            between the minimum and the maximum of the track
+    """
+    print('Packing the bigWig file:', bw_file, '->', store_path)
+    sys.stdout.flush()
+    
+    bw = pyBigWig.open(bw_file)
+    
+    # value = code*scale + vmin
+    vmin, scale = 0.0, 1.0
+    if dtype == 'uint8':
+        vmin, scale = get_bw_quant_params(bw_file)
+    
+    # Write to temporary files, renamed into place when complete, so that 
+    # other jobs never see a partially written store; the index file is 
+    # renamed last, and its presence marks a complete store
+    chrom_index = []
+    offset = 0
+    with atomic_output(store_path + '.idx') as tmp_idx_path:
+        with atomic_output(store_path) as tmp_path, open(tmp_path, 'wb') as fout:
+            for chrom, chrom_len in bw.chroms().items():
+                for start in range(0, chrom_len, PACK_BLOCK_SIZE):
+                    stop = min(start+PACK_BLOCK_SIZE, chrom_len)
+                    values = np.nan_to_num(bw.values(chrom, start, stop, numpy=True))
+                    if dtype == 'uint8':
+                        values = np.rint((values - vmin)/scale)
+                    else:
+                        values = np.clip(values, np.finfo(np.float16).min, np.finfo(np.float16).max)
+                    values.astype(dtype).tofile(fout)
+                
+                chrom_index.append((chrom, offset, chrom_len))
+                offset += chrom_len
+        bw.close()
+        
+        with open(tmp_idx_path, 'w') as fidx:
+            fidx.write('#{}\t{!r}\t{!r}\n'.format(dtype, float(vmin), float(scale)))
+            for chrom, chrom_offset, chrom_len in chrom_index:
+                fidx.write('{}\t{}\t{}\n'.format(chrom, chrom_offset, chrom_len))
+    
+    return store_path
+
+def check_bw_store(bw_file, store_path):
+    """Check whether the store of a bigWig file exists, is complete and is newer than the file"""
+    return os.path.exists(store_path + '.idx') and os.path.getmtime(store_path + '.idx') >= os.path.getmtime(bw_file)
+
+def get_bw_store(bw_file, dtype='float16'):
+    """Get the dense store of a bigWig file, generating it if needed
+    
+    Returns None if the store can't be written.
+    """
+    store_path = get_bw_store_path(bw_file, dtype)
+    
+    # Check whether the existing store is latest and complete
+    if not check_bw_store(bw_file, store_path):
+        try:
+            # Concurrent jobs for the same track wait for the one packing it,
+            # which may have finished while this job was waiting
+            with file_lock(store_path):
+                if not check_bw_store(bw_file, store_path):
+                    pack_bigwig(bw_file, store_path, dtype)
+        except OSError as e:
+            print('Warning: cannot write the bigWig store (', e, '), reading the bigWig file instead', file=sys.stderr)
+            
+            return None
+    
+    return BigWigStore(store_path)
+
+
+class BigWigStore:
+    """Base-wise values of a bigWig track, accessed via np.memmap"""
+    def __init__(self, store_path):
+        """
+        Args:
+            store_path: file path of the store generated by pack_bigwig
+        """
+        self.store_path = store_path
+        
+        # chrom -> (offset, length)
+        self.chrom_index = {}
+        with open(store_path + '.idx', 'r') as fidx:
+            dtype, vmin, scale = fidx.readline().lstrip('#').rstrip('\n').split('\t')
+            for line in fidx:
+                chrom, offset, length = line.rstrip('\n').split('\t')
+                self.chrom_index[chrom] = (int(offset), int(length))
+        
+        self.dtype = np.dtype(dtype)
+        self.vmin = float(vmin)
+        self.scale = float(scale)
+        
+        self._values = None
+    
+    def __getstate__(self):
+        # Don't pickle the memmap; each process maps the file by itself
+        state = self.__dict__.copy()
+        state['_values'] = None
+        
+        return state
+    
+    @property
+    def values(self):
+        """The whole store"""
+        if self._values is None:
+            self._values = np.memmap(self.store_path, dtype=self.dtype, mode='r')
+        
+        return self._values
+    
+    def chroms(self, chrom):
+        """Length of a chromosome, or None for chromosomes not in the track"""
+        return self.chrom_index[chrom][1] if chrom in self.chrom_index else None
+    
+    def get_chrom(self, chrom):
+        """Get the stored array (a view of the store) of a chromosome"""
+        offset, length = self.chrom_index[chrom]
+        
+        return self.values[offset:offset+length]
+    
+    def decode(self, values):
+        """Convert stored values into float32 values"""
+        values = values.astype(np.float32)
+        if self.dtype == np.uint8:
+            values *= self.scale
+            values += self.vmin
+        
+        return values
+
+
+def get_bw_sum_index_path(bw_file):
+    """Get the directory path of the prefix-sum index of a bigWig file"""
+    return bw_file + '.mural.csum'
+
+def build_bw_sum_index(bw_file, index_path):
+    """Build the prefix-sum index of a bigWig file in the directory 'index_path'
+    
+    For each chromosome, the sums of track values over [0, pos) for all 
+    pos in [0, length] are stored as a float64 .npy file, so that the sum
+    of any window takes two lookups. The values are read block by block
+    (see PACK_BLOCK_SIZE), so building takes little memory whatever the 
+    resolution of the track. Missing values count as 0.
+    
+    'chroms.txt' lists the name and length of each chromosome, whose 
+    prefix sums are in '<line number>.npy'; it is written last and marks
+    a complete index.
+    """
+    os.makedirs(index_path, exist_ok=True)
+    
+    bw = pyBigWig.open(bw_file)
+    chrom_lens = list(bw.chroms().items())
+    for i, (chrom, chrom_len) in enumerate(chrom_lens):
+        with atomic_output(os.path.join(index_path, str(i) + '.npy')) as tmp_path:
+            sums = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64, shape=(chrom_len+1,))
+            sums[0] = 0
+            for start in range(0, chrom_len, PACK_BLOCK_SIZE):
+                stop = min(start+PACK_BLOCK_SIZE, chrom_len)
+                values = np.nan_to_num(bw.values(chrom, start, stop, numpy=True)).astype(np.float64)
+                np.cumsum(values, out=sums[start+1:stop+1])
+                sums[start+1:stop+1] += sums[start]
+            sums.flush()
+            del sums
+    bw.close()
+    
+    with atomic_output(os.path.join(index_path, 'chroms.txt')) as tmp_path, open(tmp_path, 'w') as fout:
+        for chrom, chrom_len in chrom_lens:
+            fout.write('{}\t{}\n'.format(chrom, chrom_len))
+
+def get_bw_sum_index(bw_file):
+    """Get the prefix-sum index of a bigWig file, generating it if needed
+    
+    The index is cached next to the bigWig file. Returns None if the index
+    can't be written; window means are then computed with bw.stats().
+    """
+    index_path = get_bw_sum_index_path(bw_file)
+    chroms_path = os.path.join(index_path, 'chroms.txt')
+    
+    # Concurrent jobs for the same track wait for the one building the index
+    try:
+        with file_lock(index_path):
+            # Check whether the existing index is latest and complete
+            if not os.path.exists(chroms_path) or os.path.getmtime(chroms_path) < os.path.getmtime(bw_file):
+                print('Building the prefix-sum index of the bigWig file:', bw_file, '->', index_path)
+                sys.stdout.flush()
+                
+                build_bw_sum_index(bw_file, index_path)
+    except OSError as e:
+        print('Warning: cannot write the prefix-sum index (', e, '), using bigWig stats instead', file=sys.stderr)
+        
+        return None
+    
+    return BigWigSumIndex(index_path)
+
+def get_bw_stats_means(bw_file, chroms, starts, radius):
+    """Get mean track values of the (2*radius+1)-bp windows centered at given sites,
+    reading window sums from the bigWig file (see BigWigSumIndex.get_means)
+    """
+    bw = pyBigWig.open(bw_file)
+    chrom_lens = bw.chroms()
+    
+    means = np.zeros(len(starts))
+    for i, (chrom, start) in enumerate(zip(chroms, starts)):
+        if chrom not in chrom_lens:
+            continue
+        
+        start1 = int(np.clip(start-radius, 0, chrom_lens[chrom]))
+        stop1 = int(np.clip(start+radius+1, 0, chrom_lens[chrom]))
+        if stop1 > start1:
+            # The sum of a window without data is None
+            means[i] = (bw.stats(chrom, start1, stop1, type='sum', exact=True)[0] or 0.0) / (stop1-start1)
+    bw.close()
+    
+    return means
+
+
+class BigWigSumIndex:
+    """Prefix-sum index of a bigWig track for computing window sums and means
+    
+    The prefix sums of each chromosome are accessed via np.memmap, so 
+    processes sharing an index don't load it into memory.
+    """
+    def __init__(self, index_path):
+        """
+        Args:
+            index_path: directory of the index generated by build_bw_sum_index
+        """
+        self.index_path = index_path
+        
+        # chrom -> (file number, length)
+        self.chrom_index = {}
+        with open(os.path.join(index_path, 'chroms.txt'), 'r') as fidx:
+            for i, line in enumerate(fidx):
+                chrom, length = line.rstrip('\n').split('\t')
+                self.chrom_index[chrom] = (i, int(length))
+        
+        self._sums = {}
+    
+    def __getstate__(self):
+        # Don't pickle the memmaps; each process maps the files by itself
+        state = self.__dict__.copy()
+        state['_sums'] = {}
+        
+        return state
+    
+    def get_prefix_sums(self, chrom):
+        """Get the prefix sums of a chromosome, of length chrom_len+1"""
+        if chrom not in self._sums:
+            self._sums[chrom] = np.load(os.path.join(self.index_path, str(self.chrom_index[chrom][0]) + '.npy'), mmap_mode='r')
+        
+        return self._sums[chrom]
+    
+    def get_means(self, chroms, starts, radius):
+        """Get mean track values of the (2*radius+1)-bp windows centered at given sites
+        
+        Missing values count as 0, and positions beyond chromosome ends 
+        are not counted. Windows on chromosomes not in the track are 0.
+        """
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        
+        means = np.zeros(len(starts))
+        for chrom in np.unique(chroms):
+            if chrom not in self.chrom_index:
+                continue
+            
+            idx = np.flatnonzero(chroms == chrom)
+            chrom_len = self.chrom_index[chrom][1]
+            start1 = np.clip(starts[idx]-radius, 0, chrom_len)
+            stop1 = np.clip(starts[idx]+radius+1, 0, chrom_len)
+            
+            sums = self.get_prefix_sums(chrom)
+            means[idx] = (sums[stop1] - sums[start1]) / np.maximum(stop1-start1, 1)
+        
+        return means
+
+
+class BigWigReader:
+    """Read windows of bigWig tracks for sites, keeping the files open across calls"""
+    def __init__(self, bw_files, n_threads=None, max_gap=1000, cache=None):
+        """
+        Args:
+            bw_files: file paths of bigWig tracks
+            n_threads: number of threads reading tracks concurrently;
+                default: one per track (at most 8)
+            max_gap: windows of sorted sites separated by gaps shorter than
+                this are read with one values() call
+            cache: if 'float16' or 'uint8', read the tracks from dense 
+                stores of that type (see pack_bigwig), generated if needed
+        """
+        self.bw_files = list(bw_files)
+        self.n_threads = n_threads if n_threads else min(len(self.bw_files), 8)
+        self.max_gap = max_gap
+        
+        # Stores are generated here, in the main process
+        self.bw_stores = [None]*len(self.bw_files)
+        if cache:
+            self.bw_stores = [get_bw_store(file, cache) for file in self.bw_files]
+
+        # Prefix-sum indices for window means, loaded when first used
+        self.sum_indices = None
+
+        self._pid = None
+        self._bw_fh = None
+        self._pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_bw_fh'] = None
+        state['_pool'] = None
+
+        return state
+
+    def __len__(self):
+        return len(self.bw_files)
+
+    @property
+    def bw_fh(self):
+        """File handles (or stores) of the tracks, opened once in each process
+
+        Handles and threads inherited from a parent process (e.g. in a
+        forked DataLoader worker) are unusable, so they are reopened.
+        """
+        if self._pid != os.getpid():
+            self._bw_fh = [store if store is not None else pyBigWig.open(file) for file, store in zip(self.bw_files, self.bw_stores)]
+            self._pool = ThreadPoolExecutor(self.n_threads) if self.n_threads > 1 else None
+            self._pid = os.getpid()
+
+        return self._bw_fh
+
+    def close(self):
+        if self._pid == os.getpid():
+            for bw in self._bw_fh:
+                if not isinstance(bw, BigWigStore):
+                    bw.close()
+            if self._pool is not None:
+                self._pool.shutdown()
+
+        self._pid = None
+        self._bw_fh = None
+        self._pool = None
+
+    def _map_tracks(self, func):
+        """Apply func(track_index, bw) to all tracks, concurrently if threads are used"""
+        bw_fh = self.bw_fh
+        if self._pool is None:
+            return [func(j, bw) for j, bw in enumerate(bw_fh)]
+
+        return list(self._pool.map(func, range(len(bw_fh)), bw_fh))
+
+    def get_windows(self, chroms, starts, strands, radius, out=None):
+        """Get track values of the (2*radius+1)-bp windows centered at given sites
+
+        Args:
+            chroms: chromosome names of the sites
+            starts: 0-based positions of the sites
+            strands: strands ('+'/'-', or int8 codes 1/-1) of the sites
+            radius: radius of the windows
+            out: preallocated array of shape (n_sites, n_tracks, 2*radius+1)
+
+        Returns a float32 array of shape (n_sites, n_tracks, 2*radius+1).
+        Missing values and positions beyond chromosome ends are 0; windows
+        of '-' strand sites are reversed.
+        """
+        seq_len = 2*radius + 1
+        segments, offsets = merge_windows(chroms, starts, radius, self.max_gap)
+
+        if out is None:
+            out = np.empty((len(offsets), len(self.bw_files), seq_len), dtype=np.float32)
+
+        def read_track(j, bw):
+            buf = self._read_segments(bw, segments)
+
+            # Windows are strided views of the segments; indexing makes the copy
+            windows = np.lib.stride_tricks.sliding_window_view(buf, seq_len)
+            out[:, j, :] = windows[offsets]
+
+        self._map_tracks(read_track)
+
+        minus = is_minus_strand(strands)
+        out[minus] = out[minus, :, ::-1]
+
+        return out
+
+    def get_means(self, chroms, starts, radius):
+        """Get mean track values of the (2*radius+1)-bp windows centered at given sites
+
+        Returns a float64 array of shape (n_sites, n_tracks); positions
+        beyond chromosome ends are not counted. The means are computed from
+        the prefix-sum indices of the tracks (see get_bw_sum_index), or 
+        from bigWig stats for tracks without an index.
+        """
+        if self.sum_indices is None:
+            self.sum_indices = [get_bw_sum_index(file) for file in self.bw_files]
+
+        means = [sum_index.get_means(chroms, starts, radius) if sum_index is not None else get_bw_stats_means(file, chroms, starts, radius) 
+                 for file, sum_index in zip(self.bw_files, self.sum_indices)]
+
+        return np.stack(means, axis=1) if len(means) > 0 else np.zeros((len(starts), 0))
+
+    def _read_segments(self, bw, segments):
+        """Read track values of merged segments, concatenated into one float32 array"""
+        bufs = []
+        for chrom, seg_starts, seg_lens in segments:
+            buf = np.zeros(seg_lens.sum(), dtype=np.float32)
+            chrom_len = bw.chroms(chrom)
+
+            if chrom_len and isinstance(bw, BigWigStore):
+                # Gather all segments of the run from the store at once
+                seg_offsets = np.concatenate(([0], np.cumsum(seg_lens)[:-1]))
+                pos = np.arange(len(buf)) + np.repeat(seg_starts - seg_offsets, seg_lens)
+                in_chrom = (pos >= 0) & (pos < chrom_len)
+                buf[in_chrom] = bw.decode(bw.get_chrom(chrom)[pos[in_chrom]])
+            elif chrom_len:
+                offset = 0
+                for seg_start, seg_len in zip(seg_starts, seg_lens):
+                    # One values() call for each segment, clipped to the chromosome
+                    start1 = max(seg_start, 0)
+                    stop1 = min(seg_start+seg_len, chrom_len)
+                    if stop1 > start1:
+                        buf[offset+start1-seg_start:offset+stop1-seg_start] = bw.values(chrom, int(start1), int(stop1), numpy=True)
+                    offset += seg_len
+
+            bufs.append(buf)
+
+        return np.nan_to_num(np.concatenate(bufs), copy=False) if len(bufs) > 0 else np.zeros(0, dtype=np.float32)
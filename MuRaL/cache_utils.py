@@ -0,0 +1,82 @@
+import os
+import json
+import hashlib
+import fcntl
+from contextlib import contextmanager
+
+
+# Version of the cached data schema; bump it to invalidate older caches
+CACHE_SCHEMA_VERSION = 1
+
+# Content hashes of files computed in this process, keyed by (path, size, mtime)
+_file_hashes = {}
+
+
+def get_file_hash(path, block_size=1<<24):
+    """Get the SHA1 hash of the content of a file, computed once per process"""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+    if key not in _file_hashes:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as fin:
+            for block in iter(lambda: fin.read(block_size), b''):
+                sha1.update(block)
+        _file_hashes[key] = sha1.hexdigest()
+
+    return _file_hashes[key]
+
+def get_file_id(path):
+    """Identify a (large) file by its absolute path, size and modification time"""
+    st = os.stat(path)
+
+    return [os.path.realpath(path), st.st_size, st.st_mtime_ns]
+
+def get_cache_key(**items):
+    """Get a short hash of the given (JSON-serializable) items, e.g. the inputs of a cached file"""
+    items['schema_version'] = CACHE_SCHEMA_VERSION
+
+    return hashlib.sha1(json.dumps(items, sort_keys=True).encode()).hexdigest()[0:16]
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock of 'path' (using the file path+'.lock')
+
+    Jobs building the same cached file wait for each other; POSIX locks
+    also work on NFS. The lock file is removed when the lock is released,
+    so no lock files are left next to the cached files.
+    """
+    lock_path = path + '.lock'
+    while True:
+        flock = open(lock_path, 'a')
+        fcntl.lockf(flock, fcntl.LOCK_EX)
+
+        # The previous holder may have removed the lock file while this job
+        # was waiting; retry with the current lock file in that case
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(flock.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        flock.close()
+
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
+        fcntl.lockf(flock, fcntl.LOCK_UN)
+        flock.close()
+
+@contextmanager
+def atomic_output(path):
+    """Get a temporary path to be written, which is renamed to 'path' if no error occurs
+
+    Readers never see a partially written file at 'path'.
+    """
+    tmp_path = path + '.tmp' + str(os.getpid())
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
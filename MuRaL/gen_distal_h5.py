@@ -1,7 +1,6 @@
 import warnings
 warnings.filterwarnings('ignore',category=FutureWarning)
 
-from pybedtools import BedTool
 
 import sys
 import argparse
@@ -23,6 +22,7 @@ import datetime
 #from MuRaL.nn_models import *
 #from MuRaL.nn_utils import *
 from MuRaL.preprocessing import *
+from MuRaL.bed_utils import read_bed
 #from MuRaL.evaluation import *
 from MuRaL._version import __version__
 
@@ -67,13 +67,16 @@ def parse_arguments(parser):
     
     optional.add_argument('--distal_order', type=int, metavar='INT', default=1, 
                           help=textwrap.dedent("""
-                          Order of distal sequences to be considered. Kept for 
-                          future development. Default: 1. """ ).strip())
+                          Order of distal sequences to be considered. Only used
+                          for the 'float32' layout, as the 'compact' layout has
+                          base codes for all orders. Default: 1. """ ).strip())
     
     optional.add_argument('--distal_binsize', type=int, metavar='INT', default=1, 
                           help=textwrap.dedent("""
-                          Bin size of distal sequences. Kept for 
-                          future development. Default: 1. """ ).strip())
+                          Bin size of distal data. Values of one-hot encoded bases 
+                          and bigWig tracks are averaged in bins, e.g. for coarse
+                          levels of multi-resolution distal data (see --distal_bins
+                          of mural_train). Default: 1. """ ).strip())
     
     optional.add_argument('--i_file', type=int, metavar='INT', default=0, 
                           help=textwrap.dedent("""
@@ -88,6 +91,67 @@ def parse_arguments(parser):
                           help=textwrap.dedent("""
                           Bioseq read chunk size. Default: 10000. """ ).strip())
     
+    optional.add_argument('--n_workers', type=int, metavar='INT', default=4, 
+                          help=textwrap.dedent("""
+                          Number of processes encoding chunks of sites, while earlier
+                          chunks are compressed and written; with '--n_files' > 1, 
+                          they are split among the jobs for each file. Default: 4. 
+                          """ ).strip())
+    
+    optional.add_argument('--h5_layout', type=str, metavar='STR', default='compact', choices=['compact', 'float32'],
+                          help=textwrap.dedent("""
+                          Layout of distal data in HDF5 files: 'compact' (uint8 base 
+                          codes and reduced-precision bigWig tracks, one-hot encoded
+                          when read) or 'float32' (one-hot encoded data). Only 
+                          'float32' is used when distal_binsize > 1. Default: 'compact'.
+                          """ ).strip())
+    
+    optional.add_argument('--track_dtype', type=str, metavar='STR', default='float16', choices=['float16', 'uint8'],
+                          help=textwrap.dedent("""
+                          Data type of bigWig tracks in the 'compact' layout: 'float16',
+                          or 'uint8' for values linearly quantized between the minimum 
+                          and the maximum of each track. Default: 'float16'.
+                          """ ).strip())
+    
+    optional.add_argument('--h5_codec', type=str, metavar='STR', default='gzip', choices=H5_CODECS,
+                          help=textwrap.dedent("""
+                          Codec for compressing HDF5 datasets: 'gzip', 'lzf', 'none', 
+                          or 'blosc' (Blosc with LZ4; requires the hdf5plugin package
+                          for writing and reading). Default: 'gzip'.
+                          """ ).strip())
+    
+    optional.add_argument('--h5_chunk_rows', type=int, metavar='INT', default=H5_CHUNK_ROWS,
+                          help=textwrap.dedent("""
+                          Number of rows (sites) in each HDF5 chunk. Larger chunks 
+                          compress better and are faster for reading contiguous rows,
+                          but each random read decompresses a whole chunk; training 
+                          draws the rows of a chunk in nearby batches. Default: 256.
+                          """ ).strip())
+    
+    optional.add_argument('--cache_dir', type=str, metavar='DIR', default=None,
+                          help=textwrap.dedent("""
+                          Directory for the HDF5 files. File names include a hash of
+                          the BED content, the genome and bigWig files and the 
+                          parameters, so that existing files are reused only for the
+                          same inputs. Default: the directory of the BED file.
+                          """ ).strip())
+    
+    optional.add_argument('--base_h5', type=str, metavar='FILE', default=None,
+                          help=textwrap.dedent("""
+                          An existing H5 file (compact layout) of the same genome, 
+                          bigWig files and parameters, e.g. of an earlier version of 
+                          the BED file. Data of the sites in it are reused and only 
+                          new sites are encoded; the new file links to it, so it must
+                          be kept. Default: the latest H5 file of the same BED file
+                          name in the directory of the H5 files, if any.
+                          """ ).strip())
+    
+    optional.add_argument('--full_rebuild', default=False, action='store_true',  
+                          help=textwrap.dedent("""
+                          Generate the H5 file from scratch, without reusing the data
+                          of existing H5 files. Default: False.
+                          """ ).strip())
+    
     optional.add_argument('--out_format', type=str, metavar='STR', default='h5',  
                           help=textwrap.dedent("""
                           Generate HDF5 ('h5').
@@ -133,18 +197,29 @@ def main():
     distal_radius = args.distal_radius
     distal_order = args.distal_order # reserved for future improvement
     distal_binsize = args.distal_binsize
+    h5_layout = args.h5_layout
+    
+    # Base codes are stored for all distal orders in the compact layout; 
+    # datasets derive the k-mers of higher orders
+    if h5_layout == 'compact':
+        distal_order = 1
+    track_dtype = args.track_dtype
+    h5_codec = args.h5_codec
+    h5_chunk_rows = args.h5_chunk_rows
+    cache_dir = os.path.abspath(args.cache_dir) if args.cache_dir else None
     
     i_file = args.i_file
     n_files = args.n_files
 
     chunk_size = args.chunk_size
+    n_workers = args.n_workers
     
     start_time = time.time()
     print('Start time:', datetime.datetime.now())
     sys.stdout.flush()
     
     # Read BED files
-    test_bed = BedTool(bed_file)
+    test_bed = read_bed(bed_file)
 
     # Read bigWig file names
     bw_paths = args.bw_paths
@@ -161,59 +236,101 @@ def main():
     else:
         print('NOTE: no bigWig files provided.')
 
+    # The H5 file path is keyed by the inputs
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    h5f_path = get_h5f_cache_path(bed_file, ref_genome, bw_files, bw_names, distal_radius, distal_order, cache_dir, h5_layout, track_dtype, distal_binsize)
+    n_channels = 4**distal_order + len(bw_files)
+    inputs_key = get_h5f_inputs_key(ref_genome, bw_files, distal_radius, distal_order, h5_layout, track_dtype, distal_binsize)
+    
+    # Data of existing files can be reused for the compact layout
+    incremental = h5_layout == 'compact' and distal_order == 1 and distal_binsize == 1 and not args.full_rebuild
+    base_h5f_path = os.path.abspath(args.base_h5) if args.base_h5 else None
+    
     if i_file == 0:
-        if n_files == 1:
-            h5f_path = get_h5f_path(bed_file, bw_names, distal_radius, distal_order)
-            generate_h5f(test_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_files, 1, chunk_size)
-            #generate_h5fv2(test_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_files, 1, chunk_size)
-
-        elif n_files > 1:
-            cmd = sys.argv[0]
+        # Concurrent jobs for the same file wait for the one generating it,
+        # and then use the generated file
+        with file_lock(h5f_path):
+            if check_h5f(h5f_path, len(test_bed), n_channels):
+                print('Using the existing H5 file:', h5f_path)
             
-            ps = []
-            for i in range(n_files):
-                args = [cmd, 
-                         '--ref_genome', ref_genome, 
-                         '--bed_file', bed_file, 
-                         '--distal_radius', str(distal_radius), 
-                         '--distal_order', str(distal_order), 
-                         '--i_file', str(i+1), 
-                         '--n_files', str(n_files), 
-                         '--chunk_size', str(chunk_size),
-                         '--distal_binsize', str(distal_binsize)]
-                if bw_paths != None:
-                    args.append('--bw_paths')
-                    args.append(bw_paths)
-                #'--bw_paths', bw_paths, 
-                p = subprocess.Popen(args)
-                ps.append(p)
-            for p in ps:
-                p.wait()
+            elif incremental and generate_h5f_incremental(test_bed, h5f_path, base_h5f_path, ref_genome, bw_files, inputs_key, chunk_size, n_workers=n_workers):
+                print('Generated the H5 file by reusing an existing H5 file')
             
-            h5f_path = get_h5f_path(bed_file, bw_names, distal_radius, distal_order)
+            elif n_files == 1 and distal_binsize > 1:
+                generate_h5f_singlev2(test_bed, h5f_path, ref_genome, distal_radius, distal_order, distal_binsize, bw_files, chunk_size, h5_codec, h5_chunk_rows, n_workers)
             
-            with h5py.File(h5f_path, 'w') as hf:
-                for i in  range(n_files):
-                    h5f_path_i = re.sub('h5$', str(i+1)+'.h5', h5f_path)
-                    hf['distal_X'+str(i+1)] = h5py.ExternalLink(h5f_path_i, 'distal_X')
-            with h5py.File(h5f_path, 'r') as hf:
-                data_size = 0
-                for key in hf.keys():
-                    data_size += hf[key].shape[0]
-                    print(key, hf[key].shape[0])
-                print('hf.keys():', hf.keys(), data_size)
+            elif n_files == 1:
+                generate_h5f(test_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_files, h5_chunk_rows, chunk_size, h5_layout, track_dtype, h5_codec, inputs_key, n_workers)
+                #generate_h5fv2(test_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_files, 1, chunk_size)
+
+            elif n_files > 1:
+                # Pack the reference genome once before starting the jobs for each
+                # file, unless the sites are few enough to read its FASTA index
+                get_genome(ref_genome, len(test_bed)*(2*distal_radius+1))
+                
+                cmd = sys.argv[0]
+                
+                # Split the workers among the jobs, so that they use n_workers CPUs in total
+                n_workers_i = max(1, n_workers // n_files)
+                
+                ps = []
+                for i in range(n_files):
+                    args = [cmd, 
+                             '--ref_genome', ref_genome, 
+                             '--bed_file', bed_file, 
+                             '--distal_radius', str(distal_radius), 
+                             '--distal_order', str(distal_order), 
+                             '--i_file', str(i+1), 
+                             '--n_files', str(n_files), 
+                             '--chunk_size', str(chunk_size),
+                             '--n_workers', str(n_workers_i),
+                             '--distal_binsize', str(distal_binsize),
+                             '--h5_layout', h5_layout,
+                             '--track_dtype', track_dtype,
+                             '--h5_codec', h5_codec,
+                             '--h5_chunk_rows', str(h5_chunk_rows)]
+                    if bw_paths != None:
+                        args.append('--bw_paths')
+                        args.append(bw_paths)
+                    if cache_dir:
+                        args.append('--cache_dir')
+                        args.append(cache_dir)
+                    #'--bw_paths', bw_paths, 
+                    p = subprocess.Popen(args)
+                    ps.append(p)
+                for p in ps:
+                    p.wait()
+                
+                # The master file is renamed into place last, after all files are complete
+                with atomic_output(h5f_path) as tmp_path, h5py.File(tmp_path, 'w') as hf:
+                    for i in  range(n_files):
+                        h5f_path_i = re.sub('h5$', str(i+1)+'.h5', h5f_path)
+                        with h5py.File(h5f_path_i, 'r') as hf_i:
+                            # Link all datasets of each file, e.g. 'distal_X' -> 'distal_X1'
+                            for key in hf_i.keys():
+                                hf[key+str(i+1)] = h5py.ExternalLink(h5f_path_i, key)
+                            
+                            # The layout attributes are the same for all files
+                            if i == 0:
+                                hf.attrs.update(hf_i.attrs)
+                    
+                    write_site_index(hf, test_bed, inputs_key)
+                with h5py.File(h5f_path, 'r') as hf:
+                    for key in hf.keys():
+                        print(key, hf[key].shape[0])
+                    print('hf.keys():', hf.keys(), get_h5f_info(hf)[1])
 
             
     else:
-        h5f_path = get_h5f_path(bed_file, bw_names, distal_radius, distal_order)
         single_size = int(np.ceil(len(test_bed)/float(n_files)))
         h5f_path_i = re.sub('h5$', str(i_file)+'.h5', h5f_path)
-        bed_regions = BedTool(test_bed.at(range((i_file-1)*single_size,np.min([i_file*single_size, len(test_bed)]))))
+        bed_regions = test_bed[(i_file-1)*single_size:np.min([i_file*single_size, len(test_bed)])]
         
         if distal_binsize == 1:
-            generate_h5f_singlev1(bed_regions, h5f_path_i, ref_genome, distal_radius, distal_order, bw_files, chunk_size)
+            generate_h5f_singlev1(bed_regions, h5f_path_i, ref_genome, distal_radius, distal_order, bw_files, chunk_size, h5_layout, track_dtype, h5_codec, h5_chunk_rows, n_workers)
         else:
-            generate_h5f_singlev2(bed_regions, h5f_path_i, ref_genome, distal_radius, distal_order, distal_binsize, bw_files, chunk_size)
+            generate_h5f_singlev2(bed_regions, h5f_path_i, ref_genome, distal_radius, distal_order, distal_binsize, bw_files, chunk_size, h5_codec, h5_chunk_rows, n_workers)
     
     #test_bed.at(range(single_size, bed_end))
     
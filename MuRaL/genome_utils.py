@@ -0,0 +1,591 @@
+import os
+import sys
+import gzip
+import struct
+import zlib
+from collections import OrderedDict
+
+from Bio import SeqIO
+import numpy as np
+
+from MuRaL.cache_utils import file_lock, atomic_output
+
+
+# Base codes used for encoding sequences: index of the base in BASES.
+# Bytes other than IUPAC nucleotide codes are treated as 'N'.
+BASES = 'ACGTRYMSWKBDHVN'
+N_CODE = BASES.index('N')
+
+BASE_LUT = np.full(256, N_CODE, dtype=np.int8)
+BASE_LUT[np.frombuffer(BASES.encode('ascii'), dtype=np.uint8)] = np.arange(len(BASES))
+BASE_LUT[np.frombuffer(BASES.lower().encode('ascii'), dtype=np.uint8)] = np.arange(len(BASES))
+
+# Codes of complementary bases, e.g. A->T, R(A/G)->Y(C/T), B(not A)->V(not T)
+RC_CODES = np.array([BASES.index(c) for c in 'TGCAYRKSWMVHDBN'], dtype=np.int8)
+
+# One-hot encoding (A, C, G, T) for each base code
+OHE_TABLE = np.array([[1,0,0,0], #A
+                      [0,1,0,0], #C
+                      [0,0,1,0], #G
+                      [0,0,0,1], #T
+                      [0.5,0,0.5,0], #R: A,G
+                      [0,0.5,0,0.5], #Y: C,T
+                      [0.5,0.5,0,0], #M: A,C
+                      [0,0.5,0.5,0], #S: C,G
+                      [0.5,0,0,0.5], #W: A,T
+                      [0,0,0.5,0.5], #K: G,T
+                      [0,1/3,1/3,1/3], #B: not A
+                      [1/3,0,1/3,1/3], #D: not C
+                      [1/3,1/3,0,1/3], #H: not G
+                      [1/3,1/3,1/3,0], #V: not T
+                      [0.25,0.25,0.25,0.25]], #N
+                     dtype=np.float32)
+
+# Digits (A:0, C:1, G:2, T:3, others: -1) for each base code, used for k-mers
+DIGIT_TABLE = np.array([0, 1, 2, 3] + [-1]*(len(BASES)-4), dtype=np.int8)
+
+# Upper-cased ASCII code of each byte
+UPPER_LUT = np.arange(256, dtype=np.uint8)
+UPPER_LUT[ord('a'):ord('z')+1] -= 32
+
+# Genomes are read via their FASTA index instead of being packed if the 
+# bases to be read are fewer than this fraction of the genome (see get_genome)
+SPARSE_GENOME_FRACTION = 0.01
+
+
+def encode_seq(seq):
+    """Convert a sequence (str, bytes or uint8 array) into base codes"""
+    if isinstance(seq, str):
+        seq = seq.encode('ascii')
+    if isinstance(seq, bytes):
+        seq = np.frombuffer(seq, dtype=np.uint8)
+
+    return BASE_LUT[seq]
+
+def is_minus_strand(strands):
+    """Mask of '-' strand sites; strands are '+'/'-' or int8 codes (1/-1)"""
+    strands = np.asarray(strands)
+    if strands.dtype.kind == 'i':
+        return strands < 0
+
+    return strands == '-'
+
+def merge_windows(chroms, starts, radius, max_gap=0):
+    """Merge the (2*radius+1)-bp windows of nearby sites into segments
+    
+    Args:
+        chroms: chromosome names of the sites
+        starts: 0-based positions of the sites
+        radius: radius of the windows
+        max_gap: windows separated by gaps shorter than this are also merged
+    
+    Returns (segments, offsets). 'segments' is a list of (chrom, seg_starts, 
+    seg_lens) for each run of sites on the same chromosome. If all segments
+    are concatenated into one buffer in that order, the window of site i 
+    is buffer[offsets[i]:offsets[i]+2*radius+1]. Segment starts can be 
+    negative or segments go beyond chromosome ends.
+    """
+    chroms = np.asarray(chroms)
+    starts = np.asarray(starts, dtype=np.int64)
+    n = len(starts)
+    seq_len = 2*radius + 1
+    
+    segments = []
+    offsets = np.empty(n, dtype=np.int64)
+    if n == 0:
+        return segments, offsets
+    
+    buf_len = 0
+    
+    # Sites are processed in runs of the same chromosome
+    run_starts = np.concatenate(([0], np.flatnonzero(chroms[1:] != chroms[:-1]) + 1, [n]))
+    for i, j in zip(run_starts[:-1], run_starts[1:]):
+        # Sort the sites in the run, in case the input isn't sorted
+        order = np.argsort(starts[i:j], kind='stable')
+        win_starts = starts[i:j][order] - radius
+        
+        # A new segment begins where a window is far from the previous one
+        new_seg = np.ones(j-i, dtype=bool)
+        new_seg[1:] = win_starts[1:] >= win_starts[:-1] + seq_len + max_gap
+        first = np.flatnonzero(new_seg)
+        seg_id = np.cumsum(new_seg) - 1
+        
+        seg_starts = win_starts[first]
+        seg_lens = np.append(win_starts[first[1:]-1], win_starts[-1]) + seq_len - seg_starts
+        seg_offsets = np.concatenate(([0], np.cumsum(seg_lens)[:-1]))
+        
+        offsets[i:j][order] = buf_len + seg_offsets[seg_id] + win_starts - seg_starts[seg_id]
+        
+        segments.append((chroms[i], seg_starts, seg_lens))
+        buf_len += seg_lens.sum()
+    
+    return segments, offsets
+
+def get_seq_segments(genome, chroms, starts, radius):
+    """Get base codes of merged windows around given sites
+    
+    Overlapping (2*radius+1)-bp windows of nearby sites are merged into 
+    segments (see merge_windows), so that each base is encoded only once
+    even for densely sampled sites.
+    
+    Returns (seg_codes, offsets): the codes of all segments concatenated 
+    into one int8 array, and the offset of each site's window in it, i.e.
+    the window of site i is seg_codes[offsets[i]:offsets[i]+2*radius+1].
+    Positions beyond chromosome ends are coded as 'N'.
+    """
+    segments, offsets = merge_windows(chroms, starts, radius)
+    if len(segments) == 0:
+        return np.empty(0, dtype=np.int8), offsets
+    
+    segs = []
+    for chrom, seg_starts, seg_lens in segments:
+        chrom_len = genome.chrom_len(chrom)
+        
+        # Chromosome positions of all segments in the run
+        seg_offsets = np.concatenate(([0], np.cumsum(seg_lens)[:-1]))
+        pos = np.arange(seg_lens.sum()) + np.repeat(seg_starts - seg_offsets, seg_lens)
+        
+        seg = BASE_LUT[genome.take(chrom, np.clip(pos, 0, chrom_len-1))]
+        seg[(pos < 0) | (pos >= chrom_len)] = N_CODE
+        segs.append(seg)
+    
+    return np.concatenate(segs), offsets
+
+def get_seq_codes(genome, chroms, starts, strands, radius):
+    """Get base codes of the (2*radius+1)-bp windows centered at given sites
+    
+    Args:
+        genome: GenomeStore or IndexedFasta object
+        chroms: chromosome names of the sites
+        starts: 0-based positions of the sites
+        strands: strands ('+'/'-', or int8 codes 1/-1) of the sites
+        radius: radius of the windows
+    
+    Returns an int8 array of shape (n_sites, 2*radius+1). Windows of '-' 
+    strand sites are reverse complemented; positions beyond chromosome
+    ends are coded as 'N'.
+    """
+    seg_codes, offsets = get_seq_segments(genome, chroms, starts, radius)
+    
+    # Windows are strided views of the segments; indexing makes the copy
+    windows = np.lib.stride_tricks.sliding_window_view(seg_codes, 2*radius+1)
+    codes = windows[offsets]
+    
+    # Reverse complement: flip the window and permute the codes
+    minus = is_minus_strand(strands)
+    codes[minus] = RC_CODES[codes[minus, ::-1]]
+    
+    return codes
+
+def get_seq_ohe(genome, chroms, starts, strands, radius, out=None):
+    """One-hot encode the (2*radius+1)-bp windows centered at given sites
+    
+    Same as codes_to_ohe(get_seq_codes(...)), but the merged segments are
+    one-hot encoded before the windows are taken from them, so the encoding
+    work scales with the covered genome span rather than n_sites*window.
+    Returns a float32 array of shape (n_sites, 4, 2*radius+1); 'out' can 
+    be a preallocated array of that shape.
+    """
+    seg_codes, offsets = get_seq_segments(genome, chroms, starts, radius)
+    seq_len = 2*radius + 1
+    
+    if out is None:
+        out = np.empty((len(offsets), 4, seq_len), dtype=np.float32)
+    
+    for i in range(4):
+        seg_ohe = OHE_TABLE[:, i][seg_codes]
+        windows = np.lib.stride_tricks.sliding_window_view(seg_ohe, seq_len)
+        out[:, i, :] = windows[offsets]
+    
+    # Reverse complement: flip the window and reverse the channels (A,C,G,T -> T,G,C,A)
+    minus = is_minus_strand(strands)
+    out[minus] = out[minus, ::-1, ::-1]
+    
+    return out
+
+def codes_to_ohe(codes, out=None):
+    """One-hot encode base codes of shape (n, L) into an (n, 4, L) float32 array"""
+    if out is None:
+        out = np.empty((codes.shape[0], 4, codes.shape[1]), dtype=np.float32)
+    
+    for i in range(4):
+        out[:, i, :] = OHE_TABLE[:, i][codes]
+    
+    return out
+
+def codes_to_kmers(codes, order):
+    """Convert base codes of shape (n, L) into k-mer codes of shape (n, L-order+1)
+    
+    A k-mer code is the base-4 number of the digits of its bases (e.g. 
+    'CGT' -> 1*16+2*4+3); k-mers containing non-ACGT bases are coded as -1.
+    """
+    digits = DIGIT_TABLE[codes]
+    if order == 1:
+        return digits
+    
+    # Give non-ACGT bases a digit so large that any k-mer containing one
+    # gets a code >= 4**order, so that masking is done with the dot product
+    n_kmers = 4**order
+    digits = digits.astype(np.int64)
+    digits[digits < 0] = n_kmers
+    
+    weights = 4**np.arange(order-1, -1, -1, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(digits, order, axis=1)
+    kmers = windows @ weights
+    kmers[kmers >= n_kmers] = -1
+    
+    # Use the smallest integer type for the codes
+    if n_kmers <= np.iinfo(np.int8).max:
+        return kmers.astype(np.int8)
+    elif n_kmers <= np.iinfo(np.int16).max:
+        return kmers.astype(np.int16)
+    
+    return kmers
+
+def open_fasta(ref_genome):
+    """Open a FASTA file as text, which can be gzip/bgzip-compressed"""
+    with open(ref_genome, 'rb') as fin:
+        magic = fin.read(2)
+
+    if magic == b'\x1f\x8b':
+        return gzip.open(ref_genome, 'rt')
+
+    return open(ref_genome, 'r')
+
+def has_fasta_index(ref_genome):
+    """Whether a FASTA file has an up-to-date samtools faidx index (.fai, and .gzi if bgzip-compressed)"""
+    with open(ref_genome, 'rb') as fin:
+        compressed = fin.read(2) == b'\x1f\x8b'
+
+    for index_path in [ref_genome + '.fai'] + ([ref_genome + '.gzi'] if compressed else []):
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(ref_genome):
+            return False
+
+    return True
+
+def get_genome_store_path(ref_genome):
+    """Get the path of the packed genome store for a FASTA file"""
+
+    return ref_genome + '.mural.u8'
+
+def pack_genome(ref_genome, store_path):
+    """Convert a FASTA file into a packed uint8 genome store
+
+    The store has two files: 'store_path' with upper-cased bases of all
+    chromosomes as one contiguous uint8 (ASCII) array, and 'store_path.idx'
+    with the name, offset and length of each chromosome.
+    """
+    print('Packing the reference genome:', ref_genome, '->', store_path)
+    sys.stdout.flush()
+
+    # Write to temporary files, renamed into place when complete, so that 
+    # other jobs never see a partially written store; the index file is 
+    # renamed last, and its presence marks a complete store
+    chrom_index = []
+    offset = 0
+    with atomic_output(store_path + '.idx') as tmp_idx_path:
+        with atomic_output(store_path) as tmp_path, open(tmp_path, 'wb') as fout:
+            # Parse one chromosome at a time to keep the memory usage low
+            for record in SeqIO.parse(open_fasta(ref_genome), 'fasta'):
+                seq = str(record.seq).upper().encode('ascii')
+                fout.write(seq)
+                chrom_index.append((record.id, offset, len(seq)))
+                offset += len(seq)
+
+        with open(tmp_idx_path, 'w') as fidx:
+            for chrom, chrom_offset, chrom_len in chrom_index:
+                fidx.write('{}\t{}\t{}\n'.format(chrom, chrom_offset, chrom_len))
+
+    return store_path
+
+def check_genome_store(ref_genome, store_path):
+    """Check whether the packed store of a FASTA file exists, is complete and is newer than the file"""
+
+    return os.path.exists(store_path + '.idx') and os.path.getmtime(store_path + '.idx') >= os.path.getmtime(ref_genome)
+
+def get_genome(ref_genome, n_bases=None):
+    """Get the packed genome store for a FASTA file, generating it if needed
+
+    If there is no packed store yet, jobs reading few bases (e.g. prediction
+    for a few thousand sites) read the FASTA file via its index instead, if 
+    it has one (see IndexedFasta), so that the whole genome isn't packed.
+
+    Args:
+        ref_genome: FASTA file, or a GenomeStore/IndexedFasta object
+        n_bases: number of bases to be read (e.g. n_sites*window length), 
+            if known; None for genome-wide jobs
+    """
+    if isinstance(ref_genome, (GenomeStore, IndexedFasta)):
+        return ref_genome
+
+    store_path = get_genome_store_path(ref_genome)
+
+    # Check whether the existing store is latest and complete
+    if not check_genome_store(ref_genome, store_path):
+        if n_bases is not None and has_fasta_index(ref_genome):
+            genome = IndexedFasta(ref_genome)
+            if n_bases < SPARSE_GENOME_FRACTION*genome.genome_len:
+                print('Reading the reference genome via its FASTA index:', ref_genome)
+                return genome
+
+        try:
+            # Concurrent jobs for the same genome wait for the one packing it,
+            # which may have finished while this job was waiting
+            with file_lock(store_path):
+                if not check_genome_store(ref_genome, store_path):
+                    pack_genome(ref_genome, store_path)
+        except OSError as e:
+            print('Warning: cannot write the packed genome store (', e, '), loading the genome into memory instead', file=sys.stderr)
+
+            return GenomeStore.from_fasta(ref_genome)
+
+    return GenomeStore(store_path)
+
+
+class GenomeStore:
+    """Reference genome packed as one uint8 array, accessed via np.memmap"""
+    def __init__(self, store_path):
+        """
+        Args:
+            store_path: file path of the packed genome generated by pack_genome
+        """
+        self.store_path = store_path
+
+        # chrom -> (offset, length)
+        self.chrom_index = {}
+        if store_path is not None:
+            with open(store_path + '.idx', 'r') as fidx:
+                for line in fidx:
+                    chrom, offset, length = line.rstrip('\n').split('\t')
+                    self.chrom_index[chrom] = (int(offset), int(length))
+
+        self._seq = None
+        self._chrom_seqs = {}
+
+    @classmethod
+    def from_fasta(cls, ref_genome):
+        """Load a FASTA file into an in-memory store"""
+        store = cls(None)
+        seqs = []
+        offset = 0
+        for record in SeqIO.parse(open_fasta(ref_genome), 'fasta'):
+            seq = str(record.seq).upper().encode('ascii')
+            seqs.append(seq)
+            store.chrom_index[record.id] = (offset, len(seq))
+            offset += len(seq)
+        store._seq = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+
+        return store
+
+    def __getstate__(self):
+        # Don't pickle the memmap; each process (e.g. a DataLoader worker)
+        # maps the file by itself and shares the page cache with others
+        state = self.__dict__.copy()
+        if self.store_path is not None:
+            state['_seq'] = None
+        state['_chrom_seqs'] = {}
+
+        return state
+
+    @property
+    def seq(self):
+        """The whole packed genome"""
+        if self._seq is None:
+            self._seq = np.memmap(self.store_path, dtype=np.uint8, mode='r')
+
+        return self._seq
+
+    def __contains__(self, chrom):
+        return chrom in self.chrom_index
+
+    def keys(self):
+        return self.chrom_index.keys()
+
+    def chrom_len(self, chrom):
+        """Length of a chromosome"""
+        return self.chrom_index[chrom][1]
+
+    def get_chrom(self, chrom):
+        """Get the uint8 array (a view of the store) of a chromosome"""
+        chrom_seq = self._chrom_seqs.get(chrom)
+        if chrom_seq is None:
+            offset, length = self.chrom_index[chrom]
+            chrom_seq = self._chrom_seqs[chrom] = self.seq[offset:offset+length]
+
+        return chrom_seq
+
+    def take(self, chrom, pos):
+        """Get the uint8 bases at given positions (within the chromosome) of a chromosome"""
+        return self.get_chrom(chrom)[pos]
+
+    def get_seq(self, chrom, start, stop):
+        """Get the uint8 array of [start, stop), padding 'N' beyond chromosome ends"""
+        chrom_seq = self.get_chrom(chrom)
+        chrom_len = len(chrom_seq)
+
+        if start >= 0 and stop <= chrom_len:
+            return chrom_seq[start:stop]
+
+        seq = np.full(stop - start, ord('N'), dtype=np.uint8)
+        start1 = max(start, 0)
+        stop1 = min(stop, chrom_len)
+        if stop1 > start1:
+            seq[start1-start:stop1-start] = chrom_seq[start1:stop1]
+
+        return seq
+
+    def get_str(self, chrom, start, stop):
+        """Get the sequence string of [start, stop), padding 'N' beyond chromosome ends"""
+        return self.get_seq(chrom, start, stop).tobytes().decode('ascii')
+
+
+class IndexedFasta:
+    """Reference genome read from a FASTA file via its samtools faidx index
+
+    Plain FASTA files are read in fixed-size blocks, and bgzip-compressed 
+    files by BGZF blocks located via the '.gzi' index. Only the blocks 
+    covering the requested bases are read and decoded, and decoded blocks 
+    are kept in an LRU cache, so that the windows of sparse sites are read
+    without loading or packing the whole genome. Has the same interface as
+    GenomeStore.
+    """
+    def __init__(self, fasta_path, block_size=1<<16, cache_blocks=256):
+        """
+        Args:
+            fasta_path: FASTA file indexed by 'samtools faidx' (.fai, and .gzi
+                if bgzip-compressed)
+            block_size: size (bytes) of the blocks read from plain FASTA files
+            cache_blocks: number of decoded blocks kept in the cache
+        """
+        self.fasta_path = fasta_path
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+
+        # chrom -> (length, offset, line bases, line width)
+        self.chrom_index = {}
+        with open(fasta_path + '.fai', 'r') as fidx:
+            for line in fidx:
+                fields = line.rstrip('\n').split('\t')
+                self.chrom_index[fields[0]] = tuple(int(x) for x in fields[1:5])
+
+        self.genome_len = sum(x[0] for x in self.chrom_index.values())
+
+        # Compressed and uncompressed offsets of BGZF blocks; the first block is implicit in '.gzi'
+        self.bgzf_offsets = self.bgzf_starts = None
+        with open(fasta_path, 'rb') as fin:
+            compressed = fin.read(2) == b'\x1f\x8b'
+        if compressed:
+            gzi = np.fromfile(fasta_path + '.gzi', dtype='<u8')
+            pairs = gzi[1:1+2*int(gzi[0])].reshape(-1, 2).astype(np.int64)
+            self.bgzf_offsets = np.concatenate(([0], pairs[:, 0]))
+            self.bgzf_starts = np.concatenate(([0], pairs[:, 1]))
+
+        self._fd = None
+        self._blocks = OrderedDict()
+
+    def __getstate__(self):
+        # Each process opens the file and caches blocks by itself
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        state['_blocks'] = OrderedDict()
+
+        return state
+
+    def _read_block(self, i):
+        """Read and decode block i into upper-cased uint8 bytes"""
+        # pread doesn't move a file position shared with forked processes
+        if self._fd is None:
+            self._fd = os.open(self.fasta_path, os.O_RDONLY)
+
+        if self.bgzf_starts is None:
+            data = os.pread(self._fd, self.block_size, i*self.block_size)
+        else:
+            # A BGZF block is a gzip member with its size (BSIZE-1) in the
+            # 18-byte header, followed by raw deflate data and an 8-byte footer
+            offset = int(self.bgzf_offsets[i])
+            header = os.pread(self._fd, 18, offset)
+            if header[0:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+                print('Error: the FASTA file is compressed, but not by bgzip:', self.fasta_path, file=sys.stderr)
+                sys.exit()
+
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            data = zlib.decompress(os.pread(self._fd, block_size-18-8, offset+18), -15)
+
+        return UPPER_LUT[np.frombuffer(data, dtype=np.uint8)]
+
+    def _get_block(self, i):
+        """Get decoded block i, from the LRU cache if possible"""
+        block = self._blocks.get(i)
+        if block is not None:
+            self._blocks.move_to_end(i)
+            return block
+
+        block = self._blocks[i] = self._read_block(i)
+        if len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+
+        return block
+
+    def _locate(self, file_pos):
+        """Get the blocks of (uncompressed) file positions and the offsets in the blocks"""
+        if self.bgzf_starts is None:
+            return file_pos // self.block_size, file_pos % self.block_size
+
+        blocks = np.searchsorted(self.bgzf_starts, file_pos, side='right') - 1
+
+        return blocks, file_pos - self.bgzf_starts[blocks]
+
+    def _file_pos(self, chrom, pos):
+        """Get the (uncompressed) file positions of bases of a chromosome"""
+        length, offset, line_bases, line_width = self.chrom_index[chrom]
+
+        return offset + (pos // line_bases)*line_width + pos % line_bases
+
+    def __contains__(self, chrom):
+        return chrom in self.chrom_index
+
+    def keys(self):
+        return self.chrom_index.keys()
+
+    def chrom_len(self, chrom):
+        """Length of a chromosome"""
+        return self.chrom_index[chrom][0]
+
+    def get_chrom(self, chrom):
+        """Get the uint8 array of a chromosome, which is read in whole"""
+        return self.get_seq(chrom, 0, self.chrom_len(chrom))
+
+    def take(self, chrom, pos):
+        """Get the uint8 bases at given positions (within the chromosome) of a chromosome"""
+        blocks, block_pos = self._locate(self._file_pos(chrom, np.asarray(pos, dtype=np.int64)))
+        out = np.empty(len(blocks), dtype=np.uint8)
+
+        # Positions are grouped by block, so that each block is fetched once
+        order = np.argsort(blocks, kind='stable')
+        block_ids, bounds = np.unique(blocks[order], return_index=True)
+        bounds = np.append(bounds, len(order))
+        for i, block_id in enumerate(block_ids):
+            idx = order[bounds[i]:bounds[i+1]]
+            out[idx] = self._get_block(block_id)[block_pos[idx]]
+
+        return out
+
+    def get_seq(self, chrom, start, stop):
+        """Get the uint8 array of [start, stop), padding 'N' beyond chromosome ends"""
+        seq = np.full(stop - start, ord('N'), dtype=np.uint8)
+        start1 = max(start, 0)
+        stop1 = min(stop, self.chrom_len(chrom))
+        if stop1 <= start1:
+            return seq
+
+        # Bytes of consecutive blocks, including line breaks
+        (first, last), (first_pos, last_pos) = self._locate(self._file_pos(chrom, np.array([start1, stop1-1], dtype=np.int64)))
+        data = np.concatenate([self._get_block(i)[(first_pos if i == first else 0):(last_pos+1 if i == last else None)] 
+                               for i in range(first, last+1)])
+        seq[start1-start:stop1-start] = data[(data != ord('\n')) & (data != ord('\r'))]
+
+        return seq
+
+    def get_str(self, chrom, start, stop):
+        """Get the sequence string of [start, stop), padding 'N' beyond chromosome ends"""
+        return self.get_seq(chrom, start, stop).tobytes().decode('ascii')
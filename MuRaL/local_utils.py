@@ -0,0 +1,111 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from MuRaL.cache_utils import atomic_output
+
+
+class LocalData:
+    """Local features and labels of sites, stored as compact NumPy columns
+
+    Base codes are stored as uint8, k-mer codes as uint16 (int32 for
+    k > 7), continuous features as float16 and labels as int8 (int32 for
+    larger labels, see read_bed); batches are widened to the types used
+    by the models (see get_batch).
+    """
+    def __init__(self, seq, kmers, cont, labels, seq_cols, cat_cols, cont_cols, output_col='mut_type'):
+        """
+        Args:
+            seq: base codes (0-3 for A/C/G/T) of local sequences, (n_sites, n_seq_cols)
+            kmers: k-mer codes, (n_sites, n_cat_cols); None if the categorical
+                columns are the base columns
+            cont: continuous features, (n_sites, n_cont_cols)
+            labels: labels of the sites, (n_sites,)
+            seq_cols: names of the base columns
+            cat_cols: names of the categorical columns used for training
+            cont_cols: names of the continuous columns
+            output_col: name of the label column
+        """
+        self.seq = seq
+        self.kmers = kmers
+        self.cont = cont
+        self.labels = labels
+        self.seq_cols = list(seq_cols)
+        self.cat_cols = list(cat_cols)
+        self.cont_cols = list(cont_cols)
+        self.output_col = output_col
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        """Get the data of a subset of sites; slicing returns views without copying"""
+        return LocalData(self.seq[idx], None if self.kmers is None else self.kmers[idx], self.cont[idx],
+                         self.labels[idx], self.seq_cols, self.cat_cols, self.cont_cols, self.output_col)
+
+    @property
+    def cat(self):
+        """Codes of the categorical columns"""
+        return self.seq if self.kmers is None else self.kmers
+
+    @property
+    def cat_dims(self):
+        """Biggest dimension (max code + 1) of each categorical column"""
+        return [int(x) + 1 for x in self.cat.max(axis=0)]
+
+    def get_batch(self, idxs):
+        """Get (y, cont_X, cat_X) of given sites, in the types used by the models
+
+        Returns float32 labels of shape (n, 1), float32 continuous features
+        (zeros of shape (n, 1) if there are none) and int64 categorical codes.
+        """
+        y = self.labels[idxs].astype(np.float32).reshape(-1, 1)
+        if len(self.cont_cols) > 0:
+            cont_X = self.cont[idxs].astype(np.float32)
+        else:
+            cont_X = np.zeros((len(y), 1), dtype=np.float32)
+        cat_X = self.cat[idxs].astype(np.int64)
+
+        return y, cont_X, cat_X
+
+    def to_dataframe(self, idxs=slice(None)):
+        """Get the base columns and the labels as a DataFrame, e.g. for k-mer evaluation"""
+        df = pd.DataFrame(self.seq[idxs], columns=self.seq_cols)
+        df[self.output_col] = self.labels[idxs]
+
+        return df
+
+    def save(self, path):
+        """Save the columns as .npy files in the directory 'path'"""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'seq.npy'), self.seq)
+        if self.kmers is not None:
+            np.save(os.path.join(path, 'kmers.npy'), self.kmers)
+        np.save(os.path.join(path, 'cont.npy'), self.cont)
+        np.save(os.path.join(path, 'labels.npy'), self.labels)
+
+        # Column names are written last; their presence marks complete data
+        with atomic_output(os.path.join(path, 'columns.pkl')) as tmp_path, open(tmp_path, 'wb') as fout:
+            pickle.dump({'seq_cols':self.seq_cols, 'cat_cols':self.cat_cols, 'cont_cols':self.cont_cols,
+                         'output_col':self.output_col}, fout)
+
+    @staticmethod
+    def exists(path):
+        """Check whether complete data were saved in the directory 'path'"""
+        return os.path.exists(os.path.join(path, 'columns.pkl'))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load the columns saved by save(), memory-mapped by default"""
+        with open(os.path.join(path, 'columns.pkl'), 'rb') as fin:
+            cols = pickle.load(fin)
+
+        kmers = None
+        if os.path.exists(os.path.join(path, 'kmers.npy')):
+            kmers = np.load(os.path.join(path, 'kmers.npy'), mmap_mode=mmap_mode)
+
+        return cls(np.load(os.path.join(path, 'seq.npy'), mmap_mode=mmap_mode), kmers,
+                   np.load(os.path.join(path, 'cont.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, 'labels.npy'), mmap_mode=mmap_mode), **cols)
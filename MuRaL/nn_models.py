@@ -15,6 +15,7 @@ from scipy.special import lambertw
 
 from MuRaL.nn_utils import *
 from MuRaL.evaluation import *
+from MuRaL.genome_utils import OHE_TABLE
 
 class FeedForwardNN(nn.Module):
     """Feedforward only model with local data"""
@@ -108,9 +109,82 @@ class Network0(nn.Module):
         return self.model.forward(cont_data, cat_data)
         
     
+def conv_base_codes(conv, x):
+    """Apply a 1st conv layer (BatchNorm1d + Conv1d, e.g. conv1 of Network2) to base codes
+    
+    x has base codes (see genome_utils.BASES) in channel 0 and bigWig tracks
+    in the other channels, instead of one-hot encoded bases. In eval mode, 
+    BatchNorm is folded into the conv, and the conv of a one-hot base is a
+    gather of its kernel taps; in training mode, the bases are one-hot 
+    encoded on the device for the batch statistics of BatchNorm.
+    """
+    bn, conv1d = conv[0], conv[1]
+    ohe_table = torch.as_tensor(OHE_TABLE, device=x.device)
+    codes = x[:, 0, :].long()
+    tracks = x[:, 1:, :].float()
+    
+    if bn.training:
+        return conv(torch.cat([ohe_table[codes].transpose(1, 2), tracks], dim=1))
+    
+    # Fold BatchNorm into a scale and a shift of each channel
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean*scale
+    weight = conv1d.weight
+    kernel_size = weight.shape[2]
+    padding, stride, dilation = conv1d.padding[0], conv1d.stride[0], conv1d.dilation[0]
+    
+    # Output of each base code at each kernel tap, (kernel_size, n_codes+1, out_channels); 
+    # the extra code is for the zero padding after BatchNorm
+    taps = torch.einsum('bc,ock->kbo', ohe_table*scale[0:4] + shift[0:4], weight[:, 0:4, :])
+    taps = torch.cat([taps, torch.zeros_like(taps[:, 0:1, :])], dim=1)
+    
+    codes = F.pad(codes, (padding, padding), value=len(OHE_TABLE))
+    len_out = (codes.shape[1] - dilation*(kernel_size-1) - 1)//stride + 1
+    out = sum(F.embedding(codes[:, k*dilation:k*dilation+(len_out-1)*stride+1:stride], taps[k]) for k in range(kernel_size)).transpose(1, 2)
+    
+    if tracks.shape[1] > 0:
+        out = out + F.conv1d(tracks*scale[4:, None] + shift[4:, None], weight[:, 4:, :], None, stride, padding, dilation)
+    if conv1d.bias is not None:
+        out = out + conv1d.bias[:, None]
+    
+    return out
+
+def first_conv(conv, x):
+    """Apply a 1st conv layer to distal input of one-hot encoded bases or of base codes"""
+    if x.shape[1] == conv[0].num_features:
+        return conv(x)
+    
+    return conv_base_codes(conv, x)
+
+class DistalKmerEmbedding(nn.Module):
+    """Embedding of distal k-mers, for distal_order > 1
+    
+    Distal input has the k-mer indices in channel 0 and bigWig tracks in 
+    the other channels (see preprocessing.expand_distal_kmers). Embedding 
+    the indices is equivalent to a linear layer on 4**distal_order one-hot
+    channels, without making the one-hot channels.
+    """
+    def __init__(self, distal_order, emb_dim):
+        """  
+        Args:
+            distal_order: length of the k-mers
+            emb_dim: embedding size of the k-mers
+        """
+        super(DistalKmerEmbedding, self).__init__()
+        
+        # The last index is for k-mers with non-ACGT bases
+        self.emb_layer = nn.Embedding(4**distal_order+1, emb_dim, padding_idx=4**distal_order)
+    
+    def forward(self, distal_input):
+        """Return the embeddings and the tracks, of shape (batch_size, emb_dim+n_tracks, L)"""
+        emb = self.emb_layer(distal_input[:, 0, :].long()).transpose(1, 2)
+        
+        return torch.cat([emb, distal_input[:, 1:, :]], dim=1)
+
+    
 class Network1(nn.Module):
     """The expanded-only model"""
-    def __init__(self,  in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class):
+    def __init__(self,  in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class, distal_emb_dim=8):
         """  
         Args:
             emb_dims: embedding dimensions
@@ -126,6 +200,7 @@ class Network1(nn.Module):
             distal_fc_dropout: dropout for distal fc layer
             n_class: number of classes (labels)
             emb_padding_idx: number to be used for padding in embeddings
+            distal_emb_dim: embedding size of distal k-mers, for distal_order > 1
         """
         
         super(Network1, self).__init__()
@@ -135,6 +210,13 @@ class Network1(nn.Module):
         self.kernel_size = kernel_size
         self.seq_len = distal_radius*2+1 - (distal_order-1)
         
+        # For distal_order > 1, k-mer indices are embedded instead of feeding 
+        # 4**distal_order one-hot channels to the 1st conv layers
+        self.distal_emb = None
+        if distal_order > 1:
+            self.distal_emb = DistalKmerEmbedding(distal_order, distal_emb_dim)
+            in_channels = in_channels - 4**distal_order + distal_emb_dim
+        
 
         rb1_kernel_size = 3
         rb2_kernel_size = 3
@@ -235,8 +317,11 @@ class Network1(nn.Module):
         # Input data shape: batch_size, in_channels, L_in (lenth of sequence)
         assert distal_input.shape[2] > 200, "Error: distal seq len must be >200bp"
         
+        if self.distal_emb is not None:
+            distal_input = self.distal_emb(distal_input)
+        
         distal_input0 = distal_input[:,:,(distal_input.shape[2]//2-100):(distal_input.shape[2]//2+100+1)].detach().clone()
-        distal_out = self.conv1(distal_input0) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
+        distal_out = first_conv(self.conv1, distal_input0) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
         jump_input = distal_out = self.maxpool1(distal_out)
         
         distal_out = self.RBs1(distal_out)    
@@ -257,7 +342,7 @@ class Network1(nn.Module):
         distal_out = self.distal_fc1(distal_out)
 ##############################
         # Input data shape: batch_size, in_channels, L_in (lenth of sequence)
-        distal_out2 = self.conv1_2(distal_input) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
+        distal_out2 = first_conv(self.conv1_2, distal_input) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
         jump_input2 = distal_out2 = self.maxpool1_2(distal_out2)
         
         distal_out2 = self.RBs1_2(distal_out2)    
@@ -288,7 +373,7 @@ class Network1(nn.Module):
     
 class Network2(nn.Module):
     """Combined model with FeedForward and ResNet componets"""
-    def __init__(self,  emb_dims, no_of_cont, lin_layer_sizes, emb_dropout, lin_layer_dropouts, in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class, emb_padding_idx=None):
+    def __init__(self,  emb_dims, no_of_cont, lin_layer_sizes, emb_dropout, lin_layer_dropouts, in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class, emb_padding_idx=None, distal_emb_dim=8):
         """  
         Args:
             emb_dims: embedding dimensions
@@ -304,6 +389,7 @@ class Network2(nn.Module):
             distal_fc_dropout: dropout for distal fc layer
             n_class: number of classes (labels)
             emb_padding_idx: number to be used for padding in embeddings
+            distal_emb_dim: embedding size of distal k-mers, for distal_order > 1
         """
         
         super(Network2, self).__init__()
@@ -339,6 +425,13 @@ class Network2(nn.Module):
         self.kernel_size = kernel_size
         self.seq_len = distal_radius*2+1 - (distal_order-1)
         
+        # For distal_order > 1, k-mer indices are embedded instead of feeding 
+        # 4**distal_order one-hot channels to the 1st conv layers
+        self.distal_emb = None
+        if distal_order > 1:
+            self.distal_emb = DistalKmerEmbedding(distal_order, distal_emb_dim)
+            in_channels = in_channels - 4**distal_order + distal_emb_dim
+        
 
         rb1_kernel_size = 3
         rb2_kernel_size = 3
@@ -442,7 +535,13 @@ class Network2(nn.Module):
             local_input: local input
             distal_input: distal input
         """
+        local_out = self.local_forward(local_input)
+        distal_out = sum(self.distal_forward(distal_input))/2
         
+        return self.combine_outputs(local_out, distal_out)
+    
+    def local_forward(self, local_input):
+        """Get the output logits of the local module"""
         # FeedForward layers for local input
         cont_data, cat_data = local_input
         
@@ -465,11 +564,19 @@ class Network2(nn.Module):
             local_out = bn_layer(local_out)
             local_out = dropout_layer(local_out)
         
+        return self.local_fc(local_out)
+    
+    def distal_forward(self, distal_input):
+        """Get the output probabilities of the middle-scale and large-scale distal modules"""
         assert distal_input.shape[2] > 200, "Error: distal seq len must be >200"
+        
+        if self.distal_emb is not None:
+            distal_input = self.distal_emb(distal_input)
+        
         # CNN layers for distal_input
         # Input data shape: batch_size, in_channels, L_in (lenth of sequence)
         distal_input0 = distal_input[:,:,(distal_input.shape[2]//2-100):(distal_input.shape[2]//2+100+1)].detach().clone()
-        distal_out = self.conv1(distal_input0) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
+        distal_out = first_conv(self.conv1, distal_input0) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
         jump_input = distal_out = self.maxpool1(distal_out)
         
         distal_out = self.RBs1(distal_out)    
@@ -487,11 +594,10 @@ class Network2(nn.Module):
         distal_out, _ = torch.max(distal_out, dim=2)
         
         # Separate FC layers 
-        local_out = self.local_fc(local_out)
         distal_out = self.distal_fc1(distal_out)
 ##############################
         # Input data shape: batch_size, in_channels, L_in (lenth of sequence)
-        distal_out2 = self.conv1_2(distal_input) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
+        distal_out2 = first_conv(self.conv1_2, distal_input) #output shape: batch_size, L_out; L_out = floor((L_in+2*padding-kernel_size)/stride + 1) 
         jump_input2 = distal_out2 = self.maxpool1_2(distal_out2)
         
         distal_out2 = self.RBs1_2(distal_out2)    
@@ -515,7 +621,10 @@ class Network2(nn.Module):
         
         #distal_out = torch.log((F.softmax(mid_out1, dim=1) +F.softmax(mid_out2, dim=1) + F.softmax(distal_out, dim=1))/3)
         #distal_out = torch.log((F.softmax(distal_out, dim=1)+ F.softmax(distal_out2, dim=1))/2)
-        distal_out = (F.softmax(distal_out, dim=1)+ F.softmax(distal_out2, dim=1))/2
+        return [F.softmax(distal_out, dim=1), F.softmax(distal_out2, dim=1)]
+    
+    def combine_outputs(self, local_out, distal_out):
+        """Combine local logits and distal probabilities into log probabilities"""
         local_out = F.softmax(local_out, dim=1)
         
         if self.training == False and np.random.uniform(0,1) < 0.00001*local_out.shape[0]:
@@ -526,6 +635,110 @@ class Network2(nn.Module):
         out = torch.log(torch.clamp((local_out + distal_out)/2, min=1e-9))  
         
         return out
+
+
+class DistalConvBranch(nn.Module):
+    """ResNet module for one level of binned distal data, as the large-scale module of Network2"""
+    def __init__(self, in_channels, out_channels, kernel_size, distal_fc_dropout, n_class):
+        """  
+        Args:
+            in_channels: number of input channels
+            out_channels: number of output channels after first covolution layer
+            kernel_size: kernel size of covolution layers
+            distal_fc_dropout: dropout for the fc layer
+            n_class: number of classes (labels)
+        """
+        super(DistalConvBranch, self).__init__()
+        
+        rb_kernel_size = 3
+        
+        self.conv1 = nn.Sequential(
+            nn.BatchNorm1d(in_channels),
+            nn.Conv1d(in_channels, out_channels, kernel_size, 1, (kernel_size-1)//2),
+        )
+        
+        self.maxpool1 = nn.MaxPool1d(15, 15, 7)
+        self.RBs1 = nn.Sequential(*[ResBlock(out_channels, kernel_size=rb_kernel_size, stride=1, padding=(rb_kernel_size-1)//2, dilation=1) for x in range(2)])
+        
+        self.maxpool2 = nn.MaxPool1d(7, 7, 3)
+        self.conv2 = nn.Sequential(
+            nn.BatchNorm1d(out_channels),
+            nn.Conv1d(out_channels, out_channels, kernel_size, 1, (kernel_size-1)//2),
+        )
+        self.RBs2 = nn.Sequential(*[ResBlock(out_channels, kernel_size=rb_kernel_size, stride=1, padding=(rb_kernel_size-1)//2, dilation=1) for x in range(2)])
+        
+        self.maxpool3 = nn.MaxPool1d(3, 3, 1)
+        self.conv3 = nn.Sequential(
+            nn.BatchNorm1d(out_channels),
+            nn.Conv1d(out_channels, out_channels, kernel_size, 1, (kernel_size-1)//2),
+            nn.ReLU(),
+        )
+        
+        self.fc = nn.Sequential(
+            nn.BatchNorm1d(out_channels),
+            nn.Dropout(distal_fc_dropout), 
+            nn.Linear(out_channels, n_class), 
+        )
+    
+    def forward(self, x):
+        """Get the output logits for binned distal data of shape (batch_size, in_channels, n_bins)"""
+        jump_input = out = self.maxpool1(self.conv1(x))
+        out = self.RBs1(out)
+        out = out + jump_input[:,:,0:out.shape[2]]
+        out = self.maxpool2(out)
+        
+        jump_input = out = self.conv2(out)
+        out = self.RBs2(out)
+        out = out + jump_input[:,:,0:out.shape[2]]
+        out = self.maxpool3(out)
+        
+        out = self.conv3(out)
+        out, _ = torch.max(out, dim=2)
+        
+        return self.fc(out)
+
+
+class Network3(Network2):
+    """Combined model with FeedForward and ResNet componets for multi-resolution distal data
+    
+    The distal input holds the per-base data within distal_radius, followed
+    by the binned data of each level in distal_bins (see CombinedDatasetH5);
+    each level has its own ResNet module, and the distal probabilities are
+    the average of all distal modules.
+    """
+    def __init__(self, emb_dims, no_of_cont, lin_layer_sizes, emb_dropout, lin_layer_dropouts, in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class, emb_padding_idx=None, distal_emb_dim=8, distal_bins=()):
+        """  
+        Args:
+            distal_bins: (binsize, radius) of the levels of binned distal data
+            other args: see Network2
+        """
+        super(Network3, self).__init__(emb_dims, no_of_cont, lin_layer_sizes, emb_dropout, lin_layer_dropouts, in_channels, out_channels, kernel_size, distal_radius, distal_order, distal_fc_dropout, n_class, emb_padding_idx, distal_emb_dim)
+        
+        if distal_order > 1:
+            print('Error: binned distal data are only supported for distal_order 1', file=sys.stderr)
+            sys.exit()
+        
+        self.bin_lens = [int(np.ceil((radius*2+1)/binsize)) for binsize, radius in distal_bins]
+        self.bin_branches = nn.ModuleList([DistalConvBranch(in_channels, out_channels, kernel_size, distal_fc_dropout, n_class) for x in distal_bins])
+    
+    def forward(self, local_input, distal_input):
+        """
+        Forward pass
+        
+        Args:
+            local_input: local input
+            distal_input: distal input, with the levels of binned data after the per-base data
+        """
+        local_out = self.local_forward(local_input)
+        
+        # Split the levels along the sequence dimension
+        levels = torch.split(distal_input, [self.seq_len] + self.bin_lens, dim=2)
+        distal_outs = self.distal_forward(levels[0])
+        for branch, bin_input in zip(self.bin_branches, levels[1:]):
+            distal_outs.append(F.softmax(branch(bin_input), dim=1))
+        
+        return self.combine_outputs(local_out, sum(distal_outs)/len(distal_outs))
+
     
 # Residual block (according to Jaganathan et al. 2019 Cell)
 class ResBlock(nn.Module):
@@ -675,7 +888,7 @@ class MuTransformer(nn.Module):
             distal_input: distal input
         """
         
-        x = self.conv1(distal_input) #output shape: batch_size, out_channels, L_out
+        x = first_conv(self.conv1, distal_input) #output shape: batch_size, out_channels, L_out
         x = x.permute(2, 0, 1)
         x = x * math.sqrt(self.d_model)
         x = self.pos_encoder(x)
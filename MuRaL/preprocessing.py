@@ -2,20 +2,29 @@ import os
 import sys
 
 #from janggu.data import Bioseq, Cover
-import pyBigWig
-from pybedtools import BedTool
-from Bio import SeqIO
+
+from MuRaL.genome_utils import *
+from MuRaL.local_utils import LocalData
+from MuRaL.bw_utils import BigWigReader, get_bw_quant_params
+from MuRaL.cache_utils import get_file_hash, get_file_id, get_cache_key, file_lock, atomic_output
 
 from sklearn.preprocessing import LabelEncoder
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Subset, get_worker_info
+from torch.utils.data import Sampler, SequentialSampler, RandomSampler, BatchSampler
 import pandas as pd
 import numpy as np
 import h5py
 import time
 
+try:
+    # Registers HDF5 filters such as Blosc, for writing and reading
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
 from sklearn import metrics, calibration
 from itertools import product
 
@@ -24,7 +33,22 @@ from itertools import repeat
 from multiprocessing import Pool
 import re
 import subprocess
+import mmap
+import glob
+from collections import deque
+
 
+def get_shared_array(shape, dtype):
+    """Allocate a NumPy array in anonymous shared memory
+    
+    Forked processes (e.g. DataLoader workers) map the same memory, so the
+    data are neither copied nor duplicated for each process.
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(size*dtype.itemsize, 1))
+    
+    return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
 
 def to_np(tensor):
     """Convert Tensor to numpy arrays"""
@@ -33,8 +57,16 @@ def to_np(tensor):
     else:
         return tensor.detach().numpy()
 
-def get_h5f_path(bed_file, bw_names, distal_radius, distal_order):
-    """Get the H5 file path name based on input data"""
+def get_h5f_path(bed_file, bw_names, distal_radius, distal_order, superset_radius=None, cache_key=None, cache_dir=None):
+    """Get the H5 file path name based on input data
+    
+    If superset_radius is given, smaller radii resolve to the file of
+    superset_radius, whose windows are center-cropped by the datasets.
+    The file is put in cache_dir if given, otherwise next to the BED file;
+    cache_key (see get_h5f_cache_key) is added to the file name.
+    """
+    if superset_radius is not None:
+        distal_radius = max(distal_radius, superset_radius)
     
     h5f_path = bed_file + '.distal_' + str(distal_radius)
     
@@ -44,96 +76,485 @@ def get_h5f_path(bed_file, bw_names, distal_radius, distal_order):
     if len(bw_names) > 0:
         h5f_path = h5f_path + '.' + '.'.join(list(bw_names))
     
+    if cache_dir:
+        h5f_path = os.path.join(cache_dir, os.path.basename(h5f_path))
+    
+    if cache_key:
+        h5f_path = h5f_path + '.' + cache_key
+    
     h5f_path = h5f_path + '.h5'
     
     return h5f_path
 
-def generate_h5f(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_files, h5_chunk_size, chunk_size=50000):
-    """Generate the H5 file for storing distal data"""
-    n_channels = 4**distal_order + len(bw_files)
+def get_h5f_inputs_key(ref_genome, bw_files, distal_radius, distal_order, h5_layout='compact', track_dtype='float16', distal_binsize=1):
+    """Get the key of the inputs of an H5 file of distal data other than the BED 
+    file, i.e. the identities (path, size, mtime) of the genome and bigWig files 
+    and the parameters of the distal data
     
-    write_h5f = True
-    if os.path.exists(h5f_path):
-        try:
-            with h5py.File(h5f_path, 'r') as hf:
-                bed_path = bed_regions.fn
+    Files with the same inputs key can share the rows of the same sites 
+    (see generate_h5f_incremental).
+    """
+    return get_cache_key(ref_genome=get_file_id(ref_genome), bw_files=[get_file_id(file) for file in bw_files], 
+                         distal_radius=distal_radius, distal_order=distal_order, h5_layout=h5_layout, 
+                         track_dtype=track_dtype, distal_binsize=distal_binsize, h5_version=H5_COMPACT_VERSION)
+
+def get_h5f_cache_key(bed_file, ref_genome, bw_files, distal_radius, distal_order, h5_layout='compact', track_dtype='float16', distal_binsize=1):
+    """Get the key of an H5 file of distal data, from the hash of the BED content
+    and the inputs key (see get_h5f_inputs_key); H5 files of different inputs 
+    get different keys
+    """
+    return get_cache_key(bed=get_file_hash(bed_file), 
+                         inputs=get_h5f_inputs_key(ref_genome, bw_files, distal_radius, distal_order, h5_layout, track_dtype, distal_binsize))
+
+def get_h5f_cache_path(bed_file, ref_genome, bw_files, bw_names, distal_radius, distal_order, cache_dir=None, h5_layout='compact', track_dtype='float16', distal_binsize=1):
+    """Get the content-keyed path of the H5 file of distal data (see get_h5f_path)"""
+    # Base codes are stored for all distal orders in the compact layout
+    if h5_layout == 'compact':
+        distal_order = 1
+    
+    cache_key = get_h5f_cache_key(bed_file, ref_genome, bw_files, distal_radius, distal_order, h5_layout, track_dtype, distal_binsize)
+    
+    return get_h5f_path(bed_file, bw_names, distal_radius, distal_order, cache_key=cache_key, cache_dir=cache_dir)
+
+def check_h5f(h5f_path, n_rows, n_channels):
+    """Check whether an H5 file of distal data exists and is complete
+    
+    As files are renamed into place when complete and keyed by their inputs, 
+    only the numbers of rows and channels are checked.
+    """
+    if not os.path.exists(h5f_path):
+        return False
+    
+    try:
+        with h5py.File(h5f_path, 'r') as hf:
+            _, h5_n_rows, h5_n_channels = get_h5f_info(hf)
+    except (OSError, KeyError):
+        print('Warning: re-genenerating the H5 file, because the file is empty or imcomplete:', h5f_path)
+        return False
+    
+    return h5_n_rows == n_rows and h5_n_channels == n_channels
+
+# Version of the compact H5 layout of distal data; files without the
+# 'mural_h5_version' attribute have the float32 'distal_X' layout
+H5_COMPACT_VERSION = 2
+
+def get_h5f_part_keys(hf, key):
+    """Get the names of the datasets of all parts of a file (see gen_distal_h5), e.g. ['distal_X1', 'distal_X2']"""
+    if key in hf:
+        return [key]
+    
+    return [key+str(i+1) for i in range(len(hf.keys())) if key+str(i+1) in hf]
+
+def get_h5f_info(hf):
+    """Get the layout version, number of rows and number of channels of an H5 file of distal data
+    
+    Files split into several parts (see gen_distal_h5) have one dataset
+    per part, e.g. 'distal_X1', 'distal_X2', ...; the rows of all parts 
+    are counted. Files with a 'row_index' dataset (see generate_h5f_incremental)
+    have one row per entry of the index.
+    """
+    version = hf.attrs.get('mural_h5_version', 1)
+    keys = get_h5f_part_keys(hf, 'distal_X' if version == 1 else 'distal_seq')
+    
+    n_rows = sum([hf[k].shape[0] for k in keys])
+    if 'row_index' in hf:
+        n_rows = hf['row_index'].shape[0]
+    
+    if version == 1:
+        n_channels = hf[keys[0]].shape[1] if len(keys) > 0 else 0
+    else:
+        n_channels = int(hf.attrs['n_channels'])
+    
+    return version, n_rows, n_channels
+
+# Codecs for compressing distal data in H5 files
+H5_CODECS = ['gzip', 'lzf', 'none', 'blosc']
+
+# Default number of rows in each HDF5 chunk, a multiple of the default batch
+# size, so that batches drawn by BlockShuffleSampler share chunks
+H5_CHUNK_ROWS = 256
+
+def get_h5_compression(h5_codec):
+    """Get the codec used and the compression arguments of h5py create_dataset
+    
+    'blosc' (Blosc with LZ4 and byte shuffle) requires the hdf5plugin 
+    package, also for reading; gzip is used if it is not installed.
+    """
+    if h5_codec == 'blosc':
+        if hdf5plugin is not None:
+            return h5_codec, dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        
+        print('Warning: hdf5plugin is not installed, using gzip instead of blosc for H5 files', file=sys.stderr)
+        h5_codec = 'gzip'
+    
+    if h5_codec == 'gzip':
+        return h5_codec, {'compression':'gzip', 'compression_opts':4}
+    elif h5_codec == 'lzf':
+        return h5_codec, {'compression':'lzf'}
+    elif h5_codec == 'none':
+        return h5_codec, {}
+    
+    print('Error: unknown H5 codec:', h5_codec, file=sys.stderr)
+    sys.exit()
+
+def create_distal_dataset(hf, name, shape, dtype, h5_codec='gzip', h5_chunk_size=H5_CHUNK_ROWS):
+    """Create a preallocated dataset of distal data, chunked by rows
+    
+    The codec and the number of rows in each chunk are recorded in the
+    file attributes 'h5_codec' and 'h5_chunk_rows', so that readers can
+    align their access pattern to the chunks.
+    
+    Args:
+        hf: h5py.File opened for writing
+        name: name of the dataset
+        shape: final shape of the dataset; the first dimension is rows
+        dtype: data type of the dataset
+        h5_codec: one of H5_CODECS
+        h5_chunk_size: number of rows in each HDF5 chunk
+    """
+    h5_codec, compression = get_h5_compression(h5_codec)
+    h5_chunk_size = max(min(h5_chunk_size, shape[0]), 1)
+    
+    hf.attrs['h5_codec'] = h5_codec
+    hf.attrs['h5_chunk_rows'] = h5_chunk_size
+    
+    return hf.create_dataset(name=name, shape=shape, dtype=dtype, chunks=(h5_chunk_size,)+tuple(shape[1:]), maxshape=(None,)+tuple(shape[1:]), **compression)
+
+def write_distal_compact(hf, bed_regions, ref_genome, distal_radius, bw_files, track_dtype='float16', chunk_size=50000, h5_chunk_size=H5_CHUNK_ROWS, h5_codec='gzip', suffix='', n_workers=1):
+    """Write distal data of given regions into an H5 file, in the compact layout
+    
+    The compact layout has a uint8 'distal_seq' dataset of base codes (see
+    genome_utils.BASES) of shape (n_regions, seq_len) and, with bigWig 
+    tracks, a 'distal_tracks' dataset of shape (n_regions, n_tracks, 
+    seq_len) with float16 values or uint8 codes (value = code*track_scale 
+    + track_min). Both are in the orientation of the sites, i.e. reverse 
+    complemented for '-' strand sites. See expand_distal_compact for 
+    getting the one-hot encoded distal data.
+    
+    Args:
+        hf: h5py.File opened for writing
+        track_dtype: 'float16', or 'uint8' for linearly quantized values
+        chunk_size: number of regions processed at a time
+        h5_chunk_size: number of rows in each HDF5 chunk
+        h5_codec: codec for compressing the datasets (see H5_CODECS)
+        suffix: suffix of the dataset names, e.g. for a part of a file
+        n_workers: number of processes encoding chunks (see iter_encoded_chunks)
+    """
+    n = len(bed_regions)
+    n_tracks = len(bw_files)
+    seq_len = distal_radius*2+1
+    
+    hf.attrs['mural_h5_version'] = H5_COMPACT_VERSION
+    hf.attrs['n_channels'] = 4 + n_tracks
+    hf.attrs['distal_radius'] = distal_radius
+    hf.attrs['track_dtype'] = track_dtype
+    
+    track_min = np.zeros(n_tracks, dtype=np.float32)
+    track_scale = np.ones(n_tracks, dtype=np.float32)
+    if track_dtype == 'uint8':
+        for j, file in enumerate(bw_files):
+            track_min[j], track_scale[j] = get_bw_quant_params(file)
+    hf.attrs['track_min'] = track_min
+    hf.attrs['track_scale'] = track_scale
+    
+    seq_ds = create_distal_dataset(hf, 'distal_seq'+suffix, (n, seq_len), np.uint8, h5_codec, h5_chunk_size)
+    if n_tracks > 0:
+        tracks_ds = create_distal_dataset(hf, 'distal_tracks'+suffix, (n, n_tracks, seq_len), track_dtype, h5_codec, h5_chunk_size)
+    
+    encoder = partial(encode_distal_compact, genome=get_genome(ref_genome, len(bed_regions)*(2*distal_radius+1)), bw_reader=BigWigReader(bw_files), distal_radius=distal_radius, 
+                      track_dtype=track_dtype, track_min=track_min, track_scale=track_scale)
+    
+    # Chunks are compressed and written here while next chunks are encoded
+    timings = {}
+    for start, end, (seq_codes, tracks) in iter_encoded_chunks(encoder, bed_regions, chunk_size, n_workers, timings):
+        t0 = time.time()
+        seq_ds[start:end] = seq_codes
+        if n_tracks > 0:
+            tracks_ds[start:end] = tracks
+        timings['write'] = timings.get('write', 0) + time.time() - t0
+    
+    print_stage_timings(timings)
+
+def encode_distal_compact(bed_regions, genome, bw_reader, distal_radius, track_dtype, track_min, track_scale):
+    """Encode distal data of given regions in the compact layout (see write_distal_compact)
+    
+    Returns ((seq_codes, tracks), timings); tracks is None without bigWig
+    tracks and timings has the time used for the sequences and the tracks.
+    """
+    chroms, starts, strands = get_bed_columns(bed_regions)
+    
+    t0 = time.time()
+    seq_codes = get_seq_codes(genome, chroms, starts, strands, distal_radius)
+    
+    t1 = time.time()
+    tracks = None
+    if len(bw_reader) > 0:
+        tracks = bw_reader.get_windows(chroms, starts, strands, distal_radius)
+        if track_dtype == 'uint8':
+            tracks = np.rint((tracks - track_min[:, None])/track_scale[:, None])
+        else:
+            # Same precision as the float32 layout
+            tracks = tracks.round(decimals=2)
+        tracks = tracks.astype(track_dtype)
+    
+    return (seq_codes, tracks), {'seq':t1-t0, 'bigWig':time.time()-t1}
+
+def encode_distal_ohe(bed_regions, genome, bw_reader, distal_radius, n_channels, seq_len, binsize=1, round_tracks=True):
+    """Encode distal data of given regions as float32 one-hot encoded data ('distal_X')
+    
+    Args:
+        seq_len: length of the windows (before binning)
+        binsize: windows are padded to a multiple of binsize and averaged in bins
+        round_tracks: whether to round the data to 2 decimals if there are bigWig tracks
+    
+    Returns (distal_X, timings), see encode_distal_compact.
+    """
+    t0 = time.time()
+    
+    # Extract sequence from the genome, which is in one-hot encoding format
+    seqs = np.empty((len(bed_regions), n_channels, seq_len), dtype=np.float32)
+    get_digitalized_seq_ohe(genome, bed_regions, distal_radius, out=seqs[:, 0:4, :])
+    
+    # Handle distal bigWig data, return base-wise values
+    t1 = time.time()
+    if len(bw_reader) > 0:
+        get_bw_for_bed(bw_reader, bed_regions, distal_radius, out=seqs[:, 4:, :])
+        if round_tracks:
+            seqs = seqs.round(decimals=2)
+    t2 = time.time()
+    
+    if binsize > 1:
+        pad_left = 0
+        pad_right = 0
+        if seq_len % binsize:
+            pad_len = binsize - (seq_len % binsize)
+            pad_left = pad_len//2
+            pad_right = pad_len - pad_left
+        
+        seqs = np.pad(seqs, ((0,0), (0,0), (pad_left,pad_right))).reshape(seqs.shape[0], seqs.shape[1],-1,binsize).mean(axis=3).round(decimals=2)
+    
+    return seqs, {'seq':t1-t0+time.time()-t2, 'bigWig':t2-t1}
+
+# Encoder of the worker processes of iter_encoded_chunks
+_chunk_encoder = None
+
+def _init_chunk_encoder(encoder):
+    global _chunk_encoder
+    _chunk_encoder = encoder
+
+def _encode_chunk(bed_regions):
+    return _chunk_encoder(bed_regions)
+
+def iter_encoded_chunks(encoder, bed_regions, chunk_size, n_workers=1, timings=None, max_pending=None):
+    """Encode regions chunk by chunk, pipelined with the handling of encoded chunks
+    
+    With n_workers > 1, chunks are encoded in worker processes while the 
+    caller handles (e.g. compresses and writes) earlier chunks. At most 
+    max_pending chunks (default: 2*n_workers) are being encoded or waiting,
+    which caps the memory used.
+    
+    Args:
+        encoder: function of chunk regions returning (data, timings), e.g.
+            a partial of encode_distal_compact; it is passed to the workers 
+            once, when they start
+        bed_regions: BedRegions object
+        chunk_size: number of regions in each chunk
+        n_workers: number of worker processes
+        timings: dict accumulating the time (seconds) of the encoding stages
+            (summed over workers) and of waiting for the encoded chunks
+    
+    Yields (start, end, data) of the chunks in order.
+    """
+    if timings is None:
+        timings = {}
+    
+    def add_timings(chunk_timings):
+        for key, t in chunk_timings.items():
+            timings[key] = timings.get(key, 0) + t
+    
+    n = len(bed_regions)
+    chunks = [(start, min(start+chunk_size, n)) for start in range(0, n, chunk_size)]
+    
+    if n_workers <= 1 or len(chunks) <= 1:
+        for start, end in chunks:
+            data, chunk_timings = encoder(bed_regions[start:end])
+            add_timings(chunk_timings)
+            
+            yield start, end, data
+        return
+    
+    if max_pending is None:
+        max_pending = 2*n_workers
+    
+    with Pool(min(n_workers, len(chunks)), initializer=_init_chunk_encoder, initargs=(encoder,)) as pool:
+        pending = deque()
+        for i, (start, end) in enumerate(chunks):
+            pending.append((start, end, pool.apply_async(_encode_chunk, (bed_regions[start:end],))))
+            
+            # Take the oldest chunk when the queue is full, or all chunks are submitted
+            while len(pending) >= max_pending or (i == len(chunks)-1 and len(pending) > 0):
+                chunk_start, chunk_end, result = pending.popleft()
                 
-                # Check whether the existing H5 file is latest and complete
-                #if os.path.getmtime(bed_path) < os.path.getmtime(h5f_path) and len(bed_regions) == hf["distal_X"].shape[0] and n_channels == hf["distal_X"].shape[1]:
-                # Check whether the existing H5 file (not following the link) is latest and complete
-                if os.lstat(bed_path).st_mtime < os.lstat(h5f_path).st_mtime and len(bed_regions) == hf["distal_X"].shape[0] and n_channels == hf["distal_X"].shape[1]:
-                    write_h5f = False
-        except OSError:
-            print('Warning: re-genenerating the H5 file, because the file is empty or imcomplete:', h5f_path)
+                t0 = time.time()
+                data, chunk_timings = result.get()
+                timings['wait'] = timings.get('wait', 0) + time.time() - t0
+                add_timings(chunk_timings)
+                
+                yield chunk_start, chunk_end, data
+
+def print_stage_timings(timings):
+    """Print the time used by the stages of generating distal data"""
+    print('Time used by stages (seconds; encoding is summed over workers):', 
+          ', '.join([key + ': ' + str(round(t, 2)) for key, t in timings.items()]))
+    sys.stdout.flush()
+
+def expand_distal_compact(seq_codes, tracks, track_min, track_scale, n_channels, out=None):
+    """Convert distal data in the compact layout into float32 one-hot encoded data
+    
+    Args:
+        seq_codes: uint8 base codes, (n, seq_len)
+        tracks: track values or codes, (n, n_tracks, seq_len); can be None
+            if n_channels is 4
+        track_min, track_scale: dequantization parameters of uint8 tracks
+        n_channels: number of channels to be returned (4 + number of tracks used)
+        out: preallocated array of shape (n, n_channels, seq_len)
+    
+    Returns a float32 array of shape (n, n_channels, seq_len).
+    """
+    if out is None:
+        out = np.empty((seq_codes.shape[0], n_channels, seq_codes.shape[1]), dtype=np.float32)
+    
+    codes_to_ohe(seq_codes, out=out[:, 0:4, :])
+    
+    if n_channels > 4:
+        n_tracks = n_channels - 4
+        out[:, 4:, :] = tracks[:, 0:n_tracks, :]
+        if tracks.dtype == np.uint8:
+            out[:, 4:, :] *= np.asarray(track_scale, dtype=np.float32)[0:n_tracks, None]
+            out[:, 4:, :] += np.asarray(track_min, dtype=np.float32)[0:n_tracks, None]
+    
+    return out
+
+def expand_distal_kmers(seq_codes, tracks, track_min, track_scale, n_tracks, distal_order, out=None):
+    """Convert distal base codes into k-mer indices, for distal_order > 1
+    
+    Args:
+        seq_codes: uint8 base codes, (n, seq_len)
+        tracks: track values or codes, (n, n_tracks, seq_len); can be None
+            if n_tracks is 0
+        track_min, track_scale: dequantization parameters of uint8 tracks
+        n_tracks: number of tracks to be returned
+        distal_order: length of the k-mers
+        out: preallocated array of shape (n, 1+n_tracks, seq_len-distal_order+1)
+    
+    Returns a float32 array of shape (n, 1+n_tracks, seq_len-distal_order+1):
+    channel 0 has the k-mer indices (4**distal_order for k-mers with non-ACGT
+    bases), to be embedded by the models (see nn_models.DistalKmerEmbedding),
+    and the other channels have the track values at the centers of the k-mers.
+    """
+    kmers = codes_to_kmers(seq_codes, distal_order)
+    if out is None:
+        out = np.empty((kmers.shape[0], 1+n_tracks, kmers.shape[1]), dtype=np.float32)
+    
+    out[:, 0, :] = np.where(kmers >= 0, kmers, 4**distal_order)
+    
+    if n_tracks > 0:
+        offset = (distal_order-1)//2
+        out[:, 1:, :] = tracks[:, 0:n_tracks, offset:offset+kmers.shape[1]]
+        if tracks.dtype == np.uint8:
+            out[:, 1:, :] *= np.asarray(track_scale, dtype=np.float32)[0:n_tracks, None]
+            out[:, 1:, :] += np.asarray(track_min, dtype=np.float32)[0:n_tracks, None]
+    
+    return out
+
+def expand_distal_codes(seq_codes, tracks, track_min, track_scale, n_tracks, out=None):
+    """Keep distal base codes in channel 0 followed by the tracks, for models taking base codes
+    
+    Args:
+        seq_codes: uint8 base codes, (n, seq_len)
+        tracks: track values or codes, (n, n_tracks, seq_len); can be None
+            if n_tracks is 0
+        track_min, track_scale: dequantization parameters of uint8 tracks
+        n_tracks: number of tracks to be returned
+        out: preallocated array of shape (n, 1+n_tracks, seq_len)
+    
+    Returns an array of shape (n, 1+n_tracks, seq_len), uint8 if n_tracks
+    is 0 and float32 otherwise; the first conv of the models gathers the
+    weights of the base codes (see nn_models.conv_base_codes).
+    """
+    if out is None:
+        out = np.empty((seq_codes.shape[0], 1+n_tracks, seq_codes.shape[1]), dtype=np.uint8 if n_tracks == 0 else np.float32)
+    
+    out[:, 0, :] = seq_codes
+    
+    if n_tracks > 0:
+        out[:, 1:, :] = tracks[:, 0:n_tracks, :]
+        if tracks.dtype == np.uint8:
+            out[:, 1:, :] *= np.asarray(track_scale, dtype=np.float32)[0:n_tracks, None]
+            out[:, 1:, :] += np.asarray(track_min, dtype=np.float32)[0:n_tracks, None]
+    
+    return out
+
+def generate_h5f(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_files, h5_chunk_size, chunk_size=50000, h5_layout='compact', track_dtype='float16', h5_codec='gzip', inputs_key=None, n_workers=1):
+    """Generate the H5 file for storing distal data
+    
+    h5_layout is 'compact' (uint8 base codes and float16/uint8 tracks, see
+    write_distal_compact) or 'float32' (one-hot encoded 'distal_X'). 
+    Datasets are compressed with h5_codec in chunks of h5_chunk_size rows.
+    If inputs_key is given, the site keys are also written (see write_site_index).
+    Chunks are encoded by n_workers processes (see iter_encoded_chunks).
+    """
+    n_channels = 4**distal_order + len(bw_files)
+    
+    # Check whether the existing H5 file is complete
+    write_h5f = not check_h5f(h5f_path, len(bed_regions), n_channels)
             
-    # If the H5 file is unavailable or im complete, generate the file
+    # If the H5 file is unavailable or im complete, generate the file;
+    # it is written to a temporary file, renamed when complete
     if write_h5f:            
-        with h5py.File(h5f_path, 'w') as hf:
+        with atomic_output(h5f_path) as tmp_path, h5py.File(tmp_path, 'w') as hf:
             
             print('Generating HDF5 file:', h5f_path)
             sys.stdout.flush()
             
+            if inputs_key is not None:
+                write_site_index(hf, bed_regions, inputs_key)
+            
+            if h5_layout == 'compact' and distal_order == 1:
+                write_distal_compact(hf, bed_regions, ref_genome, distal_radius, bw_files, track_dtype, chunk_size, h5_chunk_size, h5_codec, n_workers=n_workers)
+                
+                return None
+            
             # Total seq len
             seq_len =  distal_radius*2+1-(distal_order-1)
             
-            # Create distal_X dataset
-            # Note, the default dtype for create_dataset is numpy.float32
-            hf.create_dataset(name='distal_X', shape=(0, n_channels, seq_len), compression="gzip", compression_opts=4, chunks=(h5_chunk_size,n_channels, seq_len), maxshape=(None,n_channels, seq_len)) 
+            # Create distal_X dataset of the final size
+            create_distal_dataset(hf, 'distal_X', (len(bed_regions), n_channels, seq_len), np.float32, h5_codec, h5_chunk_size)
+            hf.attrs['distal_radius'] = distal_radius
             
             # Write data in chunks
             # chunk_size = 50000
-            seq_records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
-            for start in range(0, len(bed_regions), chunk_size):
-                end = min(start+chunk_size, len(bed_regions))
-                
-                # Extract sequence from the genome, which is in one-hot encoding format
-                seqs = get_digitalized_seq_ohe(seq_records, bed_regions.at(range(start, end)), distal_radius)
-                
-                # Handle distal bigWig data, return base-wise values
-                if len(bw_files) > 0:
- 
-                    bw_distal = get_bw_for_bed(bw_files, bed_regions.at(range(start, end)), distal_radius)
-
-                    # Concatenate the sequence data and the bigWig data
-                    seqs = np.concatenate((seqs, bw_distal), axis=1)       
-                # Write the numpy array into the H5 file
-                hf['distal_X'].resize((hf['distal_X'].shape[0] + seqs.shape[0]), axis = 0)
-                hf['distal_X'][-seqs.shape[0]:] = seqs
+            write_distal_ohe(hf['distal_X'], bed_regions, ref_genome, distal_radius, n_channels, seq_len, bw_files, chunk_size, round_tracks=False, n_workers=n_workers)
 
     return None
 
 
-def generate_h5fv2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size=50000, n_h5_files=1):
-    """Generate the H5 file for storing distal data"""
+def generate_h5fv2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size=50000, n_h5_files=1, h5_codec='gzip', h5_chunk_rows=H5_CHUNK_ROWS, cache_dir=None, distal_binsize=1, n_workers=4):
+    """Generate the H5 file for storing distal data, by running gen_distal_h5
+    
+    h5f_path should be the path given by get_h5f_cache_path for cache_dir
+    and distal_binsize (for binned data, see generate_h5f_singlev2). 
+    n_workers encoding processes are split among the n_h5_files files.
+    Concurrent jobs generating the same file wait for one of them (see 
+    gen_distal_h5).
+    """
+    # Base codes are stored for all distal orders; k-mers are derived when
+    # reading (see expand_distal_kmers)
+    distal_order = 1
     n_channels = 4**distal_order + len(bw_files)
     
-    write_h5f = True
-    if os.path.exists(h5f_path):
-        try:
-            with h5py.File(h5f_path, 'r') as hf:
-                bed_path = bed_regions.fn
-                
-                # Check whether the existing H5 file (not following the link) is latest and complete
-                if len(hf.keys()) ==1 \
-                and os.lstat(bed_path).st_mtime < os.lstat(h5f_path).st_mtime \
-                and len(bed_regions) == hf["distal_X"].shape[0] \
-                and n_channels == hf["distal_X"].shape[1]:
-                    write_h5f = False
-                
-                if len(hf.keys()) > 1:
-                    try:
-                        h5_sample_size = sum([hf[key].shape[0] for key in hf.keys()])
-                        
-                        if os.lstat(bed_path).st_mtime < os.lstat(h5f_path).st_mtime \
-                        and len(bed_regions) == h5_sample_size \
-                        and n_channels == hf["distal_X1"].shape[1]:
-                            write_h5f = False
-                    except KeyError:
-                        print('Warning: re-genenerating the H5 file, because the file is empty or imcomplete:', h5f_path)
-                                       
-        except OSError:
-            print('Warning: re-genenerating the H5 file, because the file is empty or imcomplete:', h5f_path)
-
+    # Check whether the existing H5 file (compact or float32 layout) is complete
+    write_h5f = not check_h5f(h5f_path, len(bed_regions), n_channels)
             
     # If the H5 file is unavailable or im complete, generate the file
     if write_h5f:            
@@ -146,63 +567,62 @@ def generate_h5fv2(bed_regions, h5f_path, ref_genome, distal_radius, distal_orde
                  '--distal_radius', str(distal_radius), 
                  '--distal_order', str(distal_order), 
                  '--n_files', str(n_h5_files), 
-                 '--chunk_size', str(chunk_size)]
+                 '--chunk_size', str(chunk_size),
+                 '--h5_codec', h5_codec,
+                 '--h5_chunk_rows', str(h5_chunk_rows),
+                 '--distal_binsize', str(distal_binsize),
+                 '--n_workers', str(n_workers)]
         if bw_paths != None:
             args.append('--bw_paths')
             args.append(bw_paths)
+        if cache_dir:
+            args.append('--cache_dir')
+            args.append(cache_dir)
         p = subprocess.Popen(args)
         p.wait()
+        
+        if not check_h5f(h5f_path, len(bed_regions), n_channels):
+            print('Error: failed to generate the H5 file:', h5f_path, file=sys.stderr)
+            sys.exit()
             
     return None
 
 
 
-def generate_h5f_singlev1(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_files, chunk_size):
+def generate_h5f_singlev1(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_files, chunk_size, h5_layout='compact', track_dtype='float16', h5_codec='gzip', h5_chunk_size=H5_CHUNK_ROWS, n_workers=1):
     """generate an HDF file for specific regions"""
     #bed_regions = BedTool(bed_file)
     n_channels = 4**distal_order + len(bw_files)
     
-    with h5py.File(h5f_path, 'w') as hf:
+    with atomic_output(h5f_path) as tmp_path, h5py.File(tmp_path, 'w') as hf:
 
         print('Generating HDF5 file:', h5f_path)
         sys.stdout.flush()
+        
+        if h5_layout == 'compact' and distal_order == 1:
+            write_distal_compact(hf, bed_regions, ref_genome, distal_radius, bw_files, track_dtype, chunk_size, h5_chunk_size, h5_codec, n_workers=n_workers)
+            
+            return h5f_path
 
         # Total seq len
         seq_len =  distal_radius*2+1-(distal_order-1)
 
-        # Create distal_X dataset
-        # Note, the default dtype for create_dataset is numpy.float32
-        hf.create_dataset(name='distal_X', shape=(0, n_channels, seq_len), compression="gzip", compression_opts=4, chunks=(1,n_channels, seq_len), maxshape=(None,n_channels, seq_len)) 
+        # Create distal_X dataset of the final size
+        create_distal_dataset(hf, 'distal_X', (len(bed_regions), n_channels, seq_len), np.float32, h5_codec, h5_chunk_size)
+        hf.attrs['distal_radius'] = distal_radius
 
         # Write data in chunks
         #chunk_size = 50000
-        
-        seq_records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
-        for start in range(0, len(bed_regions), chunk_size):
-            end = min(start+chunk_size, len(bed_regions))
-
-            # Extract sequence from the genome, which is in one-hot encoding format
-            seqs = get_digitalized_seq_ohe(seq_records, bed_regions.at(range(start, end)), distal_radius)
-            
-            # Handle distal bigWig data, return base-wise values
-            if len(bw_files) > 0:
-                bw_distal = get_bw_for_bed(bw_files, bed_regions.at(range(start, end)), distal_radius)
-
-                # Concatenate the sequence data and the bigWig data
-                #seqs = np.concatenate((seqs, bw_distal), axis=1)
-                seqs = np.concatenate((seqs, bw_distal), axis=1).round(decimals=2)       
-            # Write the numpy array into the H5 file
-            hf['distal_X'].resize((hf['distal_X'].shape[0] + seqs.shape[0]), axis = 0)
-            hf['distal_X'][-seqs.shape[0]:] = seqs
+        write_distal_ohe(hf['distal_X'], bed_regions, ref_genome, distal_radius, n_channels, seq_len, bw_files, chunk_size, n_workers=n_workers)
     
     return h5f_path
 
-def generate_h5f_singlev2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, binsize, bw_files, chunk_size):
+def generate_h5f_singlev2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, binsize, bw_files, chunk_size, h5_codec='gzip', h5_chunk_size=H5_CHUNK_ROWS, n_workers=1):
     
     #bed_regions = BedTool(bed_file)
     n_channels = 4**distal_order + len(bw_files)
     
-    with h5py.File(h5f_path, 'w') as hf:
+    with atomic_output(h5f_path) as tmp_path, h5py.File(tmp_path, 'w') as hf:
 
         print('Generating HDF5 file:', h5f_path)
         sys.stdout.flush()
@@ -210,282 +630,295 @@ def generate_h5f_singlev2(bed_regions, h5f_path, ref_genome, distal_radius, dist
         # Total seq len
         seq_len_orig =  distal_radius*2+1-(distal_order-1)
         seq_len = int(np.ceil(seq_len_orig/binsize))
-        pad_left = 0
-        pad_right = 0
-        if seq_len_orig % binsize:
-            pad_len = binsize - (seq_len_orig % binsize)
-            pad_left = pad_len//2
-            pad_right = pad_len - pad_left
 
-        # Create distal_X dataset
-        # Note, the default dtype for create_dataset is numpy.float32
-        hf.create_dataset(name='distal_X', shape=(0, n_channels, seq_len), compression="gzip", compression_opts=4, chunks=(1,n_channels, seq_len), maxshape=(None,n_channels, seq_len)) 
+        # Create distal_X dataset of the final size
+        create_distal_dataset(hf, 'distal_X', (len(bed_regions), n_channels, seq_len), np.float32, h5_codec, h5_chunk_size)
 
-        # Write data in chunks
+        # Write data in chunks, binned by the workers
         #chunk_size = 50000
-        
-        seq_records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
-        for start in range(0, len(bed_regions), chunk_size):
-            end = min(start+chunk_size, len(bed_regions))
+        write_distal_ohe(hf['distal_X'], bed_regions, ref_genome, distal_radius, n_channels, seq_len_orig, bw_files, chunk_size, binsize, n_workers=n_workers)
+    
+    return h5f_path
 
-            # Extract sequence from the genome, which is in one-hot encoding format
-            seqs = get_digitalized_seq_ohe(seq_records, bed_regions.at(range(start, end)), distal_radius)
-            
-            # Handle distal bigWig data, return base-wise values
-            if len(bw_files) > 0:
-                bw_distal = get_bw_for_bed(bw_files, bed_regions.at(range(start, end)), distal_radius)
+def write_distal_ohe(ds, bed_regions, ref_genome, distal_radius, n_channels, seq_len, bw_files, chunk_size, binsize=1, round_tracks=True, n_workers=1):
+    """Write one-hot encoded distal data of given regions into the dataset ds (see encode_distal_ohe)"""
+    encoder = partial(encode_distal_ohe, genome=get_genome(ref_genome, len(bed_regions)*(2*distal_radius+1)), bw_reader=BigWigReader(bw_files), distal_radius=distal_radius, 
+                      n_channels=n_channels, seq_len=seq_len, binsize=binsize, round_tracks=round_tracks)
+    
+    # Chunks are compressed and written here while next chunks are encoded
+    timings = {}
+    for start, end, seqs in iter_encoded_chunks(encoder, bed_regions, chunk_size, n_workers, timings):
+        t0 = time.time()
+        ds[start:end] = seqs
+        timings['write'] = timings.get('write', 0) + time.time() - t0
+    
+    print_stage_timings(timings)
 
-                # Concatenate the sequence data and the bigWig data
-                #seqs = np.concatenate((seqs, bw_distal), axis=1)
-                seqs = np.concatenate((seqs, bw_distal), axis=1).round(decimals=2)        
-            
-            ######
-            #print('seqs[0]:', seqs[0])
-            #print('seqs before: ', seqs.shape)
-            seqs = np.pad(seqs, ((0,0), (0,0), (pad_left,pad_right))).reshape(seqs.shape[0], seqs.shape[1],-1,binsize).mean(axis=3).round(decimals=2)
-            #print('seqs after: ', seqs.shape)
-            #print('seqs[0]:', seqs[0])
-            
-            assert seqs.shape[2] == seq_len
-            ######
-            # Write the numpy array into the H5 file
-            hf['distal_X'].resize((hf['distal_X'].shape[0] + seqs.shape[0]), axis = 0)
-            hf['distal_X'][-seqs.shape[0]:] = seqs
+def get_site_keys(bed_regions):
+    """Get the keys (chrom, start, end, strand) of the sites of BED regions, as a structured array"""
+    chroms = bed_regions.chroms.astype('S')
     
-    return h5f_path
+    keys = np.empty(len(bed_regions), dtype=[('chrom', chroms.dtype), ('start', np.int64), ('end', np.int64), ('strand', np.int8)])
+    keys['chrom'] = chroms
+    keys['start'] = bed_regions.starts
+    keys['end'] = bed_regions.ends
+    keys['strand'] = bed_regions.strands
+    
+    return keys
 
+def write_site_index(hf, bed_regions, inputs_key, row_index=None):
+    """Write the site keys of the rows of an H5 file of distal data
+    
+    The 'site_keys' dataset and the 'inputs_key' attribute (see 
+    get_h5f_inputs_key) allow later files to reuse the rows of the same 
+    sites. row_index maps the sites to the rows of all parts of the file
+    (see generate_h5f_incremental).
+    """
+    hf.attrs['inputs_key'] = inputs_key
+    hf.create_dataset('site_keys', data=get_site_keys(bed_regions), compression='gzip')
+    
+    if row_index is not None:
+        hf.create_dataset('row_index', data=row_index, compression='gzip')
 
-def get_digitalized_seq(ref_genome, bed_regions, radius, order):
-    seq_records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
-
-    digit_encoder = {'A':0,'C':1,'G':2,'T':3,
-               'R':-1, #A,G
-               'Y':-1, #C,T
-               'M':-1, #A,C
-               'S':-1, #C,G
-               'W':-1, #A,T
-               'K':-1, #G,T
-               'B':-1, #not A
-               'D':-1, #not C
-               'H':-1, #not G
-               'V':-1, #not T
-               'N':-1}
-
-    digit_encoder_rc = {'A':3, 'C':2, 'G':1, 'T':0,
-               'R':-1, #A,G
-               'Y':-1, #C,T
-               'M':-1, #A,C
-               'S':-1, #C,G
-               'W':-1, #A,T
-               'K':-1, #G,T
-               'B':-1, #not A
-               'D':-1, #not C
-               'H':-1, #not G
-               'V':-1, #not T
-               'N':-1}
-
-    #self.records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
-
-    digit_seqs = []
-    for region in bed_regions:
-        chrom, start, stop, strand = str(region.chrom), region.start, region.stop, region.strand
-
-        #long_seq_record = self.records[chrom]
-
-        long_seq = str(seq_records[chrom].seq)
-        long_seq_len = len(long_seq)
-
-        start1 = np.max([int(start)-radius, 0])
-        stop1 = np.min([int(stop)+radius, long_seq_len])
-        short_seq = long_seq[start1:stop1].upper()
-
-        seq_len = 2*radius + 1 
-
-        if(len(short_seq) < seq_len):
-            #print('warning:', chrom, start1, stop1, long_seq_len)
-            if start1 == 0:
-                short_seq = (seq_len - len(short_seq))*'N' + short_seq
-                #print(short_seq)
-            else:
-                short_seq = short_seq + (seq_len - len(short_seq))*'N'
-                #print(short_seq)
-        #a = np.concatenate([digit_encoder[c] for c in short_seq], axis=1)
-        if strand == '+':
-            digit_seq = np.array([digit_encoder[c] for c in short_seq])
-        else:
-            #a = [digit_encoder_rc[c] for c in short_seq[::-1]]
-            #a.reverse()
-            digit_seq = np.array([digit_encoder_rc[c] for c in short_seq[::-1]])
-            
-        if order > 1:
-            new_seq = []
-            for i in range(seq_len - order +1):
-                kmer = digit_seq[i:i+order]
-                if min(kmer) < 0:
-                    new_seq.append(-1)
+def find_h5f_base(h5f_path, inputs_key):
+    """Find the latest H5 file of an earlier version of the same BED file, with the same inputs key
+    
+    Candidates are the files named as h5f_path with other cache keys (see 
+    get_h5f_path), e.g. generated before sites were added to the BED file.
+    """
+    key_pattern = r'\.[0-9a-f]{16}\.h5'
+    match = re.search(key_pattern+'$', h5f_path)
+    if match is None:
+        return None
+    
+    candidates = []
+    for path in glob.glob(glob.escape(h5f_path[:match.start()]) + '.*.h5'):
+        # Parts of split files ('*.1.h5', ...) are not candidates
+        if path == h5f_path or not re.fullmatch(key_pattern, path[match.start():]):
+            continue
+        try:
+            with h5py.File(path, 'r') as hf:
+                if hf.attrs.get('inputs_key') == inputs_key and 'site_keys' in hf:
+                    candidates.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+    
+    return max(candidates)[1] if len(candidates) > 0 else None
+
+def generate_h5f_incremental(bed_regions, h5f_path, base_h5f_path, ref_genome, bw_files, inputs_key, chunk_size=50000, min_reuse=0.5, n_workers=1):
+    """Generate the H5 file of distal data by reusing the rows of an existing H5 file
+    
+    The sites of bed_regions are matched against the site keys of the base
+    file (see write_site_index). The new file links the datasets of the
+    base file, adds a part with the data of new sites only, and has a 
+    'row_index' dataset mapping the sites to the rows of all parts, in the
+    order of bed_regions. The base file (and its parts) must be kept.
+    
+    Only the compact layout is supported. 
+    
+    Args:
+        base_h5f_path: the existing H5 file; if None, it is searched by find_h5f_base
+        inputs_key: inputs key of the new file (see get_h5f_inputs_key)
+        min_reuse: minimum fraction of sites in the base file for reusing it
+        n_workers: number of processes encoding the new sites
+    
+    Returns True if the file was generated, or False if no suitable base file
+    was found and the file should be generated from scratch.
+    """
+    if base_h5f_path is None:
+        base_h5f_path = find_h5f_base(h5f_path, inputs_key)
+        if base_h5f_path is None:
+            return False
+    
+    with h5py.File(base_h5f_path, 'r') as base_hf:
+        if base_hf.attrs.get('inputs_key') != inputs_key or 'site_keys' not in base_hf or get_h5f_info(base_hf)[0] == 1:
+            print('Warning: the H5 file does not match the inputs, ignored:', base_h5f_path)
+            return False
+        
+        # Datasets of the parts of the base file, resolved to the files storing them
+        suffixes = [''] if 'distal_seq' in base_hf else [str(i+1) for i in range(len(base_hf.keys())) if 'distal_seq'+str(i+1) in base_hf]
+        parts = []
+        for suffix in suffixes:
+            part = {}
+            for key in ['distal_seq', 'distal_tracks']:
+                if key+suffix not in base_hf:
+                    continue
+                link = base_hf.get(key+suffix, getlink=True)
+                if isinstance(link, h5py.ExternalLink):
+                    part[key] = h5py.ExternalLink(link.filename, link.path)
                 else:
-                    digit = sum([kmer[d]*4**(order-d-1) for d in range(order)])
-                    new_seq.append(digit)
-            
-            digit_seq = np.array(new_seq)
+                    part[key] = h5py.ExternalLink(os.path.abspath(base_h5f_path), key+suffix)
+            parts.append(part)
         
-        if len(digit_seq) != seq_len - order +1:
-            print('digit_seq.shape:', digit_seq.shape, chrom, start, stop)
-            print('short_seq:', short_seq)
-        digit_seqs.append(digit_seq)
+        n_base_rows = sum([base_hf['distal_seq'+suffix].shape[0] for suffix in suffixes])
+        base_rows = base_hf['row_index'][:] if 'row_index' in base_hf else np.arange(n_base_rows)
+        base_keys = pd.DataFrame(base_hf['site_keys'][:])
+        base_attrs = dict(base_hf.attrs)
+    
+    # Match the sites against the sites in the base file
+    key_cols = list(base_keys.columns)
+    base_keys['row'] = base_rows
+    base_keys = base_keys.drop_duplicates(subset=key_cols)
+    
+    row_index = pd.DataFrame(get_site_keys(bed_regions)).merge(base_keys, how='left', on=key_cols)['row'].to_numpy(dtype=np.float64, copy=True)
+    is_new = np.isnan(row_index)
+    n_new = int(is_new.sum())
+    
+    if len(bed_regions) - n_new < min_reuse*len(bed_regions):
+        print('Too few sites in the H5 file for reusing it:', base_h5f_path)
+        return False
     
-    digit_seqs = np.array(digit_seqs, dtype=np.int32)
+    row_index[is_new] = n_base_rows + np.arange(n_new)
+    row_index = row_index.astype(np.int64)
     
-    return digit_seqs
+    with atomic_output(h5f_path) as tmp_path, h5py.File(tmp_path, 'w') as hf:
+        print('Generating HDF5 file:', h5f_path)
+        print('Reusing {} sites in {}; new sites: {}'.format(len(bed_regions)-n_new, base_h5f_path, n_new))
+        sys.stdout.flush()
+        
+        hf.attrs.update(base_attrs)
+        
+        # Parts of the base file are linked, e.g. 'distal_seq' -> 'distal_seq1'
+        for i, part in enumerate(parts):
+            for key, link in part.items():
+                hf[key+str(i+1)] = link
+        
+        # Only the new sites are read from the genome and the bigWig files
+        if n_new > 0:
+            write_distal_compact(hf, bed_regions[np.flatnonzero(is_new)], ref_genome, int(base_attrs['distal_radius']), bw_files, 
+                                 base_attrs['track_dtype'], chunk_size, int(base_attrs['h5_chunk_rows']), base_attrs['h5_codec'], suffix=str(len(parts)+1), n_workers=n_workers)
+        
+        write_site_index(hf, bed_regions, inputs_key, row_index)
+    
+    return True
 
-def get_mean_bw_for_bed(bw_files, bw_names, bed_regions, radius):
+def get_bed_columns(bed_regions):
+    """Get chromosomes, start positions and strands of BED regions as NumPy arrays"""
+    return bed_regions.chroms, bed_regions.starts, bed_regions.strands
 
-    bw_fh = []
-    for file in bw_files:
-        bw_fh.append(pyBigWig.open(file))
+def get_digitalized_seq(ref_genome, bed_regions, radius, order):
+    """Get k-mer codes of the (2*radius+1)-bp sequences of given regions
     
-    bw_data = np.zeros((len(bed_regions), len(bw_fh)), dtype=float)
+    Returns an array of shape (n_regions, 2*radius+1-(order-1)); k-mers 
+    with non-ACGT bases are coded as -1.
+    """
+    genome = get_genome(ref_genome, len(bed_regions)*(2*radius+1))
+    chroms, starts, strands = get_bed_columns(bed_regions)
     
-    if len(bw_fh) > 0:
-        
-        for i, region in enumerate(bed_regions):
-            chrom, start, stop = str(region.chrom), region.start, region.stop
-            #bw_values = []
-            #seq_len = [bw.chroms(chrom) for bw in bw_fh]
-            
-            for j, bw in enumerate(bw_fh):
-                            
-                start1 = max([int(start)-radius, 0])
-                stop1 = min([int(stop)+radius, bw.chroms(chrom)])
-                bw_data[i,j] = np.nan_to_num(bw.values(chrom, start1, stop1, numpy=True)).mean()
-                
+    codes = get_seq_codes(genome, chroms, starts, strands, radius)
+    
+    return codes_to_kmers(codes, order)
 
-        bw_data = pd.DataFrame(bw_data, columns=bw_names)
+def get_mean_bw_for_bed(bw_files, bw_names, bed_regions, radius):
+    """Get mean bigWig track values of the expanded windows of given regions
+    
+    Args:
+        bw_files: file paths of bigWig tracks, or a BigWigReader
+        bw_names: names of the tracks
+        bed_regions: BedRegions object
+        radius: radius of the windows
+    """
+    bw_reader = bw_files if isinstance(bw_files, BigWigReader) else BigWigReader(bw_files)
+    
+    bw_data = np.zeros((len(bed_regions), len(bw_reader)), dtype=float)
+    
+    if len(bw_reader) > 0:
+        chroms, starts, strands = get_bed_columns(bed_regions)
+        bw_data = pd.DataFrame(bw_reader.get_means(chroms, starts, radius), columns=bw_names)
     
     return bw_data
 
-def get_digitalized_seq_ohe(seq_records, bed_regions, distal_radius):
-
-    one_hot_encoder = {'A':np.array([[1,0,0,0]], dtype=np.float32).T,
-               'C':np.array([[0,1,0,0]], dtype=np.float32).T,
-               'G':np.array([[0,0,1,0]], dtype=np.float32).T,
-               'T':np.array([[0,0,0,1]], dtype=np.float32).T,
-               'R':np.array([[0.5,0,0.5,0]], dtype=np.float32).T, #A,G
-               'Y':np.array([[0,0.5,0,0.5]], dtype=np.float32).T, #C,T
-               'M':np.array([[0.5,0.5,0,0]], dtype=np.float32).T, #A,C
-               'S':np.array([[0,0.5,0.5,0]], dtype=np.float32).T, #C,G
-               'W':np.array([[0.5,0,0,0.5]], dtype=np.float32).T, #A,T
-               'K':np.array([[0,0,0.5,0.5]], dtype=np.float32).T, #G,T
-               'B':np.array([[0,1/3,1/3,1/3]], dtype=np.float32).T, #not A
-               'D':np.array([[1/3,0,1/3,1/3]], dtype=np.float32).T, #not C
-               'H':np.array([[1/3,1/3,0,1/3]], dtype=np.float32).T, #not G
-               'V':np.array([[1/3,1/3,1/3,0]], dtype=np.float32).T, #not T
-               'N':np.array([[0.25,0.25,0.25,0.25]], dtype=np.float32).T}
-
-    one_hot_encoder_rc = {'A':np.array([[0,0,0,1]], dtype=np.float32).T,
-               'C':np.array([[0,0,1,0]], dtype=np.float32).T,
-               'G':np.array([[0,1,0,0]], dtype=np.float32).T,
-               'T':np.array([[1,0,0,0]], dtype=np.float32).T,
-               'R':np.array([[0,0.5,0,0.5]], dtype=np.float32).T, #A,G
-               'Y':np.array([[0.5,0,0.5,0]], dtype=np.float32).T, #C,T
-               'M':np.array([[0,0,0.5,0.5]], dtype=np.float32).T, #A,C
-               'S':np.array([[0,0.5,0.5,0]], dtype=np.float32).T, #C,G
-               'W':np.array([[0.5,0,0,0.5]], dtype=np.float32).T, #A,T
-               'K':np.array([[0.5,0.5,0,0]], dtype=np.float32).T, #G,T
-               'B':np.array([[1/3,1/3,1/3,0]], dtype=np.float32).T, #not A
-               'D':np.array([[1/3,1/3,0,1/3]], dtype=np.float32).T, #not C
-               'H':np.array([[1/3,0,1/3,1/3]], dtype=np.float32).T, #not G
-               'V':np.array([[0,1/3,1/3,1/3]], dtype=np.float32).T, #not T
-               'N':np.array([[0.25,0.25,0.25,0.25]], dtype=np.float32).T}
-
-    #self.records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
-
-    distal_seqs = []
-    for region in bed_regions:
-        chrom, start, stop, strand = str(region.chrom), region.start, region.stop, region.strand
-
-        #long_seq_record = self.records[chrom]
-
-        long_seq = str(seq_records[chrom].seq)
-        long_seq_len = len(long_seq)
-
-        start1 = np.max([int(start)-distal_radius, 0])
-        stop1 = np.min([int(stop)+distal_radius, long_seq_len])
-        short_seq = long_seq[start1:stop1].upper()
-
-        seq_len = 2*distal_radius + 1 
-
-        if(len(short_seq) < seq_len):
-            #print('warning:', chrom, start1, stop1, long_seq_len)
-            if start1 == 0:
-                short_seq = (seq_len - len(short_seq))*'N' + short_seq
-                #print(short_seq)
-            else:
-                short_seq = short_seq + (seq_len - len(short_seq))*'N'
-                #print(short_seq)
-        #a = np.concatenate([one_hot_encoder[c] for c in short_seq], axis=1)
-        if strand == '+':
-            distal_seq = np.concatenate([one_hot_encoder[c] for c in short_seq], axis=1)
-        else:
-            #a = [one_hot_encoder_rc[c] for c in short_seq[::-1]]
-            #a.reverse()
-            distal_seq = np.concatenate([one_hot_encoder_rc[c] for c in short_seq[::-1]], axis=1)
-        if distal_seq.shape[1] != seq_len:
-            print('distal_seq.shape:', distal_seq.shape, chrom, start, stop)
-            print('short_seq:', short_seq)
-        distal_seqs.append(distal_seq)
+def get_digitalized_seq_ohe(genome, bed_regions, distal_radius, out=None):
+    """One-hot encode the expanded sequences of given regions
     
-    distal_seqs = np.array(distal_seqs)
+    Returns a float32 array of shape (n_regions, 4, 2*distal_radius+1); 
+    'out' can be a preallocated array of that shape.
+    """
+    chroms, starts, strands = get_bed_columns(bed_regions)
     
-    return distal_seqs
+    # Encode all windows in the chunk at once
+    return get_seq_ohe(genome, chroms, starts, strands, distal_radius, out)
     
 
-def get_bw_for_bed(bw_files, bed_regions, radius):
-
-    bw_fh = []
-    for file in bw_files:
-        bw_fh.append(pyBigWig.open(file))
+def get_bw_for_bed(bw_files, bed_regions, radius, out=None):
+    """Get bigWig track values of the expanded windows of given regions
+    
+    Args:
+        bw_files: file paths of bigWig tracks, or a BigWigReader
+        bed_regions: BedRegions object
+        radius: radius of the windows
+        out: preallocated array of shape (n_regions, n_tracks, 2*radius+1)
+    
+    Tracks are read block-wise for all regions at once (see BigWigReader).
+    """
+    bw_reader = bw_files if isinstance(bw_files, BigWigReader) else BigWigReader(bw_files)
     
     bw_data = []
     
-    seq_len = radius*2+1
+    if len(bw_reader) > 0:
+        chroms, starts, strands = get_bed_columns(bed_regions)
+        bw_data = bw_reader.get_windows(chroms, starts, strands, radius, out)
     
-    if len(bw_fh) > 0:
-        
-        for i, region in enumerate(bed_regions):
-            chrom, start, stop, strand = str(region.chrom), region.start, region.stop, region.strand
-            #bw_values = []
-            #seq_len = [bw.chroms(chrom) for bw in bw_fh]
-            
-            bw_list = []
-            for j, bw in enumerate(bw_fh):
-                            
-                start1 = max([int(start)-radius, 0])
-                stop1 = min([int(stop)+radius, bw.chroms(chrom)])
-                
-                bw_values = np.nan_to_num(bw.values(chrom, start1, stop1, numpy=True))
-                if(len(bw_values) < seq_len):
-                    if start1 == 0:
-                        bw_values = np.concatenate([(seq_len - len(bw_values))*[0], bw_values])
-                    else:
-                        bw_values = np.concatenate([bw_values, (seq_len - len(bw_values))*[0]])
-                
-                if strand == '-':
-                    bw_values = np.flip(bw_values)
-                
-                bw_list.append(bw_values)
-            
-            bw_data.append(bw_list)     
+    return bw_data
 
-        bw_data = np.array(bw_data).astype(np.float32)
+def get_local_data_path(bed_file, ref_genome, bw_files, local_radius, local_order, seq_only, cache_dir=None):
+    """Get the content-keyed path of the directory of local data columns (see LocalData.save)
     
-    return bw_data
+    The directory is put in cache_dir if given, otherwise next to the BED file.
+    """
+    cache_key = get_cache_key(bed=get_file_hash(bed_file), ref_genome=get_file_id(ref_genome), 
+                              bw_files=[] if seq_only else [get_file_id(file) for file in bw_files], 
+                              local_radius=local_radius, local_order=local_order)
+    
+    local_path = bed_file + '.local_' + str(local_radius) + '_' + str(local_order)
+    if cache_dir:
+        local_path = os.path.join(cache_dir, os.path.basename(local_path))
+    
+    return local_path + '.' + cache_key
 
-def prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only):
-    """Prepare local data for given regions"""
+def prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only, local_seq_codes=None, cache=False, cache_dir=None):
+    """Prepare local data for given regions
     
-    # Read the seq data
-    local_seq_cat = get_digitalized_seq(ref_genome, bed_regions, local_radius, order=1)    
+    Returns a LocalData object with compact columns of the local bases, 
+    k-mers (if local_order > 1), bigWig features and labels. 
+    
+    local_seq_codes can be the base codes of the regions (see get_seq_codes)
+    extracted at a radius >= local_radius, e.g. the largest radius to be 
+    used; their center is then used instead of reading the genome again.
+    
+    With cache, the columns of regions read from a BED file are saved once
+    (see get_local_data_path) and later runs load them memory-mapped.
+    """
+    if cache and bed_regions.fn:
+        local_path = get_local_data_path(bed_regions.fn, ref_genome, bw_files, local_radius, local_order, seq_only, cache_dir)
+        
+        # Concurrent jobs for the same data wait for the one saving it
+        with file_lock(local_path):
+            if LocalData.exists(local_path):
+                print('Using the existing local data:', local_path)
+            else:
+                build_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only, local_seq_codes).save(local_path)
+        
+        return LocalData.load(local_path, mmap_mode='r')
+    
+    return build_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only, local_seq_codes)
+
+def build_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only, local_seq_codes=None):
+    """Build the local data of given regions in memory (see prepare_local_data)"""
+    chroms, starts, strands = get_bed_columns(bed_regions)
+    
+    # Read the seq data; the base codes are extracted once for all k-mer orders
+    if local_seq_codes is None:
+        genome = get_genome(ref_genome, len(bed_regions)*(2*local_radius+1))
+        local_seq_codes = get_seq_codes(genome, chroms, starts, strands, local_radius)
+    else:
+        offset = (local_seq_codes.shape[1] - (2*local_radius+1))//2
+        if offset < 0:
+            print('Error: the given local seq codes are shorter than the local window!', file=sys.stderr)
+            sys.exit()
+        local_seq_codes = local_seq_codes[:, offset:offset+2*local_radius+1]
+    
+    local_seq_cat = codes_to_kmers(local_seq_codes, 1)
     
     # Check whether the data is correctly extracted (e.g. not all sites are A/T; incorrect padding in the beginning of a chromosome)
     if np.unique(local_seq_cat[:,local_radius], axis=0).shape[0] != 1:
@@ -493,130 +926,377 @@ def prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius
         sys.exit()
   
     # NOTE: replace negatives with 0, meaning replacing 'N' with 'A'
-    local_seq_cat = np.where(local_seq_cat>=0, local_seq_cat, 0)
+    local_seq_cat = np.where(local_seq_cat>=0, local_seq_cat, 0).astype(np.uint8)
     
-    # Assign column names and convert to DataFrame
+    # Assign column names
     seq_cols = ['us'+str(local_radius - i) for i in range(local_radius)] + ['mid'] + ['ds'+str(i+1) for i in range(local_radius)]
-    local_seq_cat = pd.DataFrame(local_seq_cat, columns = seq_cols)
     
     if local_order > 1:
-        local_seq_cat2 = get_digitalized_seq(ref_genome, bed_regions, local_radius, order=local_order)
-        
-        # NOTE: use np.int64 because nn.Embedding needs a Long type
-        local_seq_cat2 = local_seq_cat2.astype(np.int64)
+        local_seq_cat2 = codes_to_kmers(local_seq_codes, local_order)
         
         # NOTE: replace k-mers with 'N' with a large number; the padding numbers at the two ends of the chromosomes are also large numbers   
         local_seq_cat2 = np.where(np.logical_and(local_seq_cat2>=0, local_seq_cat2<=4**local_order), local_seq_cat2, 4**local_order)
         
+        # Codes are widened to int64 (needed by nn.Embedding) per batch
+        local_seq_cat2 = local_seq_cat2.astype(np.uint16 if 4**local_order < 2**16 else np.int32)
+        
         # Names of the categorical variables
         cat_n = local_radius*2 +1 - (local_order-1)
         categorical_features  = ['cat'+str(i+1) for i in range(cat_n)]
-        
-        local_seq_cat2 = pd.DataFrame(local_seq_cat2, columns = categorical_features)
-        local_seq_cat2 = pd.concat([local_seq_cat, local_seq_cat2], axis=1)
     else:
-        local_seq_cat2 = local_seq_cat.astype(np.int64)
+        local_seq_cat2 = None
         categorical_features = seq_cols
     
-    print('local_seq_cat2 shape and columns:', local_seq_cat2.shape, local_seq_cat2.columns)
+    print('local seq columns:', seq_cols)
     print('categorical_features:', categorical_features)
     
-    # The 'score' field in the BED file stores the label/class information
-    y = np.array([float(loc.score) for loc in bed_regions], ndmin=2).reshape((-1,1)) # shape: (n_row, 1)
-    y = pd.DataFrame(y, columns=['mut_type'])
+    # The 'score' field in the BED file stores the label/class information;
+    # labels are int8, or int32 if they don't fit (see read_bed)
+    y = bed_regions.labels
     output_feature = 'mut_type'
     
     # Add feature data in bigWig files
     if len(bw_files) > 0 and seq_only == False:
         # Use the mean value of the region of 2*radius+1 bp around the focal site
-        bw_data = get_mean_bw_for_bed(bw_files, bw_names, bed_regions, local_radius)
- 
-        data_local = pd.concat([local_seq_cat2, bw_data, y], axis=1)
+        bw_data = BigWigReader(bw_files).get_means(chroms, starts, local_radius).astype(np.float16)
+        cont_cols = list(bw_names)
     else:
-        data_local = pd.concat([local_seq_cat2, y], axis=1)
+        bw_data = np.zeros((len(y), 0), dtype=np.float16)
+        cont_cols = []
 
-    return data_local, seq_cols, categorical_features, output_feature
+    return LocalData(local_seq_cat, local_seq_cat2, bw_data, y, seq_cols, categorical_features, cont_cols, output_feature)
 
 
 
     
+def parse_distal_bins(specs):
+    """Parse the levels of binned distal data, given as 'BINSIZE:RADIUS' strings
+    
+    Returns a list of (binsize, radius) tuples, from fine to coarse bins.
+    """
+    distal_bins = []
+    for spec in specs:
+        try:
+            binsize, radius = [int(x) for x in spec.split(':')]
+        except ValueError:
+            print('Error: distal bins should be given as BINSIZE:RADIUS, e.g. 10:10000:', spec, file=sys.stderr)
+            sys.exit()
+        
+        if binsize < 2 or radius < binsize:
+            print('Error: invalid bin size or radius of distal bins:', spec, file=sys.stderr)
+            sys.exit()
+        distal_bins.append((binsize, radius))
+    
+    return sorted(distal_bins)
+
+def get_distal_bins_len(distal_bins):
+    """Get the number of bins of each level of binned distal data (see generate_h5f_singlev2)"""
+    return [int(np.ceil((radius*2+1)/binsize)) for binsize, radius in distal_bins]
+
+def take_h5_rows(ds, rows, inverse, *cols):
+    """Read given rows of a dataset (h5py or NumPy), in the order given by inverse
+    
+    Args:
+        ds: the dataset
+        rows: sorted unique rows to be read
+        inverse: positions in rows of the rows to be returned (see np.unique)
+        cols: selections of the other dimensions
+    
+    Dense rows, e.g. of the blocks read by ShardStreamDataset, are read as 
+    one slice, which is much faster than a point selection in h5py.
+    """
+    if rows[-1] - rows[0] < 2*len(rows):
+        return ds[(slice(rows[0], rows[-1]+1),) + cols][(rows - rows[0])[inverse]]
+    
+    return ds[(rows,) + cols][inverse]
+
+def read_h5_rows(parts, part_starts, rows, n_channels, out):
+    """Read given rows of a dataset split into parts (e.g. 'distal_X1', 'distal_X2', ...)
+    
+    Args:
+        parts: datasets of the parts
+        part_starts: first row of each part
+        rows: sorted rows to be read
+        n_channels: number of channels to be read
+        out: array of shape (len(rows), n_channels, ...) for the data
+    """
+    bounds = np.append(np.searchsorted(rows, part_starts), len(rows))
+    for i, ds in enumerate(parts):
+        if bounds[i] == bounds[i+1]:
+            continue
+        
+        # One read for all rows of the part; h5py needs increasing unique indices
+        part_rows, inverse = np.unique(rows[bounds[i]:bounds[i+1]] - part_starts[i], return_inverse=True)
+        out[bounds[i]:bounds[i+1]] = take_h5_rows(ds, part_rows, inverse, slice(0, n_channels))
+    
+    return out
+
 class CombinedDatasetH5(Dataset):
     """Combine local data and distal into Dataset, with H5"""
-    def __init__(self, data, seq_cols, cat_cols, output_col, h5f_path, n_channels):
+    def __init__(self, local_data, h5f_path, n_channels, h5_cache_size=64*1024**2, distal_radius=None, distal_order=1, bin_h5f_paths=None, base_codes=False):
         """  
         Args:
-            data: DataFrame containing local seq data and categorical data
-            seq_cols: names of local seq columns
-            cat_cols: names of categorical columns used for training
-            output_col: name of the label column
+            local_data: LocalData object with local seq data, features and labels
             h5f_path: H5 file storing the distal data
             n_channels: number of columns (channels) in distal data to be extracted
+            h5_cache_size: size (bytes) of the HDF5 chunk cache of each process
+            distal_radius: radius of the distal windows; the center of the 
+                windows in the H5 file is used if it has a larger radius
+            distal_order: order of distal sequences; for orders > 1, distal data
+                have k-mer indices instead of one-hot encoded bases (see 
+                expand_distal_kmers), derived from the compact layout
+            bin_h5f_paths: H5 files of binned distal data of coarser levels (see
+                prepare_dataset_h5); the levels are appended to the distal data 
+                of each site along the sequence dimension
+            base_codes: if True, distal data have base codes instead of one-hot
+                encoded bases (see expand_distal_codes), for distal_order 1 
+                and the compact layout without binned data
         """
-        # Store the local seq data and label for later use
-        self.data_local = data[seq_cols+[output_col]]
-        
-        self.n = data.shape[0]
+        # Local data is kept in compact columns and widened per batch
+        self.local_data = local_data
         
-        # Output column
-        if output_col:
-            self.y = data[output_col].astype(np.float32).values.reshape(-1, 1)
-        else:
-            self.y = np.zeros((self.n, 1))
+        self.n = len(local_data)
         
-        # Names of categorical columns
-        self.cat_cols = cat_cols
+        # Names of categorical and continuous columns
+        self.cat_cols = local_data.cat_cols
+        self.cont_cols = local_data.cont_cols
         
         # Set biggest dimension for each categorical column
-        self.cat_dims = [np.max(data[col]) + 1 for col in cat_cols]
+        self.cat_dims = local_data.cat_dims
         
-        # Find the continuous columns
-        self.cont_cols = [col for col in data.columns if col not in self.cat_cols + seq_cols + [output_col]]
-        
-        # Assign the continuous data to cont_X
-        if self.cont_cols:
-            self.cont_X = data[self.cont_cols].astype(np.float32).values
-        else:
-            self.cont_X = np.zeros((self.n, 1)) 
-        
-        # Assign the categorical data to cat_X
-        if len(self.cat_cols) > 0:
-            self.cat_X = data[cat_cols].astype(np.int64).values
-        else:
+        if len(self.cat_cols) == 0:
             print("Error: no categorical data, something is wrong!", file=sys.stderr)
             sys.exit()
         
         # For distal data
         self.h5f_path = h5f_path
         self.h5f = None
-        self.single_h5_size = 0
+        self.h5f_pid = None
+        self.preloaded = False
+        self.h5_cache_size = h5_cache_size
         self.n_channels = n_channels
+        self.distal_radius = distal_radius
+        self.distal_order = distal_order
+        self.n_tracks = n_channels - 4**distal_order
         print('Number of channels to be used for distal data:', self.n_channels)
         
+        self.bin_h5f_paths = list(bin_h5f_paths) if bin_h5f_paths else []
+        self.bin_levels = None
+        self.bin_pid = None
+        if len(self.bin_h5f_paths) > 0 and distal_order > 1:
+            print('Error: binned distal data are only supported for distal_order 1', file=sys.stderr)
+            sys.exit()
+        
+        # Binned data are averages of one-hot encoded bases
+        self.base_codes = base_codes and distal_order == 1 and len(self.bin_h5f_paths) == 0
+        
+        # Rows in each HDF5 chunk, used for drawing rows of a chunk together
+        with h5py.File(self.h5f_path, 'r') as hf:
+            self.h5_chunk_rows = int(hf.attrs.get('h5_chunk_rows', 1))
+            
+            # Rows of the sites in files reusing the rows of other files (see generate_h5f_incremental)
+            self.row_index = hf['row_index'][:] if 'row_index' in hf else None
+        
 
     def __len__(self):
         """ Denote the total number of samples. """
         return self.n
+    
+    def __getstate__(self):
+        """ Don't pickle the H5 handles; they are reopened when used. """
+        state = self.__dict__.copy()
+        state['h5f'] = None
+        state['shards'] = None
+        state['bin_levels'] = None
+        
+        # Preloaded data are only shared with forked processes; other
+        # processes read the H5 file
+        state['preloaded'] = False
+        
+        return state
+    
+    def _open_h5f(self):
+        """ Open the H5 file and keep the handles of the datasets of all parts """
+        # The chunk cache should hold the chunks shared by nearby batches
+        self.h5f = h5py.File(self.h5f_path, 'r', rdcc_nbytes=self.h5_cache_size, rdcc_nslots=10007)
+        self.h5f_pid = os.getpid()
+        
+        # Compact files store base codes and tracks separately
+        self.compact = get_h5f_info(self.h5f)[0] != 1
+        if not self.compact and self.distal_order > 1:
+            print('Error: distal_order > 1 requires H5 files of the compact layout:', self.h5f_path, file=sys.stderr)
+            sys.exit()
+        
+        if self.compact:
+            self.track_min = self.h5f.attrs['track_min']
+            self.track_scale = self.h5f.attrs['track_scale']
+        
+        # Files split into parts (see gen_distal_h5) have one dataset per part
+        key = 'distal_seq' if self.compact else 'distal_X'
+        suffixes = [''] if key in self.h5f else [str(i+1) for i in range(len(self.h5f.keys())) if key+str(i+1) in self.h5f]
+        
+        self.shards = []
+        for suffix in suffixes:
+            if self.compact:
+                tracks = self.h5f['distal_tracks'+suffix] if self.n_tracks > 0 else None
+                self.shards.append((self.h5f['distal_seq'+suffix], tracks))
+            else:
+                self.shards.append((self.h5f['distal_X'+suffix], None))
+        
+        # First row of each part
+        self.shard_starts = np.cumsum([0] + [shard[0].shape[0] for shard in self.shards])[:-1]
+        
+        # Columns of the distal windows to be used
+        self.seq_len = self.shards[0][0].shape[-1]
+        self.crop = slice(None)
+        if self.distal_radius is not None:
+            h5_radius = int(self.h5f.attrs.get('distal_radius', (self.seq_len-1)//2))
+            if self.distal_radius > h5_radius:
+                print('Error: distal_radius is larger than the radius of the H5 file:', self.distal_radius, h5_radius, file=sys.stderr)
+                sys.exit()
+            
+            # Center-crop the windows of a larger radius
+            offset = h5_radius - self.distal_radius
+            self.seq_len = self.seq_len - 2*offset
+            self.crop = slice(offset, offset+self.seq_len)
+        #print('open h5f file:', self.h5f_path)
+    
+    def _open_bin_h5fs(self):
+        """ Open the H5 files of binned distal data and keep the handles of their parts """
+        self.bin_levels = []
+        for path in self.bin_h5f_paths:
+            hf = h5py.File(path, 'r', rdcc_nbytes=self.h5_cache_size, rdcc_nslots=10007)
+            parts = [hf[key] for key in get_h5f_part_keys(hf, 'distal_X')]
+            self.bin_levels.append((parts, np.cumsum([0] + [ds.shape[0] for ds in parts])[:-1]))
+        
+        self.bin_pid = os.getpid()
+    
+    def preload(self, block_size=100000):
+        """Read all distal data into shared memory, for training data fitting in RAM
+        
+        Data are decompressed once and kept in the layout of the file (i.e. 
+        base codes and tracks for compact files), only for the channels used;
+        forked DataLoader workers map the same memory (see get_shared_array).
+        
+        Args:
+            block_size: number of rows read at a time
+        """
+        if self.preloaded:
+            return
+        
+        if self.h5f is None or self.h5f_pid != os.getpid():
+            self._open_h5f()
+        
+        shards = []
+        n_bytes = 0
+        for ds, tracks_ds in self.shards:
+            arrays = []
+            for x, n_cols in [(ds, None if self.compact else self.n_channels), (tracks_ds, self.n_tracks)]:
+                if x is None:
+                    arrays.append(None)
+                    continue
+                
+                # Only the channels and columns used are loaded
+                shape = (x.shape[0], self.seq_len) if n_cols is None else (x.shape[0], n_cols, self.seq_len)
+                arr = get_shared_array(shape, x.dtype)
+                for start in range(0, x.shape[0], block_size):
+                    end = min(start+block_size, x.shape[0])
+                    arr[start:end] = x[start:end, self.crop] if n_cols is None else x[start:end, 0:n_cols, self.crop]
+                
+                arrays.append(arr)
+                n_bytes += arr.nbytes
+            
+            shards.append(tuple(arrays))
+        
+        self.shards = shards
+        self.crop = slice(None)
+        self.preloaded = True
+        
+        self.h5f.close()
+        self.h5f = None
+        print('Preloaded distal data into shared memory (MB):', round(n_bytes/1024**2, 1))
 
     def __getitem__(self, idx):
-        """ Generate one sample of data. """
-        if self.h5f is None:
+        """ Generate one sample, or a batch of samples if idx is a list of indices. """
+        if np.ndim(idx) > 0:
+            return self.get_batch(idx)
+        
+        y, cont_X, cat_X, distal_X = self.get_batch([idx])
+        
+        return y[0], cont_X[0], cat_X[0], distal_X[0]
+    
+    def get_batch(self, idxs):
+        """ Generate a batch of samples; samples are returned in the order of sorted indices. """
+        # Open the H5 file once in each process, unless the data are preloaded
+        if not self.preloaded and (self.h5f is None or self.h5f_pid != os.getpid()):
+            self._open_h5f()
+        
+        # Sorted indices make the rows of each part contiguous in the batch
+        idxs = np.sort(np.asarray(idxs, dtype=np.int64))
+        
+        # Rows of the sites in the file, sorted as well if remapped
+        h5_rows = idxs
+        if self.row_index is not None:
+            order = np.argsort(self.row_index[idxs], kind='stable')
+            h5_rows = self.row_index[idxs][order]
+        
+        # Base codes are only stored in compact files
+        base_codes = self.base_codes and self.compact
+        if base_codes:
+            distal_X = np.empty((len(idxs), 1+self.n_tracks, self.seq_len), dtype=np.uint8 if self.n_tracks == 0 else np.float32)
+        elif self.distal_order == 1:
+            distal_X = np.empty((len(idxs), self.n_channels, self.seq_len), dtype=np.float32)
+        else:
+            distal_X = np.empty((len(idxs), 1+self.n_tracks, self.seq_len-self.distal_order+1), dtype=np.float32)
+        
+        bounds = np.searchsorted(h5_rows, self.shard_starts)
+        bounds = np.append(bounds, len(idxs))
+        for i, (ds, tracks_ds) in enumerate(self.shards):
+            if bounds[i] == bounds[i+1]:
+                continue
             
-            # Open the H5 file once
-            self.h5f = h5py.File(self.h5f_path, 'r')
+            # One read for all rows of the part; h5py needs increasing unique indices
+            rows, inverse = np.unique(h5_rows[bounds[i]:bounds[i+1]] - self.shard_starts[i], return_inverse=True)
+            out = distal_X[bounds[i]:bounds[i+1]]
             
-            if len(self.h5f.keys()) > 1:
-                self.single_h5_size = self.h5f['distal_X1'].shape[0]
-            #print('open h5f file:', self.h5f_path)     
-        if self.single_h5_size > 0:
-            file_i = (idx // self.single_h5_size) + 1
-            idx1 = idx % self.single_h5_size
-            return self.y[idx], self.cont_X[idx], self.cat_X[idx], np.array(self.h5f['distal_X'+str(file_i)][idx1, 0:self.n_channels, :])
+            if self.compact:
+                # Expand the base codes into one-hot encoding, or k-mer indices
+                tracks = take_h5_rows(tracks_ds, rows, inverse, slice(0, self.n_tracks), self.crop) if tracks_ds is not None else None
+                if base_codes:
+                    expand_distal_codes(take_h5_rows(ds, rows, inverse, self.crop), tracks, self.track_min, self.track_scale, self.n_tracks, out=out)
+                elif self.distal_order == 1:
+                    expand_distal_compact(take_h5_rows(ds, rows, inverse, self.crop), tracks, self.track_min, self.track_scale, self.n_channels, out=out)
+                else:
+                    expand_distal_kmers(take_h5_rows(ds, rows, inverse, self.crop), tracks, self.track_min, self.track_scale, self.n_tracks, self.distal_order, out=out)
+            else:
+                out[:] = take_h5_rows(ds, rows, inverse, slice(0, self.n_channels), self.crop)
         
-        else:
-            return self.y[idx], self.cont_X[idx], self.cat_X[idx], np.array(self.h5f['distal_X'][idx, 0:self.n_channels, :])
+        # Back to the order of the sites
+        if self.row_index is not None:
+            distal_X[order] = distal_X.copy()
+        
+        # Binned data of coarser levels follow the data of base resolution
+        if len(self.bin_h5f_paths) > 0:
+            if self.bin_levels is None or self.bin_pid != os.getpid():
+                self._open_bin_h5fs()
+            
+            levels = [distal_X]
+            for parts, part_starts in self.bin_levels:
+                out = np.empty((len(idxs), self.n_channels, parts[0].shape[2]), dtype=np.float32)
+                levels.append(read_h5_rows(parts, part_starts, idxs, self.n_channels, out))
+            distal_X = np.concatenate(levels, axis=2)
+        
+        y, cont_X, cat_X = self.local_data.get_batch(idxs)
+        
+        return y, cont_X, cat_X, distal_X
+    
+    @property
+    def data_local(self):
+        """Local seq data and labels as a DataFrame"""
+        return self.local_data.to_dataframe()
     
     def get_labels(self): 
-        return np.squeeze(self.y)
+        return self.local_data.labels.astype(np.float32)
     
     def _get_labels(self, dataset, idx):
         return dataset.__getitem__(idx)[1]
@@ -626,47 +1306,37 @@ class CombinedDatasetH5(Dataset):
 
 class CombinedDatasetNP(Dataset):
     """Combine local data and distal into Dataset, using NumPy funcions"""
-    def __init__(self, data, seq_cols, cat_cols, output_col, ref_genome, bed_regions, distal_radius, n_channels, bw_files, seq_only):
+    def __init__(self, local_data, ref_genome, bed_regions, distal_radius, n_channels, bw_files, seq_only, bw_cache=None, distal_order=1, base_codes=False):
         """  
         Args:
-            data: DataFrame containing local seq data and categorical data
-            seq_cols: names of local seq columns
-            cat_cols: names of categorical columns used for training
-            output_col: name of the label column
-            h5f_path: H5 file storing the distal data
+            local_data: LocalData object with local seq data, features and labels
+            ref_genome: reference genome (FASTA file, GenomeStore or IndexedFasta)
+            bed_regions: BedRegions object of the sites
+            distal_radius: radius of the distal windows
             n_channels: number of columns (channels) in distal data to be extracted
+            bw_files: file paths of bigWig tracks
+            seq_only: if True, ignore the bigWig tracks
+            bw_cache: type of dense bigWig stores to read tracks from (see BigWigReader)
+            distal_order: order of distal sequences; for orders > 1, distal data
+                have k-mer indices instead of one-hot encoded bases (see 
+                expand_distal_kmers)
+            base_codes: if True, distal data have base codes instead of one-hot
+                encoded bases (see expand_distal_codes), for distal_order 1
         """
-        # Store the local seq data and label for later use
-        self.data_local = data[seq_cols+[output_col]]
+        # Local data is kept in compact columns and widened per batch
+        self.local_data = local_data
         
         # Sample size
-        self.n = data.shape[0]
-        
-        # Output column
-        if output_col:
-            self.y = data[output_col].astype(np.float32).values.reshape(-1, 1)
-        else:
-            self.y = np.zeros((self.n, 1))
+        self.n = len(local_data)
         
-        # Names of categorical columns
-        self.cat_cols = cat_cols
+        # Names of categorical and continuous columns
+        self.cat_cols = local_data.cat_cols
+        self.cont_cols = local_data.cont_cols
         
         # Set biggest dimension for each categorical column
-        self.cat_dims = [np.max(data[col]) + 1 for col in cat_cols]
+        self.cat_dims = local_data.cat_dims
         
-        # Find the continuous columns
-        self.cont_cols = [col for col in data.columns if col not in self.cat_cols + seq_cols + [output_col]]
-        
-        # Assign the continuous data to cont_X
-        if self.cont_cols:
-            self.cont_X = data[self.cont_cols].astype(np.float32).values
-        else:
-            self.cont_X = np.zeros((self.n, 1)) 
-        
-        # Assign the categorical data to cat_X
-        if len(self.cat_cols) > 0:
-            self.cat_X = data[cat_cols].astype(np.int64).values
-        else:
+        if len(self.cat_cols) == 0:
             print("Error: no categorical data, something is wrong!", file=sys.stderr)
             sys.exit()
         
@@ -676,126 +1346,340 @@ class CombinedDatasetNP(Dataset):
         self.n_channels = n_channels
         self.bw_files = bw_files
         
-        ####
-        self.bw_fh = []
-        for file in self.bw_files:
-            self.bw_fh.append(pyBigWig.open(file))
-        ####
+        # bigWig files are opened in each process when first used,
+        # as they can't be shared by forked DataLoader workers
+        # With bw_cache, windows are sliced from dense stores of the tracks
+        self.bw_reader = BigWigReader(bw_files, cache=bw_cache if not seq_only else None)
+        
         self.seq_only = seq_only
         print('Number of channels to be used for distal data:', self.n_channels)
         
         self.distal_radius = distal_radius
+        self.distal_order = distal_order
+        self.base_codes = base_codes and distal_order == 1
         self.seq_len = 2*distal_radius + 1 
         
+        # Keep the site coordinates as NumPy columns
         self.bed_regions = bed_regions
-        self.bed_pd = pd.read_csv(bed_regions.fn, sep='\t', header=None, memory_map=True)
-        self.bed_pd.columns = ['chrom', 'start', 'stop', 'name', 'score', 'strand']
-
-        self.one_hot_encoder = {'A':np.array([[1,0,0,0]], dtype=np.float32).T,
-               'C':np.array([[0,1,0,0]], dtype=np.float32).T,
-               'G':np.array([[0,0,1,0]], dtype=np.float32).T,
-               'T':np.array([[0,0,0,1]], dtype=np.float32).T,
-               'R':np.array([[0.5,0,0.5,0]], dtype=np.float32).T, #A,G
-               'Y':np.array([[0,0.5,0,0.5]], dtype=np.float32).T, #C,T
-               'M':np.array([[0.5,0.5,0,0]], dtype=np.float32).T, #A,C
-               'S':np.array([[0,0.5,0.5,0]], dtype=np.float32).T, #C,G
-               'W':np.array([[0.5,0,0,0.5]], dtype=np.float32).T, #A,T
-               'K':np.array([[0,0,0.5,0.5]], dtype=np.float32).T, #G,T
-               'B':np.array([[0,1/3,1/3,1/3]], dtype=np.float32).T, #not A
-               'D':np.array([[1/3,0,1/3,1/3]], dtype=np.float32).T, #not C
-               'H':np.array([[1/3,1/3,0,1/3]], dtype=np.float32).T, #not G
-               'V':np.array([[1/3,1/3,1/3,0]], dtype=np.float32).T, #not T
-               'N':np.array([[0.25,0.25,0.25,0.25]], dtype=np.float32).T}
-
-        self.one_hot_encoder_rc = {'A':np.array([[0,0,0,1]], dtype=np.float32).T,
-               'C':np.array([[0,0,1,0]], dtype=np.float32).T,
-               'G':np.array([[0,1,0,0]], dtype=np.float32).T,
-               'T':np.array([[1,0,0,0]], dtype=np.float32).T,
-               'R':np.array([[0,0.5,0,0.5]], dtype=np.float32).T, #A,G
-               'Y':np.array([[0.5,0,0.5,0]], dtype=np.float32).T, #C,T
-               'M':np.array([[0,0,0.5,0.5]], dtype=np.float32).T, #A,C
-               'S':np.array([[0,0.5,0.5,0]], dtype=np.float32).T, #C,G
-               'W':np.array([[0.5,0,0,0.5]], dtype=np.float32).T, #A,T
-               'K':np.array([[0.5,0.5,0,0]], dtype=np.float32).T, #G,T
-               'B':np.array([[1/3,1/3,1/3,0]], dtype=np.float32).T, #not A
-               'D':np.array([[1/3,1/3,0,1/3]], dtype=np.float32).T, #not C
-               'H':np.array([[1/3,0,1/3,1/3]], dtype=np.float32).T, #not G
-               'V':np.array([[0,1/3,1/3,1/3]], dtype=np.float32).T, #not T
-               'N':np.array([[0.25,0.25,0.25,0.25]], dtype=np.float32).T}
-            
-        self.records = SeqIO.to_dict(SeqIO.parse(open(ref_genome, 'r'), 'fasta'))
-        
+        self.chroms, self.starts, self.strands = get_bed_columns(bed_regions)
 
+        # Packed genome store, or indexed FASTA for few sites; DataLoader 
+        # workers map (or read) the same file
+        self.genome = get_genome(ref_genome, self.n*self.seq_len)
+        
     def __len__(self):
         """ Denote the total number of samples. """
         return self.n
 
     def __getitem__(self, idx):
-        """ Generate one sample of data. """
-
-        region = self.bed_pd.iloc[idx]
-        chrom, start, stop, strand = str(region.chrom), region.start, region.stop, region.strand
+        """ Generate one sample, or a batch of samples if idx is a list of indices. """
+        if np.ndim(idx) > 0:
+            return self.get_batch(idx)
         
-        #long_seq_record = self.records[chrom]
-
-        long_seq = str(self.records[chrom].seq)
-        long_seq_len = len(long_seq)
-
-        start1 = np.max([int(start)-self.distal_radius, 0])
-        stop1 = np.min([int(stop)+self.distal_radius, long_seq_len])
-        short_seq = long_seq[start1:stop1].upper()
-
-        if(len(short_seq) < self.seq_len):
-            #print('warning:', chrom, start1, stop1, long_seq_len)
-            if start1 == 0:
-                short_seq = (self.seq_len - len(short_seq))*'N' + short_seq
-                #print(short_seq)
-            else:
-                short_seq = short_seq + (self.seq_len - len(short_seq))*'N'
-                #print(short_seq)
-        #a = np.concatenate([one_hot_encoder[c] for c in short_seq], axis=1)
-        if strand == '+':
-            distal_seq = np.concatenate([self.one_hot_encoder[c] for c in short_seq], axis=1)
-        else:
-            #a = [one_hot_encoder_rc[c] for c in short_seq[::-1]]
-            #a.reverse()
-            distal_seq = np.concatenate([self.one_hot_encoder_rc[c] for c in short_seq[::-1]], axis=1)
-        if distal_seq.shape[1] != self.seq_len:
-            print('distal_seq.shape:', distal_seq.shape, chrom, start, stop)
-            print('short_seq:', short_seq)
+        y, cont_X, cat_X, distal_X = self.get_batch([idx])
+        
+        return y[0], cont_X[0], cat_X[0], distal_X[0]
+    
+    def get_batch(self, idxs):
+        """ Generate a batch of samples; samples are returned in the order of sorted indices. """
+        # Sorted indices keep sites of a chromosome together for sequence extraction
+        idxs = np.sort(np.asarray(idxs, dtype=np.int64))
+        
+        chroms = self.chroms[idxs]
+        starts = self.starts[idxs]
+        strands = self.strands[idxs]
+        
+        if self.distal_order > 1:
+            n_tracks = self.n_channels - 4**self.distal_order
+            tracks = self.bw_reader.get_windows(chroms, starts, strands, self.distal_radius) if n_tracks > 0 else None
+            distal_X = expand_distal_kmers(get_seq_codes(self.genome, chroms, starts, strands, self.distal_radius), tracks, None, None, n_tracks, self.distal_order)
+            
+            y, cont_X, cat_X = self.local_data.get_batch(idxs)
+            
+            return y, cont_X, cat_X, distal_X
+        
+        if self.base_codes:
+            n_tracks = self.n_channels - 4
+            tracks = self.bw_reader.get_windows(chroms, starts, strands, self.distal_radius) if n_tracks > 0 else None
+            distal_X = expand_distal_codes(get_seq_codes(self.genome, chroms, starts, strands, self.distal_radius), tracks, None, None, n_tracks)
+            
+            y, cont_X, cat_X = self.local_data.get_batch(idxs)
+            
+            return y, cont_X, cat_X, distal_X
+        
+        distal_X = np.empty((len(idxs), self.n_channels, self.seq_len), dtype=np.float32)
+        
+        # Encode the sequences of the whole batch at once
+        get_seq_ohe(self.genome, chroms, starts, strands, self.distal_radius, out=distal_X[:, 0:4, :])
 
         # Handle distal bigWig data
-        if len(self.bw_fh) > 0 and self.seq_only == False:
-            for bw in self.bw_fh:
-                bw_values = np.nan_to_num(bw.values(chrom, start1, stop1, numpy=True))
-                if(len(bw_values) < self.seq_len):
-                    if start1 == 0:
-                        bw_values = np.concatenate([(self.seq_len - len(bw_values))*[0], bw_values])
-                    else:
-                        bw_values = np.concatenate([bw_values, (self.seq_len - len(bw_values))*[0]])
-                
-                if strand == '-':
-                    bw_values = np.flip(bw_values)
-                
-                distal_seq = np.concatenate((distal_seq, [bw_values]), axis=0).astype(np.float32)
-
+        if len(self.bw_files) > 0 and self.seq_only == False:
+            # Tracks are read block-wise for the whole batch
+            self.bw_reader.get_windows(chroms, starts, strands, self.distal_radius, out=distal_X[:, 4:, :])
+        
+        y, cont_X, cat_X = self.local_data.get_batch(idxs)
         
-        return self.y[idx], self.cont_X[idx], self.cat_X[idx], distal_seq
+        return y, cont_X, cat_X, distal_X
+    
+    @property
+    def data_local(self):
+        """Local seq data and labels as a DataFrame"""
+        return self.local_data.to_dataframe()
     
     def get_labels(self): 
-        return np.squeeze(self.y)
+        return self.local_data.labels.astype(np.float32)
     
     def _get_labels(self, dataset, idx):
         return dataset.__getitem__(idx)[1]
 
-def prepare_dataset_h5(bed_regions, ref_genome, bw_paths, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1, h5f_path='distal_data.h5', chunk_size=5000, seq_only=False, n_h5_files=1):
-    """Prepare the datasets for given regions, using H5 file"""
- 
+class BlockShuffleSampler(Sampler):
+    """Shuffle blocks of contiguous rows, then shuffle the rows within a buffer
+    
+    Rows of a block (e.g. an HDF5 chunk) are drawn in nearby batches, so that
+    each chunk is read and decompressed once for a few batches rather than 
+    once for every row. Indices are drawn in a new order in each epoch.
+    """
+    def __init__(self, indices, block_size, buffer_size, row_index=None):
+        """
+        Args:
+            indices: dataset indices to be drawn
+            block_size: number of contiguous rows in a block
+            buffer_size: number of consecutive indices shuffled together
+            row_index: rows of the dataset indices in the file, if they
+                differ (see generate_h5f_incremental)
+        """
+        self.indices = np.sort(np.asarray(indices, dtype=np.int64))
+        self.block_size = block_size
+        self.buffer_size = buffer_size
+        
+        # Rows in the file, which make up the blocks
+        self.rows = self.indices if row_index is None else np.asarray(row_index)[self.indices]
+    
+    def __iter__(self):
+        # Seed from torch, so that torch.manual_seed() makes the order reproducible
+        rng = np.random.default_rng(int(torch.empty((), dtype=torch.int64).random_().item()))
+        
+        # Shuffle the blocks, keeping the rows of a block together
+        blocks = self.rows // self.block_size
+        block_ranks = rng.permutation(blocks.max() + 1) if len(blocks) > 0 else blocks
+        perm = self.indices[np.argsort(block_ranks[blocks], kind='stable')]
+        
+        # Shuffle the rows within each buffer
+        buffers = np.arange(len(perm)) // self.buffer_size
+        perm = perm[np.lexsort((rng.random(len(perm)), buffers))]
+        
+        return iter(perm.tolist())
+    
+    def __len__(self):
+        return len(self.indices)
+
+class _SubsetIndexSampler(Sampler):
+    """Map the indices drawn by a sampler over a Subset to indices of the whole dataset"""
+    def __init__(self, sampler, indices):
+        self.sampler = sampler
+        self.indices = indices
+    
+    def __iter__(self):
+        return (self.indices[i] for i in self.sampler)
+    
+    def __len__(self):
+        return len(self.sampler)
+
+class ShardStreamDataset(IterableDataset):
+    """Stream the sites of a CombinedDatasetH5 part by part, shuffled within a buffer
+    
+    Parts of the H5 file (see gen_distal_h5) are assigned as a whole to each
+    DataLoader worker of each rank; if there are fewer parts than workers, 
+    parts are split into contiguous ranges of rows. Each worker reads its 
+    parts sequentially in blocks of read_size sites and draws batches from a
+    shuffle buffer, so that training data larger than the page cache are 
+    read at sequential disk speed. Batches are made by the stream, so the
+    DataLoader should have batch_size=None.
+    """
+    def __init__(self, dataset, indices=None, batch_size=128, buffer_size=100000, read_size=4096, seed=None, rank=None, world_size=None):
+        """
+        Args:
+            dataset: CombinedDatasetH5 object
+            indices: indices of the sites to be drawn (e.g. of a Subset); 
+                default: all sites
+            batch_size: number of samples in a batch
+            buffer_size: number of samples in the shuffle buffer of each worker
+            read_size: number of sites read at a time
+            seed: seed of the order of the parts; distributed runs should use
+                the same seed for all ranks and call set_epoch() in each epoch,
+                as for DistributedSampler. Default: a new order in each epoch,
+                drawn by the DataLoader
+            rank, world_size: rank of this process and number of ranks; 
+                default: from torch.distributed if initialized
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.buffer_size = max(buffer_size, batch_size)
+        self.read_size = read_size
+        self.seed = seed
+        self.epoch = 0
+        self.rank = rank
+        self.world_size = world_size
+        
+        indices = np.arange(len(dataset)) if indices is None else np.asarray(indices, dtype=np.int64)
+        
+        # Sites in the order of their rows in the H5 file
+        h5_rows = indices if dataset.row_index is None else dataset.row_index[indices]
+        order = np.argsort(h5_rows, kind='stable')
+        self.indices = indices[order]
+        self.h5_rows = h5_rows[order]
+        
+        # First and last rows of the parts
+        with h5py.File(dataset.h5f_path, 'r') as hf:
+            key = 'distal_X' if get_h5f_info(hf)[0] == 1 else 'distal_seq'
+            self.part_bounds = np.cumsum([0] + [hf[k].shape[0] for k in get_h5f_part_keys(hf, key)])
+    
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+    
+    def get_units(self, n_consumers):
+        """Get the row ranges to be streamed: whole parts, or pieces of them if there are fewer parts than consumers"""
+        n_pieces = -(-n_consumers // (len(self.part_bounds)-1))
+        
+        units = []
+        for start, end in zip(self.part_bounds[:-1], self.part_bounds[1:]):
+            cuts = np.linspace(start, end, n_pieces+1).astype(np.int64)
+            units.extend(zip(cuts[:-1], cuts[1:]))
+        
+        return units
+    
+    def __iter__(self):
+        rank, world_size = self.rank, self.world_size
+        if rank is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            rank, world_size = (torch.distributed.get_rank(), torch.distributed.get_world_size()) if distributed else (0, 1)
+        
+        worker_info = get_worker_info()
+        worker_id, n_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        consumer, n_consumers = rank*n_workers + worker_id, world_size*n_workers
+        
+        # The order of the units is shared by all workers of all ranks
+        if self.seed is not None:
+            shared_seed = self.seed + self.epoch
+        elif worker_info is not None:
+            shared_seed = worker_info.seed - worker_id
+        else:
+            shared_seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        
+        units = self.get_units(n_consumers)
+        units = [units[i] for i in np.random.default_rng(shared_seed).permutation(len(units))]
+        
+        return self.iter_batches(units[consumer::n_consumers], np.random.default_rng([shared_seed, consumer]))
+    
+    def iter_blocks(self, units):
+        """Read the sites of the row ranges sequentially, read_size sites at a time"""
+        for start, end in units:
+            lo, hi = np.searchsorted(self.h5_rows, [start, end])
+            for block_start in range(lo, hi, self.read_size):
+                yield self.dataset.get_batch(self.indices[block_start:min(block_start+self.read_size, hi)])
+    
+    def iter_batches(self, units, rng):
+        """Draw batches of the sites of the row ranges from the shuffle buffer"""
+        pool = None
+        for block in self.iter_blocks(units):
+            pool = block if pool is None else tuple(np.concatenate((x, y)) for x, y in zip(pool, block))
+            if len(pool[0]) < self.buffer_size:
+                continue
+            
+            # Half of the shuffled buffer is kept for mixing with next blocks
+            perm = rng.permutation(len(pool[0]))
+            n_out = (len(perm) - self.buffer_size//2)//self.batch_size*self.batch_size
+            pool = tuple(x[perm] for x in pool)
+            for start in range(0, n_out, self.batch_size):
+                yield tuple(x[start:start+self.batch_size] for x in pool)
+            pool = tuple(x[n_out:] for x in pool)
+        
+        if pool is not None:
+            perm = rng.permutation(len(pool[0]))
+            pool = tuple(x[perm] for x in pool)
+            for start in range(0, len(perm), self.batch_size):
+                yield tuple(x[start:start+self.batch_size] for x in pool)
+
+def get_dataloader(dataset, batch_size, shuffle=False, sampler=None, stream_buffer=0, **kwargs):
+    """Get a DataLoader for a dataset (or a Subset of it)
+    
+    If the dataset has a get_batch() method, each batch of indices is passed
+    to the dataset at once (through a BatchSampler), so that a batch is 
+    generated with vectorized code instead of sample by sample. For H5 
+    datasets with multi-row chunks, shuffling is done by BlockShuffleSampler.
+    With stream_buffer > 0, shuffled H5 datasets are streamed part by part
+    through a shuffle buffer of that size (see ShardStreamDataset).
+    """
+    if isinstance(dataset, Subset):
+        full_dataset, indices = dataset.dataset, dataset.indices
+    else:
+        full_dataset, indices = dataset, None
+    
+    if not hasattr(full_dataset, 'get_batch'):
+        return DataLoader(dataset, batch_size, shuffle=shuffle, sampler=sampler, **kwargs)
+    
+    if stream_buffer > 0 and shuffle and sampler is None and isinstance(full_dataset, CombinedDatasetH5):
+        return DataLoader(ShardStreamDataset(full_dataset, indices, batch_size, stream_buffer), batch_size=None, **kwargs)
+    
+    block_size = getattr(full_dataset, 'h5_chunk_rows', 1)
+    if sampler is None and shuffle and block_size > 1:
+        # Draws indices of the whole dataset; the buffer spans a few batches
+        sampler = BlockShuffleSampler(indices if indices is not None else range(len(full_dataset)), block_size, max(4*batch_size, block_size), 
+                                      getattr(full_dataset, 'row_index', None))
+        indices = None
+    elif sampler is None:
+        if shuffle:
+            sampler = RandomSampler(dataset)
+        else:
+            sampler = SequentialSampler(dataset)
+    
+    if indices is not None:
+        sampler = _SubsetIndexSampler(sampler, indices)
+    
+    # batch_size=None disables automatic batching, as batches are made by the dataset
+    return DataLoader(full_dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last=False), **kwargs)
+
+def generate_distal_bins_h5f(bed_regions, ref_genome, bw_paths, bw_files, bw_names, distal_bins, n_h5_files=1, cache_dir=None, chunk_size=10000, n_workers=4, h5_chunk_rows=H5_CHUNK_ROWS):
+    """Generate an H5 file of binned distal data for each level of distal_bins, if not existing
+    
+    Returns the paths of the files.
+    """
+    bin_h5f_paths = []
+    for binsize, bin_radius in distal_bins:
+        bin_h5f_path = get_h5f_cache_path(bed_regions.fn, ref_genome, bw_files, bw_names, bin_radius, 1, cache_dir, distal_binsize=binsize)
+        generate_h5fv2(bed_regions, bin_h5f_path, ref_genome, bin_radius, 1, bw_paths, bw_files, chunk_size, n_h5_files, h5_chunk_rows=h5_chunk_rows, cache_dir=cache_dir, distal_binsize=binsize, n_workers=n_workers)
+        bin_h5f_paths.append(bin_h5f_path)
+    
+    return bin_h5f_paths
+
+def prepare_dataset_h5(bed_regions, ref_genome, bw_paths, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1, h5f_path='distal_data.h5', chunk_size=5000, seq_only=False, n_h5_files=1, h5_distal_radius=None, local_seq_codes=None, cache_dir=None, distal_bins=None, base_codes=False, n_workers=4, h5_chunk_rows=H5_CHUNK_ROWS):
+    """Prepare the datasets for given regions, using H5 file
+    
+    The H5 file can have a larger radius (h5_distal_radius) than distal_radius,
+    e.g. the largest one to be used, and local_seq_codes can be extracted 
+    at a larger radius than local_radius (see prepare_local_data); the 
+    centers of the windows are used.
+    
+    distal_bins are (binsize, radius) of coarser levels of distal data (see
+    parse_distal_bins), each stored in an H5 file of binned data.
+    
+    Local data are cached like the H5 files (see prepare_local_data).
+    
+    With base_codes, distal data have base codes instead of one-hot encoded
+    bases (see CombinedDatasetH5). n_workers is the number of processes for
+    generating H5 files with chunks of h5_chunk_rows rows (see generate_h5fv2).
+    """
+    if h5_distal_radius is None:
+        h5_distal_radius = distal_radius
+    
     # Generate H5 file for distal data
-    generate_h5fv2(bed_regions, h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size, n_h5_files)
+    generate_h5fv2(bed_regions, h5f_path, ref_genome, h5_distal_radius, distal_order, bw_paths, bw_files, chunk_size, n_h5_files, h5_chunk_rows=h5_chunk_rows, cache_dir=cache_dir, n_workers=n_workers)
+    
+    # Generate H5 files for binned distal data
+    bin_h5f_paths = generate_distal_bins_h5f(bed_regions, ref_genome, bw_paths, bw_files, bw_names, distal_bins or [], n_h5_files, cache_dir, n_workers=n_workers, h5_chunk_rows=h5_chunk_rows)
     
     # Prepare local data
-    data_local, seq_cols, categorical_features, output_feature = prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only)
+    local_data = prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only, local_seq_codes, cache=True, cache_dir=cache_dir)
 
     # If seq_only flag was set, bigWig files will be ignored
     if seq_only:
@@ -805,17 +1689,17 @@ def prepare_dataset_h5(bed_regions, ref_genome, bw_paths, bw_files, bw_names, lo
         n_channels = 4**distal_order + len(bw_files)
     
     # Combine local data and distal into Dataset objects
-    dataset = CombinedDatasetH5(data=data_local, seq_cols=seq_cols, cat_cols=categorical_features, output_col=output_feature, h5f_path=h5f_path, n_channels=n_channels)
+    dataset = CombinedDatasetH5(local_data=local_data, h5f_path=h5f_path, n_channels=n_channels, distal_radius=distal_radius, distal_order=distal_order, bin_h5f_paths=bin_h5f_paths, base_codes=base_codes)
     
     #return dataset, data_local, categorical_features
     return dataset
 
 
-def prepare_dataset_np(bed_regions, ref_genome, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1,seq_only=False):
+def prepare_dataset_np(bed_regions, ref_genome, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1,seq_only=False, bw_cache=None, local_seq_codes=None, base_codes=False):
     """Prepare the datasets for given regions, using H5 file"""
     
     # Prepare local data
-    data_local, seq_cols, categorical_features, output_feature = prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only)
+    local_data = prepare_local_data(bed_regions, ref_genome, bw_files, bw_names, local_radius, local_order, seq_only, local_seq_codes)
 
     # If seq_only flag was set, bigWig files will be ignored
     if seq_only:
@@ -825,6 +1709,6 @@ def prepare_dataset_np(bed_regions, ref_genome, bw_files, bw_names, local_radius
         n_channels = 4**distal_order + len(bw_files)
     
     # Combine local data and distal into Dataset objects  
-    dataset = CombinedDatasetNP(data=data_local, seq_cols=seq_cols, cat_cols=categorical_features, output_col=output_feature, ref_genome=ref_genome, bed_regions=bed_regions, distal_radius=distal_radius, n_channels=n_channels, bw_files=bw_files, seq_only=seq_only)
+    dataset = CombinedDatasetNP(local_data=local_data, ref_genome=ref_genome, bed_regions=bed_regions, distal_radius=distal_radius, n_channels=n_channels, bw_files=bw_files, seq_only=seq_only, bw_cache=bw_cache, distal_order=distal_order, base_codes=base_codes)
     #return dataset, data_local, categorical_features
     return dataset
@@ -1,7 +1,6 @@
 import warnings
 warnings.filterwarnings('ignore',category=FutureWarning)
 
-from pybedtools import BedTool
 
 import sys
 import argparse
@@ -24,6 +23,8 @@ from MuRaL.nn_models import *
 from MuRaL.nn_utils import *
 from MuRaL.preprocessing import *
 from MuRaL.evaluation import *
+from MuRaL.bed_utils import read_bed
+from MuRaL.site_utils import SiteEnumerator, SITE_CLASSES
 from MuRaL._version import __version__
 
 from pynvml import *
@@ -43,11 +44,15 @@ def parse_arguments(parser):
     
     required.add_argument('--ref_genome', type=str, metavar='FILE', default='',  
                           required=True, help=textwrap.dedent("""
-                          File path of the reference genome in FASTA format.""").strip())
+                          File path of the reference genome in FASTA format, which
+                          can be bgzip-compressed. With an index by 'samtools faidx'
+                          (.fai, and .gzi if compressed), the genome is read via the
+                          index for few sites instead of being packed in whole.""").strip())
     
-    required.add_argument('--test_data', type=str, metavar='FILE', required=True,
+    required.add_argument('--test_data', type=str, metavar='FILE', default=None,
                           help= textwrap.dedent("""
-                          File path of the data to do prediction, in BED format.""").strip())
+                          File path of the data to do prediction, in BED format.
+                          Not needed if '--site_class' is given.""").strip())
     
     required.add_argument('--model_path', type=str, metavar='FILE', required=True,
                           help=textwrap.dedent("""
@@ -68,6 +73,46 @@ def parse_arguments(parser):
                           File path for the paired calibrator of the trained model.
                           """ ).strip())
     
+    optional.add_argument('--site_class', type=str, metavar='STR', default=None, choices=SITE_CLASSES,
+                          help=textwrap.dedent("""
+                          Do prediction for all sites of this class ('AT', 'CpG' or 
+                          'nonCpG') in the reference genome, instead of the sites in
+                          '--test_data'. Sites are enumerated block by block from the
+                          genome, so no BED file of the sites is needed. Default: None.
+                          """ ).strip())
+    
+    optional.add_argument('--include_bed', type=str, metavar='FILE', default=None,
+                          help=textwrap.dedent("""
+                          BED file of regions in which sites are enumerated for 
+                          '--site_class'. Default: the whole genome.
+                          """ ).strip())
+    
+    optional.add_argument('--exclude_bed', type=str, metavar='FILE', default=None,
+                          help=textwrap.dedent("""
+                          BED file of regions to be excluded for '--site_class'. 
+                          Default: None.
+                          """ ).strip())
+    
+    optional.add_argument('--mut_table', type=str, metavar='FILE', default=None,
+                          help=textwrap.dedent("""
+                          BED file of observed mutations (mutation types in the 5th
+                          column) for the sites enumerated for '--site_class'; other
+                          sites get the type 0. Default: None.
+                          """ ).strip())
+    
+    optional.add_argument('--chroms', type=str, metavar='STR', default=None, nargs='+',
+                          help=textwrap.dedent("""
+                          Chromosomes in which sites are enumerated for '--site_class',
+                          e.g. for running jobs of different chromosomes in parallel.
+                          Default: all chromosomes.
+                          """ ).strip())
+    
+    optional.add_argument('--site_block_size', type=int, metavar='INT', default=1000000,
+                          help=textwrap.dedent("""
+                          Length (bp) of the genome blocks in which sites are enumerated
+                          and predicted for '--site_class'. Default: 1000000.
+                          """ ).strip())
+    
     optional.add_argument('--bw_paths', type=str, metavar='FILE', default=None,
                           help=textwrap.dedent("""
                           File path for a list of BigWig files for non-sequence 
@@ -77,17 +122,46 @@ def parse_arguments(parser):
                           Number of HDF5 files for each BED file. Default: 1.
                           """ ).strip())
     
+    optional.add_argument('--h5_chunk_rows', type=int, metavar='INT', default=256, 
+                          help=textwrap.dedent("""
+                          Number of rows (sites) in each HDF5 chunk of generated HDF5
+                          files. Default: 256.
+                          """ ).strip())
+    
+    optional.add_argument('--cache_dir', type=str, metavar='DIR', default=None,
+                          help=textwrap.dedent("""
+                          Directory for HDF5 files of distal data and folders of local
+                          data, whose names include a hash of the inputs (see 
+                          mural_train). Default: the directory of the BED file.
+                          """ ).strip())
+    
     optional.add_argument('--without_h5', default=False, action='store_true',  
                           help=textwrap.dedent("""
                           Do not generate HDF5 file for the BED file. Default: False.
                           """).strip())
     
+    optional.add_argument('--bw_cache', type=str, metavar='STR', default=None, choices=['float16', 'uint8'],
+                          help=textwrap.dedent("""
+                          Convert bigWig tracks into dense memory-mapped stores of this
+                          type ('float16' or 'uint8') next to the bigWig files, and read
+                          distal bigWig data from them when '--without_h5' is set. 
+                          'uint8' stores values linearly quantized between the minimum
+                          and the maximum of each track. Default: None.""").strip())
+    
+    optional.add_argument('--base_codes', default=False, action='store_true', 
+                          help=textwrap.dedent("""
+                          Feed distal bases to the models as base codes instead of 
+                          one-hot encoding, for distal_order 1 without binned distal
+                          data; the first conv layers gather the weights of the bases,
+                          with the same results. Distal data of sequences only are 
+                          16 times smaller. Default: False.""").strip())
+    
     optional.add_argument('--cpu_only', default=False, action='store_true',  
                           help=textwrap.dedent("""
                           Only use CPU computing. Default: False.
                           """).strip())
         
-    optional.add_argument('--pred_batch_size', metavar='INT', default=16, 
+    optional.add_argument('--pred_batch_size', type=int, metavar='INT', default=16, 
                           help=textwrap.dedent("""
                           Size of mini batches for prediction. Default: 16.
                           """ ).strip())
@@ -118,6 +192,46 @@ def parse_arguments(parser):
 
     return args
 
+def predict_sites(sites, model, calibr, pred_file, ref_genome, bw_files, bw_names, config, criterion, device, pred_batch_size, bw_cache=None, base_codes=False):
+    """
+    Do prediction for the sites enumerated by a SiteEnumerator, block by block
+    
+    Results of each block are appended to pred_file, so that only one block 
+    of sites is kept in memory. Returns the number of sites and the total loss.
+    """
+    n_class = config['n_class']
+    prob_names = ['prob'+str(i) for i in range(n_class)]
+    
+    n_sites = 0
+    total_loss = 0
+    for bed_regions in sites.iter_blocks():
+        dataset = prepare_dataset_np(bed_regions, ref_genome, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], config.get('distal_order', 1), config['seq_only'], bw_cache, base_codes=base_codes)
+        dataloader = get_dataloader(dataset, batch_size=pred_batch_size, shuffle=False, num_workers=0)
+        
+        pred_y, loss = model_predict_m(model, dataloader, criterion, device, n_class, distal=True)
+        
+        y_prob = to_np(F.softmax(pred_y, dim=1))
+        if calibr is not None:
+            y_prob = calibr.predict_proba(y_prob)
+        
+        pred_df = bed_regions.to_dataframe()[['chrom', 'start', 'end', 'strand']]
+        pred_df['mut_type'] = bed_regions.labels
+        pred_df[prob_names] = y_prob
+        
+        # The first block writes the header; other blocks are appended
+        pred_df.to_csv(pred_file, sep='\t', float_format='%.4g', index=False, mode='a' if n_sites > 0 else 'w', header=(n_sites == 0))
+        
+        n_sites += len(bed_regions)
+        total_loss += loss
+        print('Predicted sites:', n_sites, '; last site:', bed_regions.chrom_names[bed_regions.chrom_codes[-1]], bed_regions.starts[-1])
+        sys.stdout.flush()
+    
+    if n_sites == 0:
+        print('Warning: no sites of the given class were found!')
+        pd.DataFrame(columns=['chrom', 'start', 'end', 'strand', 'mut_type'] + prob_names).to_csv(pred_file, sep='\t', index=False)
+    
+    return n_sites, total_loss
+
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
                                      description="""
@@ -168,6 +282,19 @@ def main():
         --without_h5 \\
         --cpu_only \\
         > test.out 2> test.err
+    
+    2. For genome-wide prediction, sites can be enumerated from the reference
+    genome instead of a BED file. The following command will predict mutation 
+    rates for all A/T sites of chr1 outside the regions in 'blacklist.bed', 
+    taking the observed mutation types from 'chr1.mutations.bed'.
+    
+        mural_predict --ref_genome seq.fa --site_class AT --chroms chr1 \\
+        --exclude_bed blacklist.bed --mut_table chr1.mutations.bed \\
+        --model_path checkpoint_6/model \\
+        --model_config_path checkpoint_6/model.config.pkl \\
+        --pred_file chr1.AT.ckpt6.tsv.gz \\
+        --cpu_only \\
+        > chr1.out 2> chr1.err
     """) 
     
     args = parse_arguments(parser)
@@ -188,6 +315,7 @@ def main():
     
     # Whether to generate H5 file for distal data
     without_h5 = args.without_h5
+    bw_cache = args.bw_cache
     n_h5_files = args.n_h5_files
     cpu_only = args.cpu_only
 
@@ -198,6 +326,12 @@ def main():
     
     kmer_corr = args.kmer_corr
     region_corr = args.region_corr
+    
+    # Sites are given by a BED file or enumerated from the genome
+    site_class = args.site_class
+    if (test_file is None) == (site_class is None):
+        print('Error: please provide either --test_data or --site_class!', file=sys.stderr)
+        sys.exit()
 
     # Load model config (hyperparameters)
     if model_config_path != '':
@@ -213,7 +347,8 @@ def main():
     local_hidden1_size = config['local_hidden1_size']
     local_hidden2_size = config['local_hidden2_size']
     distal_radius = config['distal_radius']
-    distal_order = 1 # reserved for future improvement
+    distal_order = config.get('distal_order', 1)
+    distal_bins = config.get('distal_bins', [])
     CNN_kernel_size = config['CNN_kernel_size']  
     CNN_out_channels = config['CNN_out_channels']
     emb_dropout = config['emb_dropout']
@@ -231,7 +366,8 @@ def main():
     sys.stdout.flush()
     
     # Read BED files
-    test_bed = BedTool(test_file)
+    if test_file:
+        test_bed = read_bed(test_file)
 
     # Read bigWig file names
     bw_paths = args.bw_paths
@@ -248,24 +384,37 @@ def main():
     else:
         print('NOTE: no bigWig files provided.')
 
-    # Get the H5 file path for testing data
-    test_h5f_path = get_h5f_path(test_file, bw_names, distal_radius, distal_order)
-
     # Prepare testing data 
-    if without_h5:
-
-        dataset_test = prepare_dataset_np(test_bed, ref_genome, bw_files, bw_names, local_radius, local_order, distal_radius, distal_order, seq_only)
+    if (without_h5 or site_class) and distal_bins:
+        print('Error: the model uses binned distal data, which require HDF5 files!', file=sys.stderr)
+        sys.exit()
+    
+    if site_class:
+        # Datasets of enumerated sites are prepared block by block, without HDF5 files
+        sites = SiteEnumerator(ref_genome, site_class, args.include_bed, args.exclude_bed, args.mut_table, args.chroms, args.site_block_size)
+        n_cont = 0 if seq_only else len(bw_files)
+    
+    elif without_h5:
+        # Local and distal data share one genome reader, e.g. an indexed FASTA for few sites
+        genome = get_genome(ref_genome, len(test_bed)*(2*max(local_radius, distal_radius)+1))
+        dataset_test = prepare_dataset_np(test_bed, genome, bw_files, bw_names, local_radius, local_order, distal_radius, distal_order, seq_only, bw_cache, base_codes=args.base_codes)
         print('using prepare_dataset_np ...')
     else:
+        # Get the H5 file path for testing data
+        cache_dir = args.cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        test_h5f_path = get_h5f_cache_path(test_file, ref_genome, bw_files, bw_names, distal_radius, distal_order, cache_dir)
 
-        dataset_test = prepare_dataset_h5(test_bed, ref_genome, bw_paths, bw_files, bw_names, local_radius, local_order, distal_radius, distal_order, test_h5f_path, 5000, seq_only, n_h5_files)
+        dataset_test = prepare_dataset_h5(test_bed, ref_genome, bw_paths, bw_files, bw_names, local_radius, local_order, distal_radius, distal_order, test_h5f_path, 5000, seq_only, n_h5_files, cache_dir=cache_dir, distal_bins=distal_bins, base_codes=args.base_codes, h5_chunk_rows=args.h5_chunk_rows)
         
         #prepare_dataset_h5(bed_regions, ref_genome, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1, h5f_path='distal_data.h5', h5_chunk_size=1, seq_only=False, n_h5_files=1)
             
-    data_local_test = dataset_test.data_local
-    n_cont = len(dataset_test.cont_cols)
-    
-    test_size = len(dataset_test)
+    if not site_class:
+        data_local_test = dataset_test.data_local
+        n_cont = len(dataset_test.cont_cols)
+        
+        test_size = len(dataset_test)
 
     sys.stdout.flush()
     
@@ -294,6 +443,8 @@ def main():
         model = Network1(in_channels=4**distal_order+n_cont, out_channels=CNN_out_channels, kernel_size=CNN_kernel_size, distal_radius=distal_radius, distal_order=distal_order, distal_fc_dropout=distal_fc_dropout, n_class=n_class).to(device)
     elif model_no == 2:
         model = Network2(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[local_hidden1_size, local_hidden2_size], emb_dropout=emb_dropout, lin_layer_dropouts=[local_dropout, local_dropout], in_channels=4**distal_order+n_cont, out_channels=CNN_out_channels, kernel_size=CNN_kernel_size, distal_radius=distal_radius, distal_order=distal_order, distal_fc_dropout=distal_fc_dropout, n_class=n_class, emb_padding_idx=4**local_order).to(device)
+    elif model_no == 3:
+        model = Network3(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[local_hidden1_size, local_hidden2_size], emb_dropout=emb_dropout, lin_layer_dropouts=[local_dropout, local_dropout], in_channels=4**distal_order+n_cont, out_channels=CNN_out_channels, kernel_size=CNN_kernel_size, distal_radius=distal_radius, distal_order=distal_order, distal_fc_dropout=distal_fc_dropout, n_class=n_class, emb_padding_idx=4**local_order, distal_bins=distal_bins).to(device)
     elif model_no == 10:
         model = Network10(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[local_hidden1_size, local_hidden2_size], emb_dropout=emb_dropout, lin_layer_dropouts=[local_dropout, local_dropout], in_channels=4**distal_order+n_cont, out_channels=CNN_out_channels, kernel_size=CNN_kernel_size, distal_radius=distal_radius, distal_order=distal_order, distal_fc_dropout=distal_fc_dropout, n_class=n_class, emb_padding_idx=4**local_order).to(device)
     elif model_no == 11:
@@ -318,11 +469,29 @@ def main():
     # Set prob names for mutation types
     prob_names = ['prob'+str(i) for i in range(n_class)]
 
+    if site_class:
+        calibr = None
+        if calibrator_path != '':
+            with open(calibrator_path, 'rb') as fcal:   
+                print('using calibrator for scaling ...')
+                calibr = pickle.load(fcal)
+        
+        test_size, test_total_loss = predict_sites(sites, model, calibr, pred_file, sites.genome, bw_files, bw_names, config, criterion, device, pred_batch_size, bw_cache, args.base_codes)
+        
+        print('Mean Loss, Total Loss, Test Size:', test_total_loss/max(test_size, 1), test_total_loss, test_size)
+        if args.mut_table:
+            print('Mutations found among the enumerated sites:', sites.n_mutations_found, 'of', sites.n_mutations)
+        if len(kmer_corr) > 0 or len(region_corr) > 0:
+            print('NOTE: k-mer and regional correlations are not calculated for enumerated sites.')
+        print('Total time used: %s seconds' % (time.time() - start_time))
+        
+        return
+    
     # Dataloader for testing data    
     if cpu_only:
-        dataloader = DataLoader(dataset_test, batch_size=pred_batch_size, shuffle=False, num_workers=0)
+        dataloader = get_dataloader(dataset_test, batch_size=pred_batch_size, shuffle=False, num_workers=0)
     else:
-        dataloader = DataLoader(dataset_test, batch_size=pred_batch_size, shuffle=False, num_workers=0)   
+        dataloader = get_dataloader(dataset_test, batch_size=pred_batch_size, shuffle=False, num_workers=0)   
 
     # Do the prediction
     pred_y, test_total_loss = model_predict_m(model, dataloader, criterion, device, n_class, distal=True)
@@ -1,7 +1,6 @@
 import warnings
 warnings.filterwarnings('ignore',category=FutureWarning)
 
-from pybedtools import BedTool
 
 import sys
 import argparse
@@ -24,6 +23,8 @@ from MuRaL.nn_utils import *
 from MuRaL.preprocessing import *
 from MuRaL.evaluation import *
 from MuRaL.training import *
+from MuRaL.bed_utils import read_bed
+from MuRaL.bw_utils import get_bw_store, get_bw_sum_index
 from MuRaL._version import __version__
 
 
@@ -124,10 +125,57 @@ def parse_arguments(parser):
     data_args.add_argument('--without_h5', default=False, action='store_true', 
                           help=textwrap.dedent("""
                           Do not generate HDF5 files for input BED files. Default: False.""").strip())
+    
+    data_args.add_argument('--bw_cache', type=str, metavar='STR', default=None, choices=['float16', 'uint8'],
+                          help=textwrap.dedent("""
+                          Convert bigWig tracks into dense memory-mapped stores of this
+                          type ('float16' or 'uint8') next to the bigWig files, and read
+                          distal bigWig data from them when '--without_h5' is set. 
+                          'uint8' stores values linearly quantized between the minimum
+                          and the maximum of each track. Default: None.""").strip())
 
+    data_args.add_argument('--preload', default=False, action='store_true', 
+                          help=textwrap.dedent("""
+                          Load the distal data of HDF5 files into shared memory once
+                          in each trial, so that DataLoader workers don't decompress
+                          them in every epoch; for data fitting in RAM. With 
+                          '--without_h5', bigWig tracks are read from dense stores 
+                          (see '--bw_cache', 'float16' if not set). Default: False.""").strip())
+    
+    data_args.add_argument('--base_codes', default=False, action='store_true', 
+                          help=textwrap.dedent("""
+                          Feed distal bases to the models as base codes instead of 
+                          one-hot encoding, for distal_order 1 without binned distal
+                          data; the first conv layers gather the weights of the bases,
+                          with the same results. Distal data of sequences only are 
+                          16 times smaller. Default: False.""").strip())
+    
+    data_args.add_argument('--stream_buffer', type=int, metavar='INT', default=0, 
+                          help=textwrap.dedent("""
+                          Stream the HDF5 files of training data instead of reading
+                          sites at random: each DataLoader worker reads whole HDF5 
+                          files (see '--n_h5_files') sequentially, and samples are 
+                          shuffled in a buffer of this size per worker. For training
+                          data larger than RAM. 0: no streaming. Default: 0.""").strip())
+    
+    data_args.add_argument('--cache_dir', type=str, metavar='DIR', default=None,
+                          help=textwrap.dedent("""
+                          Directory for HDF5 files of distal data and folders of local
+                          data. Names include a hash of the BED content, the genome and
+                          bigWig files and the parameters, so that files are reused
+                          only for the same inputs; concurrent jobs wait for the one
+                          generating a file. Default: the directory of each BED file.""").strip())
+    
     data_args.add_argument('--n_h5_files', type=int, metavar='INT', default=1, 
                           help=textwrap.dedent("""
                           Number of HDF5 files for each BED file. Default: 1. """ ).strip())
+    
+    data_args.add_argument('--h5_chunk_rows', type=int, metavar='INT', default=256, 
+                          help=textwrap.dedent("""
+                          Number of rows (sites) in each HDF5 chunk of generated HDF5
+                          files. Rows of a chunk are drawn in nearby batches during 
+                          training, so that each chunk is decompressed once for a few
+                          batches. Default: 256. """ ).strip())
 
     
     learn_args.add_argument('--batch_size', type=int, metavar='INT', default=[128], nargs='+', 
@@ -359,7 +407,8 @@ def main():
         local_hidden1_size = args.local_hidden1_size = config['local_hidden1_size']
         local_hidden2_size = args.local_hidden2_size = config['local_hidden2_size']
         distal_radius = args.distal_radius = config['distal_radius']
-        distal_order = args.distal_order = 1 # reserved for future improvement
+        distal_order = args.distal_order = config.get('distal_order', 1)
+        args.distal_bins = config.get('distal_bins', [])
         CNN_kernel_size = args.CNN_kernel_size = config['CNN_kernel_size']  
         CNN_out_channels = args.CNN_out_channels = config['CNN_out_channels']
         emb_dropout = args.emb_dropout = config['emb_dropout']
@@ -372,6 +421,13 @@ def main():
 
         args.seq_only = config['seq_only']
     
+    if args.distal_bins and args.without_h5:
+        print('Error: the model uses binned distal data, which require HDF5 files!', file=sys.stderr)
+        sys.exit()
+    
+    if args.base_codes and (distal_order > 1 or args.distal_bins):
+        print('NOTE: --base_codes is ignored for distal_order > 1 or --distal_bins')
+    
     
     start_time = time.time()
     print('Start time:', datetime.datetime.now())
@@ -402,18 +458,49 @@ def main():
     else:
         print('NOTE: no bigWig files provided.')
     # Read the train datapoints
-    train_bed = BedTool(train_file)
+    train_bed = read_bed(train_file)
+    
+    # Pack the reference genome once, so that trials only map the packed file
+    get_genome(ref_genome)
+    
+    # With preloading, tracks without HDF5 files are also decompressed once
+    if args.preload and args.without_h5 and not args.bw_cache:
+        args.bw_cache = 'float16'
+        print('NOTE: using float16 bigWig stores for --preload')
+    
+    if args.stream_buffer > 0 and args.without_h5:
+        print('NOTE: --stream_buffer is ignored with --without_h5')
+    
+    # Likewise for the bigWig stores used by the datasets without HDF5 files
+    if args.without_h5 and args.bw_cache:
+        for bw_file in bw_files:
+            get_bw_store(bw_file, args.bw_cache)
+    
+    # Build the prefix-sum indices of bigWig tracks once, so that trials
+    # compute local window means without reading the tracks
+    if not args.seq_only:
+        for bw_file in bw_files:
+            get_bw_sum_index(bw_file)
     
     # Generate H5 files for storing distal regions before training, one file for each possible distal radius
+    args.h5_distal_radius = distal_radius
+    if args.cache_dir:
+        args.cache_dir = os.path.abspath(args.cache_dir)
+        os.makedirs(args.cache_dir, exist_ok=True)
+    
     if not args.without_h5:
-        h5f_path = get_h5f_path(train_file, bw_names, distal_radius, distal_order)
-        generate_h5fv2(train_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size=10000, n_h5_files=n_h5_files)
+        h5f_path = get_h5f_cache_path(train_file, ref_genome, bw_files, bw_names, distal_radius, distal_order, args.cache_dir)
+        generate_h5fv2(train_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size=10000, n_h5_files=n_h5_files, h5_chunk_rows=args.h5_chunk_rows, cache_dir=args.cache_dir, n_workers=ray_ncpus)
+        generate_distal_bins_h5f(train_bed, ref_genome, bw_paths, bw_files, bw_names, args.distal_bins, n_h5_files, args.cache_dir, n_workers=ray_ncpus, h5_chunk_rows=args.h5_chunk_rows)
         #generate_h5f(train_bed, h5f_path, ref_genome, distal_radius, distal_order, bw_files, 1)
     
+    valid_bed = None
     if valid_file:
-        valid_bed = BedTool(valid_file)
-        valid_h5f_path = get_h5f_path(valid_file, bw_names, distal_radius, distal_order)
-        generate_h5fv2(valid_bed, valid_h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size=10000, n_h5_files=n_h5_files)
+        valid_bed = read_bed(valid_file)
+        if not args.without_h5:
+            valid_h5f_path = get_h5f_cache_path(valid_file, ref_genome, bw_files, bw_names, distal_radius, distal_order, args.cache_dir)
+            generate_h5fv2(valid_bed, valid_h5f_path, ref_genome, distal_radius, distal_order, bw_paths, bw_files, chunk_size=10000, n_h5_files=n_h5_files, h5_chunk_rows=args.h5_chunk_rows, cache_dir=args.cache_dir, n_workers=ray_ncpus)
+            generate_distal_bins_h5f(valid_bed, ref_genome, bw_paths, bw_files, bw_names, args.distal_bins, n_h5_files, args.cache_dir, n_workers=ray_ncpus, h5_chunk_rows=args.h5_chunk_rows)
         #generate_h5f(valid_bed, valid_h5f_path, ref_genome, distal_radius, distal_order, bw_files, 1)
     
     if ray_ngpus > 0 or gpu_per_trial > 0:
@@ -435,6 +522,9 @@ def main():
     # Allocate CPU/GPU resources for this Ray job
     ray.init(num_cpus=ray_ncpus, num_gpus=ray_ngpus, dashboard_host="0.0.0.0")
     
+    # The datasets are prepared once, when first used; trials get them from the object store
+    dataset_store = TrainDatasetStore.remote(args, train_bed, valid_bed, bw_files, bw_names, local_radius)
+    
     sys.stdout.flush()
     
     # Configure the search space for relavant hyperparameters
@@ -475,7 +565,7 @@ def main():
     reporter = CLIReporter(parameter_columns=['local_radius', 'local_order', 'local_hidden1_size', 'local_hidden2_size', 'distal_radius', 'emb_dropout', 'local_dropout', 'CNN_kernel_size', 'CNN_out_channels', 'distal_fc_dropout', 'transfer_learning', 'train_all', 'init_fc_with_pretrained', 'optim', 'learning_rate', 'weight_decay', 'LR_gamma'], metric_columns=['loss', 'fdiri_loss', 'after_min_loss','score', 'total_params', 'training_iteration'])
     
     trainable_id = 'Train'
-    tune.register_trainable(trainable_id, partial(train, args=args))
+    tune.register_trainable(trainable_id, partial(train, args=args, dataset_store=dataset_store))
     
     def trial_dirname_string(trial):
         return "{}_{}".format(trial.trainable_name, trial.trial_id)
@@ -0,0 +1,168 @@
+import sys
+
+import numpy as np
+
+from MuRaL.bed_utils import read_bed, BedRegions
+from MuRaL.genome_utils import get_genome, encode_seq
+
+
+# Classes of sites to be enumerated; sites are oriented so that the focal
+# bases of a class are the same (e.g. A for 'AT', C for 'CpG'), as in the
+# BED files for training
+SITE_CLASSES = ['AT', 'CpG', 'nonCpG']
+
+# Base codes (see genome_utils.BASES)
+A, C, G, T = 0, 1, 2, 3
+
+
+def get_site_masks(codes, site_class):
+    """Find the sites of a class in a sequence
+
+    Args:
+        codes: base codes of a sequence with one flanking base at each end
+        site_class: one of SITE_CLASSES
+
+    Returns masks of '+' and '-' strand sites for the inner bases; 'N' and
+    other non-ACGT bases never match.
+    """
+    prev, mid, nxt = codes[:-2], codes[1:-1], codes[2:]
+
+    if site_class == 'AT':
+        return mid == A, mid == T
+    elif site_class == 'CpG':
+        return (mid == C) & (nxt == G), (mid == G) & (prev == C)
+    elif site_class == 'nonCpG':
+        return (mid == C) & (nxt != G), (mid == G) & (prev != C)
+
+    print('Error: unknown site class:', site_class, file=sys.stderr)
+    sys.exit()
+
+def read_mutation_table(mut_file):
+    """Read a sparse table of mutated sites, in BED format with labels in the 'score' column
+
+    Returns a dict of chrom -> (sorted start positions, labels).
+    """
+    muts = read_bed(mut_file)
+    chroms = muts.chroms
+
+    mutations = {}
+    for chrom in np.unique(chroms):
+        idx = np.flatnonzero(chroms == chrom)
+        idx = idx[np.argsort(muts.starts[idx], kind='stable')]
+        mutations[chrom] = (muts.starts[idx], muts.labels[idx])
+
+    return mutations
+
+
+class SiteEnumerator:
+    """Enumerate the sites of a class in the reference genome, block by block
+
+    Sites are found in genome blocks with vectorized masks, so that no BED
+    file of all sites is needed, e.g. for genome-wide prediction. Blocks
+    without any ACGT base (e.g. runs of 'N') or outside the included
+    regions are skipped without encoding their sequences.
+    """
+    def __init__(self, ref_genome, site_class, include_bed=None, exclude_bed=None, mut_table=None, chroms=None, block_size=1000000):
+        """
+        Args:
+            ref_genome: reference genome (FASTA file, GenomeStore or IndexedFasta)
+            site_class: one of SITE_CLASSES
+            include_bed: BED file of regions to be included; default: whole genome
+            exclude_bed: BED file of regions to be excluded
+            mut_table: BED file of mutated sites, with labels in the 'score'
+                column; other sites get the label 0
+            chroms: chromosomes to be enumerated; default: all in the genome
+            block_size: length (bp) of genome blocks
+        """
+        if site_class not in SITE_CLASSES:
+            print('Error: site class should be one of', SITE_CLASSES, file=sys.stderr)
+            sys.exit()
+
+        self.genome = get_genome(ref_genome)
+        self.site_class = site_class
+        self.block_size = block_size
+
+        if chroms:
+            missing = [chrom for chrom in chroms if chrom not in self.genome]
+            if len(missing) > 0:
+                print('Error: chromosomes not found in the reference genome:', missing, file=sys.stderr)
+                sys.exit()
+        self.chrom_names = np.array(list(chroms) if chroms else list(self.genome.keys()), dtype=str)
+
+        self.include = read_bed(include_bed) if include_bed else None
+        self.exclude = read_bed(exclude_bed) if exclude_bed else None
+        self.mutations = read_mutation_table(mut_table) if mut_table else {}
+
+        # Number of mutated sites found among enumerated sites
+        self.n_mutations_found = 0
+
+    @property
+    def n_mutations(self):
+        """Number of sites in the mutation table for the enumerated chromosomes"""
+        return sum(len(self.mutations[chrom][0]) for chrom in self.chrom_names if chrom in self.mutations)
+
+    def _get_chrom_regions(self, regions, chrom):
+        """Get the regions of a chromosome"""
+        if regions is None:
+            return None
+
+        return regions[np.flatnonzero(regions.chroms == chrom)]
+
+    def iter_blocks(self):
+        """Yield a BedRegions object for the sites of each genome block having any site"""
+        for chrom_code, chrom in enumerate(self.chrom_names):
+            chrom_len = self.genome.chrom_len(chrom)
+            include = self._get_chrom_regions(self.include, chrom)
+            exclude = self._get_chrom_regions(self.exclude, chrom)
+
+            if include is not None and len(include) == 0:
+                continue
+
+            for block_start in range(0, chrom_len, self.block_size):
+                block_end = min(block_start + self.block_size, chrom_len)
+
+                if include is not None and not include.overlaps([chrom], [block_start], [block_end])[0]:
+                    continue
+                if not np.any(self.genome.get_seq(chrom, block_start, block_end) != ord('N')):
+                    continue
+
+                bed_regions = self.get_block(chrom_code, block_start, block_end, include, exclude)
+                if len(bed_regions) > 0:
+                    yield bed_regions
+
+    def get_block(self, chrom_code, block_start, block_end, include=None, exclude=None):
+        """Get the sites of [block_start, block_end) of a chromosome as a BedRegions object
+
+        Args:
+            chrom_code: index of the chromosome in chrom_names
+            block_start, block_end: 0-based coordinates of the block
+            include, exclude: regions of the chromosome to be included/excluded
+        """
+        chrom = self.chrom_names[chrom_code]
+
+        # One flanking base at each end for the dinucleotide context
+        codes = encode_seq(self.genome.get_seq(chrom, block_start-1, block_end+1))
+        plus, minus = get_site_masks(codes, self.site_class)
+
+        starts = block_start + np.flatnonzero(plus | minus)
+        strands = np.where(plus[starts-block_start], 1, -1).astype(np.int8)
+
+        if include is not None or exclude is not None:
+            keep = np.ones(len(starts), dtype=bool)
+            chroms = np.full(len(starts), chrom)
+            if include is not None:
+                keep &= include.overlaps(chroms, starts, starts+1)
+            if exclude is not None:
+                keep &= ~exclude.overlaps(chroms, starts, starts+1)
+            starts, strands = starts[keep], strands[keep]
+
+        # Join the labels of mutated sites by position
+        labels = np.zeros(len(starts), dtype=np.int8)
+        if chrom in self.mutations:
+            mut_starts, mut_labels = self.mutations[chrom]
+            idx = np.minimum(np.searchsorted(mut_starts, starts), len(mut_starts)-1)
+            found = mut_starts[idx] == starts
+            labels[found] = mut_labels[idx[found]]
+            self.n_mutations_found += int(found.sum())
+
+        return BedRegions(np.full(len(starts), chrom_code, dtype=np.int32), self.chrom_names, starts, starts+1, strands, labels)
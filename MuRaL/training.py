@@ -1,7 +1,6 @@
 import warnings
 warnings.filterwarnings('ignore',category=FutureWarning)
 
-from pybedtools import BedTool
 
 import sys
 import argparse
@@ -12,7 +11,7 @@ import pickle
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
+from torch.utils.data import Dataset, WeightedRandomSampler
 from torch.utils.data import random_split
 
 torch.backends.cuda.matmul.allow_tf32 = True
@@ -35,11 +34,113 @@ from MuRaL.nn_models import *
 from MuRaL.nn_utils import *
 from MuRaL.preprocessing import *
 from MuRaL.evaluation import *
+from MuRaL.bed_utils import read_bed
 
 #from torchsampler import ImbalancedDatasetSampler
 
 
-def train(config, args, checkpoint_dir=None):
+def prepare_train_datasets(args, train_bed, valid_bed, bw_files, bw_names, local_radius, local_order, distal_radius, local_seq_codes=None):
+    """
+    Prepare the training dataset and, if a validation file is given, the
+    validation dataset.
+    
+    Args:
+        args: input args from the command line
+        train_bed: BedRegions of the training data
+        valid_bed: BedRegions of the validation data; None without a validation file
+        bw_files: file paths of bigWig tracks
+        bw_names: names of bigWig tracks
+        local_radius, local_order, distal_radius: hyperparameters of the datasets
+        local_seq_codes: (train_codes, valid_codes), base codes of the sites
+            extracted at the largest local radius (see prepare_local_data)
+    
+    H5 files are those of the largest distal radius (args.h5_distal_radius),
+    center-cropped by the datasets; binned distal data of args.distal_bins
+    are appended to the distal data.
+    
+    Returns (dataset, dataset_valid); dataset_valid is None without a validation file.
+    """
+    distal_order = args.distal_order
+    h5_distal_radius = max(distal_radius, args.h5_distal_radius)
+    train_codes, valid_codes = local_seq_codes if local_seq_codes is not None else (None, None)
+    
+    if args.without_h5:
+        dataset = prepare_dataset_np(train_bed, args.ref_genome, bw_files, bw_names, local_radius, local_order, distal_radius, distal_order, seq_only=args.seq_only, bw_cache=args.bw_cache, local_seq_codes=train_codes, base_codes=args.base_codes)
+        print('using numpy/pandas for distal_seq ...')
+    else:
+        # Get the H5 file path
+        train_h5f_path = get_h5f_cache_path(args.train_data, args.ref_genome, bw_files, bw_names, h5_distal_radius, distal_order, args.cache_dir)
+
+        # Prepare the datasets for trainging
+        dataset = prepare_dataset_h5(train_bed, args.ref_genome, args.bw_paths, bw_files, bw_names, local_radius, local_order, distal_radius, distal_order, train_h5f_path, chunk_size=5000, seq_only=args.seq_only, n_h5_files=args.n_h5_files, h5_distal_radius=h5_distal_radius, local_seq_codes=train_codes, cache_dir=args.cache_dir, distal_bins=args.distal_bins, base_codes=args.base_codes, n_workers=args.cpu_per_trial, h5_chunk_rows=args.h5_chunk_rows)
+        
+        #prepare_dataset_h5(bed_regions, ref_genome, bw_paths, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1, h5f_path='distal_data.h5', chunk_size=5000, seq_only=False, n_h5_files=1)
+    
+    dataset_valid = None
+    if valid_bed is not None:
+        if args.without_h5:
+            dataset_valid = prepare_dataset_np(valid_bed, args.ref_genome, bw_files, bw_names, local_radius, local_order, distal_radius, distal_order, seq_only=args.seq_only, bw_cache=args.bw_cache, local_seq_codes=valid_codes, base_codes=args.base_codes)
+        else:
+            valid_h5f_path = get_h5f_cache_path(args.validation_data, args.ref_genome, bw_files, bw_names, h5_distal_radius, distal_order, args.cache_dir)
+            dataset_valid = prepare_dataset_h5(valid_bed, args.ref_genome, args.bw_paths, bw_files, bw_names, local_radius, local_order, distal_radius, distal_order, valid_h5f_path, chunk_size=5000, seq_only=args.seq_only, n_h5_files=args.n_h5_files, h5_distal_radius=h5_distal_radius, local_seq_codes=valid_codes, cache_dir=args.cache_dir, distal_bins=args.distal_bins, base_codes=args.base_codes, n_workers=args.cpu_per_trial, h5_chunk_rows=args.h5_chunk_rows)
+    
+    return dataset, dataset_valid
+
+@ray.remote(num_cpus=0)
+class TrainDatasetStore:
+    """
+    Ray actor preparing the datasets of a (local_radius, local_order, 
+    distal_radius) combination when a trial first asks for it, and keeping 
+    them in the Ray object store, so that later trials of the combination 
+    share them instead of preparing their own (see train).
+    
+    Only the combinations run by trials are prepared; each of them stays in
+    the object store until the experiment ends. Requests are served one at
+    a time, so trials wait for a combination being prepared.
+    """
+    def __init__(self, args, train_bed, valid_bed, bw_files, bw_names, max_local_radius):
+        """
+        Args:
+            args: input args from the command line
+            train_bed: BedRegions of the training data
+            valid_bed: BedRegions of the validation data; None without a validation file
+            bw_files: file paths of bigWig tracks
+            bw_names: names of bigWig tracks
+            max_local_radius: largest local_radius, at which local bases are extracted once
+        """
+        self.args = args
+        self.train_bed = train_bed
+        self.valid_bed = valid_bed
+        self.bw_files = bw_files
+        self.bw_names = bw_names
+        self.max_local_radius = max_local_radius
+        
+        self.local_seq_codes = None
+        self.dataset_refs = {}
+    
+    def get(self, key):
+        """
+        Get the object ref of the datasets for key (local_radius, local_order,
+        distal_radius), preparing them if needed; the ref is returned in a list,
+        so that Ray doesn't resolve it.
+        """
+        if key not in self.dataset_refs:
+            if self.local_seq_codes is None:
+                genome = get_genome(self.args.ref_genome)
+                self.local_seq_codes = [get_seq_codes(genome, *get_bed_columns(self.train_bed), self.max_local_radius), None]
+                if self.valid_bed is not None:
+                    self.local_seq_codes[1] = get_seq_codes(genome, *get_bed_columns(self.valid_bed), self.max_local_radius)
+            
+            print('Preparing the datasets for (local_radius, local_order, distal_radius):', key)
+            self.dataset_refs[key] = ray.put(prepare_train_datasets(self.args, self.train_bed, self.valid_bed, self.bw_files, self.bw_names, *key, local_seq_codes=self.local_seq_codes))
+        
+        return [self.dataset_refs[key]]
+    
+    def get_beds(self):
+        """Get (train_bed, valid_bed), the BED regions read once for the experiment"""
+        return self.train_bed, self.valid_bed
+
+def train(config, args, checkpoint_dir=None, dataset_store=None):
     """
     Training funtion.
     
@@ -47,13 +148,12 @@ def train(config, args, checkpoint_dir=None):
         config: configuration of hyperparameters
         args: input args from the command line
         checkpoint_dir: checkpoint dir
+        dataset_store: TrainDatasetStore actor sharing the datasets among trials
     """
 
     # Get parameters from the command line
     train_file = args.train_data # Ray requires absolute paths
     valid_file = args.validation_data
-    ref_genome= args.ref_genome
-    n_h5_files = args.n_h5_files
 
     local_radius = args.local_radius
     local_order = args.local_order
@@ -83,6 +183,7 @@ def train(config, args, checkpoint_dir=None):
     seq_only = args.seq_only
     cudnn_benchmark_false = args.cudnn_benchmark_false
     without_h5 = args.without_h5
+    preload = args.preload
     split_seed = args.split_seed
     gpu_per_trial = args.gpu_per_trial
     cpu_per_trial = args.cpu_per_trial
@@ -106,28 +207,33 @@ def train(config, args, checkpoint_dir=None):
     else:
         print('NOTE: no bigWig files provided.')
 
-    # Read BED files
-    train_bed = BedTool(train_file)
-    
-    if without_h5:
-        dataset = prepare_dataset_np(train_bed, ref_genome, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, seq_only=seq_only)
-        print('using numpy/pandas for distal_seq ...')
+    # Use the BED regions and the datasets built once for the experiment if 
+    # available; their arrays are read from the Ray object store without copying
+    dataset_key = (config['local_radius'], config['local_order'], config['distal_radius'])
+    if dataset_store is not None:
+        train_bed, valid_bed = ray.get(dataset_store.get_beds.remote())
+        dataset, dataset_valid = ray.get(ray.get(dataset_store.get.remote(dataset_key))[0])
     else:
-        # Get the H5 file path
-        train_h5f_path = get_h5f_path(train_file, bw_names, config['distal_radius'], distal_order)
-
-        # Prepare the datasets for trainging
-        dataset = prepare_dataset_h5(train_bed, ref_genome, bw_paths, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, train_h5f_path, chunk_size=5000, seq_only=seq_only, n_h5_files=n_h5_files)
-        
-        #prepare_dataset_h5(bed_regions, ref_genome, bw_paths, bw_files, bw_names, local_radius=5, local_order=1, distal_radius=50, distal_order=1, h5f_path='distal_data.h5', chunk_size=5000, seq_only=False, n_h5_files=1)
+        # Read BED files
+        train_bed = read_bed(train_file)
+        valid_bed = read_bed(valid_file) if valid_file else None
+        dataset, dataset_valid = prepare_train_datasets(args, train_bed, valid_bed, bw_files, bw_names, *dataset_key)
     
-    data_local = dataset.data_local
+    # Decompress the distal data once; forked workers share the memory
+    if preload and not without_h5:
+        dataset.preload()
+        if valid_file:
+            dataset_valid.preload()
+    
+    local_data = dataset.local_data
     categorical_features = dataset.cat_cols
     n_cont = len(dataset.cont_cols)
     
     #config['n_cont'] = n_cont
     config['n_class'] = n_class
     config['model_no'] = model_no
+    config['distal_order'] = distal_order
+    config['distal_bins'] = args.distal_bins
     #config['bw_paths'] = bw_paths
     config['seq_only'] = seq_only
     config['restart_lr'] = restart_lr
@@ -137,13 +243,6 @@ def train(config, args, checkpoint_dir=None):
     ################
     if valid_file:
         print('using given validation file:', valid_file)
-        valid_bed = BedTool(valid_file)
-        valid_h5f_path = get_h5f_path(valid_file, bw_names, config['distal_radius'], distal_order)
-        if without_h5:
-            dataset_valid = prepare_dataset_np(valid_bed, ref_genome, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, seq_only=seq_only)
-        else:
-            dataset_valid = prepare_dataset_h5(valid_bed, ref_genome, bw_paths, bw_files, bw_names, config['local_radius'], config['local_order'], config['distal_radius'], distal_order, valid_h5f_path, chunk_size=5000, seq_only=seq_only, n_h5_files=n_h5_files)
-        
         data_local_valid = dataset_valid.data_local
     ################
     
@@ -169,7 +268,7 @@ def train(config, args, checkpoint_dir=None):
         dataset_train, dataset_valid = random_split(dataset, [train_size, valid_size], torch.Generator().manual_seed(split_seed))
         dataset_valid.indices.sort()
         #data_local_valid = dataset.data_local.iloc[dataset_valid.indices, :]
-        data_local_valid = data_local.iloc[dataset_valid.indices, ].reset_index(drop=True)
+        data_local_valid = local_data.to_dataframe(dataset_valid.indices)
     else:
         dataset_train = dataset
         train_size = len(dataset_train)
@@ -179,17 +278,17 @@ def train(config, args, checkpoint_dir=None):
     # Dataloader for training
     #if not ImbSampler: 
     if not sample_weights:
-        dataloader_train = DataLoader(dataset_train, config['batch_size'], shuffle=True, num_workers=cpu_per_trial-1, pin_memory=True)
+        dataloader_train = get_dataloader(dataset_train, config['batch_size'], shuffle=True, stream_buffer=args.stream_buffer, num_workers=cpu_per_trial-1, pin_memory=True)
     else:
         weights = pd.read_csv(sample_weights, sep='\t', header=None)
         weights = weights[3]
         weighted_sampler = WeightedRandomSampler(weights, len(weights), replacement=True)
         
-        dataloader_train = DataLoader(dataset_train, config['batch_size'], shuffle=False, sampler=weighted_sampler, num_workers=cpu_per_trial-1, pin_memory=True)
+        dataloader_train = get_dataloader(dataset_train, config['batch_size'], shuffle=False, sampler=weighted_sampler, num_workers=cpu_per_trial-1, pin_memory=True)
         #dataloader_train = DataLoader(dataset_train, config['batch_size'], shuffle=False, sampler=ImbalancedDatasetSampler(dataset_train), num_workers=cpu_per_trial-1, pin_memory=True)
     
     # Dataloader for predicting
-    dataloader_valid = DataLoader(dataset_valid, config['batch_size'], shuffle=False, num_workers=0, pin_memory=True)
+    dataloader_valid = get_dataloader(dataset_valid, config['batch_size'], shuffle=False, num_workers=0, pin_memory=True)
 
     if config['transfer_learning']:
         emb_dims = config['emb_dims']
@@ -214,6 +313,10 @@ def train(config, args, checkpoint_dir=None):
     elif model_no == 2:
         # Combined model
         model = Network2(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[config['local_hidden1_size'], config['local_hidden2_size']], emb_dropout=config['emb_dropout'], lin_layer_dropouts=[config['local_dropout'], config['local_dropout']], in_channels=4**distal_order+n_cont, out_channels=config['CNN_out_channels'], kernel_size=config['CNN_kernel_size'], distal_radius=config['distal_radius'], distal_order=distal_order, distal_fc_dropout=config['distal_fc_dropout'], n_class=n_class, emb_padding_idx=4**config['local_order'])
+    
+    elif model_no == 3:
+        # Combined model with multi-resolution distal data
+        model = Network3(emb_dims, no_of_cont=n_cont, lin_layer_sizes=[config['local_hidden1_size'], config['local_hidden2_size']], emb_dropout=config['emb_dropout'], lin_layer_dropouts=[config['local_dropout'], config['local_dropout']], in_channels=4**distal_order+n_cont, out_channels=config['CNN_out_channels'], kernel_size=config['CNN_kernel_size'], distal_radius=config['distal_radius'], distal_order=distal_order, distal_fc_dropout=config['distal_fc_dropout'], n_class=n_class, emb_padding_idx=4**config['local_order'], distal_bins=args.distal_bins)
     else:
         print('Error: no model selected!')
         sys.exit() 
@@ -371,7 +474,7 @@ def train(config, args, checkpoint_dir=None):
             valid_y_prob = pd.DataFrame(data=to_np(F.softmax(valid_pred_y, dim=1)), columns=prob_names)
             
             if not valid_file:
-                valid_data_and_prob = pd.concat([data_local.iloc[dataset_valid.indices, ].reset_index(drop=True), valid_y_prob], axis=1)
+                valid_data_and_prob = pd.concat([data_local_valid, valid_y_prob], axis=1)
                 
             else:
                 valid_data_and_prob = pd.concat([data_local_valid, valid_y_prob], axis=1)
@@ -446,7 +549,7 @@ def train(config, args, checkpoint_dir=None):
             
             # Output genomic positions and predicted probabilities
             if not valid_file:
-                chr_pos = train_bed.to_dataframe().loc[dataset_valid.indices,['chrom', 'start', 'end', 'strand']].reset_index(drop=True)
+                chr_pos = train_bed[dataset_valid.indices].to_dataframe()[['chrom', 'start', 'end', 'strand']]
             else:
                 chr_pos = valid_bed.to_dataframe()[['chrom', 'start', 'end', 'strand']]
                 